@@ -0,0 +1,683 @@
+import argparse
+import contextlib
+import csv
+import http.server
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+import citationvalidator as cv
+
+# Benchmarks for citationvalidator. Run e.g.:
+#   python benchmark.py bibtex --entries 20000
+#   python benchmark.py bibtex --file mythesislibrary.bib
+#   python benchmark.py startup
+#   python benchmark.py duplicates --entries 200000
+#   python benchmark.py latex --paragraphs 20000
+#   python benchmark.py embeddings --model biobert --backends torch torch-int8 onnx --max-seq-length 256
+#   python benchmark.py vectors --abstracts 100000
+#   python benchmark.py pipeline --entries 500 --paragraphs 300 --latency 0.05 --error-rate 0.01 --save baseline.json
+#   python benchmark.py pipeline --entries 500 --paragraphs 300 --latency 0.05 --error-rate 0.01 --baseline baseline.json
+
+WORDS = ("cell protein expression tumor signalling pathway mouse model human patients clinical trial analysis gene receptor activation "
+	"inhibition response treatment disease brain neuronal synaptic plasticity memory cortex imaging study cohort risk factor association "
+	"mechanism regulation metabolism mitochondrial stress immune inflammation cancer therapy drug resistance mutation sequencing").split()
+
+
+def random_sentence(rng, n_words):
+	return " ".join(rng.choice(WORDS) for _ in range(n_words))
+
+
+def generate_synthetic_bibtex(filename, n_entries, seed=0):
+	# Writes a BibTeX library with the kind of fields (and LaTeX accents, nested braces and comments) found in exported reference libraries
+	rng = random.Random(seed)
+	with open(filename, "w", encoding="utf-8") as f:
+		f.write("% Synthetic library generated by benchmark.py\n\n")
+		for i_entry in range(n_entries):
+			f.write(f"@article{{Author{i_entry}_{2000 + i_entry % 25},\n")
+			f.write(f"  title = {{{{{random_sentence(rng, rng.randint(6, 16)).capitalize()} in {{DNA}} repair}}}},\n")
+			f.write("  author = {M{\\\"u}ller, Anna and Garc{\\'i}a, Jos{\\'e} and Smith, John},\n")
+			f.write(f"  journal = \"Journal of {random_sentence(rng, 2).title()}\",\n")
+			f.write(f"  year = {2000 + i_entry % 25},\n")
+			f.write(f"  volume = {{{rng.randint(1, 300)}}},\n")
+			f.write(f"  pages = {{{rng.randint(1, 900)}--{rng.randint(901, 999)}}},\n")
+			f.write(f"  doi = {{10.{rng.randint(1000, 9999)}/synthetic.{i_entry}}},\n")
+			f.write(f"  abstract = {{{random_sentence(rng, rng.randint(120, 250))}.\n  {random_sentence(rng, 40)}.}}\n")
+			f.write("}\n\n")
+			if i_entry % 100 == 0:
+				f.write("Comment between entries, as written by some reference managers.\n\n")
+			if i_entry % 100 == 50:  # Entries that start on the line where the previous one ends
+				f.write(f"@misc{{Inline{i_entry}a,\n  title = {{{random_sentence(rng, 8).capitalize()}}},\n  year = {{2001}}\n}}@misc{{Inline{i_entry}b,\n  title = {{{{Nested}} {random_sentence(rng, 5)}}},\n  year = 2002\n}}")
+				f.write(f" @misc{{Inline{i_entry}c, title = {{{random_sentence(rng, 6)}}}, year = {{2003}}}}@misc{{Inline{i_entry}d, title = {{{random_sentence(rng, 4)}}}, year = 2004}}\n\n")
+
+
+def time_function(func, *args, repeats=3):
+	times = []
+	result = None
+	for _ in range(repeats):
+		time_0 = time.perf_counter()
+		result = func(*args)
+		times.append(time.perf_counter() - time_0)
+	return min(times), result
+
+
+def benchmark_load_bibtex(filename=None, n_entries=5000, repeats=3):
+	# Compares the throughput (MB/s) of the streaming load_bibtex with the original regex-based parser and checks that they agree
+	with tempfile.TemporaryDirectory() as temp_folder:
+		if not filename:
+			filename = os.path.join(temp_folder, "synthetic.bib")
+			generate_synthetic_bibtex(filename, n_entries)
+		size_MB = os.path.getsize(filename) / 1024 ** 2
+		print(f"{filename}: {size_MB:.1f} MB")
+
+		results = {}
+		rows = []
+		for name, func in [("load_bibtex_regex", cv.load_bibtex_regex), ("load_bibtex", cv.load_bibtex)]:
+			seconds, results[name] = time_function(func, filename, repeats=repeats)
+			rows.append([name, round(seconds, 3), round(size_MB / seconds, 2), len(results[name][0])])
+
+	print(cv.tabulate(rows, headers=["Parser", "Seconds", "MB/s", "Entries"]))
+	print("Same result:", results["load_bibtex_regex"] == results["load_bibtex"])
+	return rows
+
+
+def generate_synthetic_bibs(n_entries, duplicate_fraction=0.02, seed=0):
+	# Parsed bib entries with a known set of duplicates: copies with the same DOI, re-typed copies of the title (changed case and punctuation,
+	# a word dropped or a typo) without a DOI, as they turn up in merged reference libraries, and retitled copies with the same authors and year.
+	# Also returns the pairs of different works with almost the same title (a typo apart) by other authors, which must not be grouped.
+	rng = random.Random(seed)
+	# Real titles draw on a large vocabulary with a few very common words, so WORDS is extended with made-up words picked with Zipf weights.
+	# Last names are made up the same way (the most common ones, like Wang or Smith, are about 1% of all authors).
+	syllables = "ba ce di fo gu la me ni po ru sa te vi xo zy an el in on us".split()
+	vocabulary = WORDS + sorted({"".join(rng.choices(syllables, k=rng.randint(2, 5))) for _ in range(20000)})
+	cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+	last_names = sorted({"".join(rng.choices(syllables, k=rng.randint(2, 4))).capitalize() for _ in range(50000)})
+	name_cum_weights = list(itertools.accumulate(1 / (rank + 10) for rank in range(len(last_names))))
+	def random_title():
+		return " ".join(rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(6, 16))).capitalize()
+	def random_authors():
+		names = dict.fromkeys(rng.choices(last_names, cum_weights=name_cum_weights, k=rng.randint(1, 8)))
+		return " and ".join(f"{name}, {rng.choice('ABCDEHJKLMPRSTW')}." for name in names)
+	bibs = {}
+	for i_entry in range(n_entries):
+		bibs[f"Author{i_entry}"] = {"title": random_title(), "author": random_authors(), "year": str(rng.randint(1990, 2025)), "doi": f"10.{rng.randint(1000, 9999)}/synthetic.{i_entry}"}
+	duplicates = []
+	for i_entry in rng.sample(range(n_entries), int(n_entries * duplicate_fraction)):
+		original = bibs[f"Author{i_entry}"]
+		words = original["title"].split()
+		if rng.random() < 0.5:
+			duplicate = dict(original, title=original["title"].upper() + ".")
+		else:
+			i_word = rng.randrange(len(words))
+			if rng.random() < 0.5 and len(words) > 10:
+				del words[i_word]
+			else:
+				words[i_word] = words[i_word][:-1] + "x"
+			duplicate = {"title": "{" + " ".join(words) + "}", "author": original["author"]}
+		bibs[f"Author{i_entry}_duplicate"] = duplicate
+		duplicates.append({f"Author{i_entry}", f"Author{i_entry}_duplicate"})
+	for i_entry in rng.sample(range(n_entries), int(n_entries * duplicate_fraction)):
+		original = bibs[f"Author{i_entry}"]
+		if original["author"].count(" and ") >= cv.DUPLICATE_MIN_AUTHORS - 1:
+			bibs[f"Author{i_entry}_retitled"] = {"title": random_title(), "author": original["author"], "year": original["year"]}
+			duplicates.append({f"Author{i_entry}", f"Author{i_entry}_retitled"})
+	others = []
+	for i_entry in rng.sample(range(n_entries), int(n_entries * duplicate_fraction)):
+		original = bibs[f"Author{i_entry}"]
+		words = original["title"].split()
+		i_word = rng.randrange(len(words))
+		words[i_word] = words[i_word][:-1] + "x"
+		bibs[f"Author{i_entry}_other"] = {"title": " ".join(words), "author": random_authors(), "year": str(rng.randint(1990, 2025))}
+		others.append({f"Author{i_entry}", f"Author{i_entry}_other"})
+	return bibs, duplicates, others
+
+
+def benchmark_duplicates(n_entries=200000, repeats=1):
+	# Time of find_duplicate_bibs on a synthetic library, how many of the planted duplicates it found,
+	# and how many of the similar titles by other authors it wrongly grouped
+	bibs, duplicates, others = generate_synthetic_bibs(n_entries)
+	seconds, clusters = time_function(cv.find_duplicate_bibs, bibs, repeats=repeats)
+	cluster_of_bib = {bib_name: i_cluster for i_cluster, cluster in enumerate(clusters) for bib_name in cluster["bib_names"]}
+	found = sum(len({cluster_of_bib.get(bib_name, bib_name) for bib_name in duplicate}) == 1 for duplicate in duplicates)
+	wrongly_grouped = sum(len({cluster_of_bib.get(bib_name, bib_name) for bib_name in other}) == 1 for other in others)
+	rows = [[len(bibs), round(seconds, 2), len(clusters), f"{found} / {len(duplicates)}", f"{wrongly_grouped} / {len(others)}"]]
+	print(cv.tabulate(rows, headers=["Entries", "Seconds", "Clusters", "Planted duplicates found", "Similar titles grouped"]))
+	return rows
+
+
+# The commands both extractors understand, and other natbib, biblatex and apacite citation commands (and \citetext around one)
+PLAIN_CITE_COMMANDS = ("cite", "citep", "citet")
+CITE_COMMAND_VARIANTS = ("citeyearpar", "Citep*", "Citet", "citealp*", "citeauthor", "Citeauthor*", "citenum", "citetalias", "citeA", "citeNP",
+	"parencite", "Textcite", "footcitetext", "cites", "citetext")
+
+def generate_synthetic_latex(filename, n_paragraphs, citations_per_paragraph=0.3, seed=0, commands=PLAIN_CITE_COMMANDS):
+	# Writes a long chapter with few citations, in the given commands. Returns the cited keys in order.
+	rng = random.Random(seed)
+	cited_keys = []
+	with open(filename, "w", encoding="utf-8") as f:
+		if commands != PLAIN_CITE_COMMANDS:
+			f.write("\\citestyle{aa}\n\n")
+		for i_paragraph in range(n_paragraphs):
+			sentences = [random_sentence(rng, rng.randint(8, 25)).capitalize() for _ in range(rng.randint(3, 8))]
+			if rng.random() < citations_per_paragraph:
+				keys = [f"Author{rng.randrange(5000)}" for _ in range(rng.randint(1, 3))]
+				cited_keys += keys
+				command = rng.choice(commands)
+				citation = f"\\citetext{{\\citealp{{{', '.join(keys)}}}; priv.\\ comm.}}" if command == "citetext" else f"\\{command}{{{', '.join(keys)}}}"
+				sentences[rng.randrange(len(sentences))] += " " + citation
+			f.write(". ".join(sentences) + ".\n\n")
+	return cited_keys
+
+
+def benchmark_latex(filename=None, n_paragraphs=5000, repeats=3):
+	# Compares the single-pass citation extractor with the original regex-based one and checks that they agree
+	with tempfile.TemporaryDirectory() as temp_folder:
+		if not filename:
+			filename = os.path.join(temp_folder, "synthetic.tex")
+			generate_synthetic_latex(filename, n_paragraphs)
+		size_MB = os.path.getsize(filename) / 1024 ** 2
+		txt = cv.load_file(filename)
+		# The original extractor only understands the plain commands, so the others are checked against the keys that were written
+		variants_filename = os.path.join(temp_folder, "variants.tex")
+		cited_keys = generate_synthetic_latex(variants_filename, 1000, citations_per_paragraph=0.5, commands=CITE_COMMAND_VARIANTS)
+		found_keys = [citation_statement.citation for citation_statement in cv.iter_latex_citations(variants_filename)]
+	print(f"{filename}: {size_MB:.1f} MB")
+
+	results = {}
+	rows = []
+	for name, func in [("latex2citations_statements_regex", cv.latex2citations_statements_regex), ("latex2citations_statements", cv.latex2citations_statements)]:
+		seconds, results[name] = time_function(func, txt, repeats=repeats)
+		rows.append([name, round(seconds, 3), round(size_MB / seconds, 2), len(results[name][0])])
+
+	print(cv.tabulate(rows, headers=["Extractor", "Seconds", "MB/s", "Citations"]))
+	print("Same result:", results["latex2citations_statements_regex"] == results["latex2citations_statements"])
+	print(f"Keys of other citation commands found: {found_keys == cited_keys} ({len(found_keys)} / {len(cited_keys)})")
+	return rows
+
+
+def load_statement_abstract_pairs(filename, n_pairs):
+	# (statements, abstracts) from a statement_vs_abstract_match_scores.csv of an earlier run, skipping rows without an abstract
+	statements, abstracts = [], []
+	with open(filename, "r", encoding="utf-8", newline="") as f:
+		for row in csv.DictReader(f, delimiter="\t"):
+			if row.get("Abstract") and len(statements) < n_pairs:
+				statements.append(row["Statement"])
+				abstracts.append(row["Abstract"])
+	return statements, abstracts
+
+
+def get_ranks(values):
+	import numpy as np
+	ranks = np.empty(len(values))
+	ranks[np.argsort(values)] = np.arange(len(values))
+	return ranks
+
+
+def benchmark_embeddings(model_name, backends, max_seq_length=None, n_pairs=500, filename=None):
+	# Throughput (statement-abstract pairs per second, encoding every text once) of each inference backend, and how close its scores are
+	# to those of the current path: the full-precision SentenceTransformer.encode without truncation
+	import numpy as np
+	if filename:
+		statements, abstracts = load_statement_abstract_pairs(filename, n_pairs)
+	else:
+		rng = random.Random(0)
+		statements = [random_sentence(rng, rng.randint(10, 30)) for _ in range(n_pairs)]
+		abstracts = [random_sentence(rng, rng.randint(150, 300)) for _ in range(n_pairs)]
+	texts = list(dict.fromkeys(statements + abstracts))
+	text_index = {text: i_text for i_text, text in enumerate(texts)}
+	statement_rows = [text_index[statement] for statement in statements]
+	abstract_rows = [text_index[abstract] for abstract in abstracts]
+	print(f"{model_name}: {len(statements)} pairs, {len(texts)} unique texts")
+
+	configurations = [("torch", None)] + [(backend, max_seq_length) for backend in backends if (backend, max_seq_length) != ("torch", None)]
+	rows = []
+	reference_scores = None
+	for backend, seq_length in configurations:
+		time_0 = time.perf_counter()
+		model = cv.get_sentence_transformer(model_name, backend, seq_length)
+		load_seconds = time.perf_counter() - time_0
+		model.encode(texts[:cv.EMBEDDING_BATCH_SIZE], batch_size=cv.EMBEDDING_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True)  # Warm-up
+		seconds, embeddings = time_function(lambda: model.encode(texts, batch_size=cv.EMBEDDING_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True), repeats=1)
+		scores = np.einsum("ij,ij->i", embeddings[statement_rows], embeddings[abstract_rows])
+		if reference_scores is None:
+			reference_scores = scores
+		differences = np.abs(scores - reference_scores)
+		rows.append([backend, seq_length or model.max_seq_length, round(load_seconds, 1), round(len(statements) / seconds, 1),
+			round(float(differences.mean()), 4), round(float(differences.max()), 4),
+			round(float(np.corrcoef(scores, reference_scores)[0, 1]), 4), round(float(np.corrcoef(get_ranks(scores), get_ranks(reference_scores))[0, 1]), 4)])
+		cv.sentence_transformer_models.clear()  # Only one model in memory at a time
+
+	print(cv.tabulate(rows, headers=["Backend", "Max tokens", "Load (s)", "Pairs/s", "Mean |diff|", "Max |diff|", "Pearson r", "Spearman rho"]))
+	return rows
+
+
+def generate_clustered_embeddings(n_rows, n_dimensions=768, n_topics=2000, noise=0.9, seed=0):
+	# L2-normalised random vectors around n_topics random centres, like the embeddings of abstracts on many topics
+	import numpy as np
+	rng = np.random.default_rng(seed)
+	centres = rng.standard_normal((n_topics, n_dimensions)).astype(np.float32)
+	embeddings = np.empty((n_rows, n_dimensions), dtype=np.float32)
+	for start in range(0, n_rows, 8192):
+		n_chunk = min(8192, n_rows - start)
+		embeddings[start:start + n_chunk] = centres[rng.integers(0, n_topics, n_chunk)] + noise * rng.standard_normal((n_chunk, n_dimensions)).astype(np.float32)
+	return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def benchmark_vector_index(n_abstracts=100000, n_queries=1000, k=cv.ALTERNATIVES_TOP_K):
+	# Build and query time of the exact and approximate AbstractIndex on synthetic embeddings,
+	# and which fraction of the exact top k the approximate index finds (recall)
+	import numpy as np
+	embeddings = generate_clustered_embeddings(n_abstracts + n_queries)
+	queries, embeddings = embeddings[:n_queries], embeddings[n_queries:]
+	bib_names = [f"Author{i_row}" for i_row in range(n_abstracts)]
+	rows, results = [], {}
+	for exact in (True, False):
+		time_0 = time.perf_counter()
+		index = cv.AbstractIndex(bib_names, embeddings, exact=exact)
+		build_seconds = time.perf_counter() - time_0
+		time_0 = time.perf_counter()
+		results[exact], _ = index.search(queries, k)
+		seconds = time.perf_counter() - time_0
+		recall = np.mean([len(set(found).intersection(true)) / k for found, true in zip(results[exact], results[True])])
+		rows.append(["exact" if exact else f"clustered ({len(index.centroids)} clusters, {cv.VECTOR_INDEX_N_PROBE} probed)", n_abstracts,
+			round(build_seconds, 2), round(seconds / n_queries * 1000, 2), round(float(recall), 3)])
+	print(cv.tabulate(rows, headers=["Index", "Abstracts", "Build (s)", "Query (ms)", f"Recall@{k}"]))
+	return rows
+
+
+def generate_synthetic_corpus(folder, n_entries, n_paragraphs, seed=0):
+	# Writes library.bib and manuscript.tex to folder, and returns the works that the mock APIs know about (one per bib entry).
+	# Like real libraries, some entries have no DOI (found by a Crossref title search), and not every work is in PubMed:
+	# some abstracts are only in the Crossref record, and some only on the DOI landing page.
+	rng = random.Random(seed)
+	works = []
+	for i_work in range(n_entries):
+		kind = rng.choices(["pubmed", "crossref", "landing page"], weights=[80, 15, 5])[0]
+		works.append({
+			"key": f"Work{i_work}_{2000 + i_work % 25}",
+			"doi": f"10.{rng.randint(1000, 9999)}/bench.{i_work}",
+			"pmid": str(30000000 + i_work) if kind == "pubmed" else "",
+			"title": f"{random_sentence(rng, rng.randint(8, 14)).capitalize()} {i_work}",
+			"abstract": ". ".join(random_sentence(rng, rng.randint(10, 30)).capitalize() for _ in range(rng.randint(4, 10))) + ".",
+			"abstract_source": kind,
+			"has_doi_in_bib": rng.random() < 0.7,
+			"reference_count": rng.randint(0, 120),
+			"citation_count": rng.randint(0, 2000),
+		})
+	with open(os.path.join(folder, "library.bib"), "w", encoding="utf-8") as f:
+		for work in works:
+			f.write(f"@article{{{work['key']},\n")
+			f.write(f"  title = {{{work['title']}}},\n")
+			f.write("  author = {Smith, John and Doe, Jane},\n")
+			f.write(f"  journal = {{Journal of {random_sentence(rng, 2).title()}}},\n")
+			f.write(f"  year = {{{work['key'][-4:]}}},\n")
+			if work["has_doi_in_bib"]:
+				f.write(f"  doi = {{{work['doi']}}},\n")
+			f.write("}\n\n")
+	with open(os.path.join(folder, "manuscript.tex"), "w", encoding="utf-8") as f:
+		f.write("\\documentclass{article}\n\\begin{document}\n")
+		for i_paragraph in range(n_paragraphs):
+			sentences = [random_sentence(rng, rng.randint(8, 25)).capitalize() for _ in range(rng.randint(2, 6))]
+			for i_sentence in rng.sample(range(len(sentences)), min(len(sentences), rng.randint(1, 3))):
+				keys = ",".join(rng.choice(works)["key"] for _ in range(rng.randint(1, 3)))
+				sentences[i_sentence] += f" \\{rng.choice(['cite', 'citep', 'citet'])}{{{keys}}}"
+			f.write(". ".join(sentences) + ".\n\n")
+		f.write("\\end{document}\n")
+	return works
+
+
+MOCK_API_HOSTS = ("api.crossref.org", "eutils.ncbi.nlm.nih.gov", "opencitations.net", "dx.doi.org")
+
+class MockAPIServer:
+	# A local HTTP server that answers the Crossref (/works/<DOI> and title search), E-utilities (esearch, esummary, efetch),
+	# OpenCitations (citation-count) and DOI landing page requests of citationvalidator from a list of works.
+	# Every response waits latency seconds (on average, uniformly 0.5-1.5x), and error_rate of the requests get a 503 or a 429 with Retry-After.
+	def __init__(self, works, latency=0.0, error_rate=0.0, seed=0):
+		self.works_by_DOI = {work["doi"].lower(): work for work in works}
+		self.works_by_PMID = {work["pmid"]: work for work in works if work["pmid"]}
+		self.works_by_title = {cv.normalize_title(work["title"]): work for work in works}
+		self.latency = latency
+		self.error_rate = error_rate
+		self.rng = random.Random(seed)
+		self.lock = threading.Lock()
+		self.request_counts = {}
+		self.error_counts = {}
+		server = self
+		
+		class Handler(http.server.BaseHTTPRequestHandler):
+			protocol_version = "HTTP/1.1"  # Keep-alive, like the real APIs
+			
+			def do_GET(self):
+				server.handle(self)
+			
+			def log_message(self, format, *args):
+				pass
+		
+		self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+		self.httpd.daemon_threads = True
+		self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+		self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+	
+	def __enter__(self):
+		self.thread.start()
+		return self
+	
+	def __exit__(self, *exc_info):
+		self.httpd.shutdown()
+		self.httpd.server_close()
+	
+	def handle(self, request):
+		parts = urlsplit(request.path)
+		query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+		endpoint = self.get_endpoint(parts.path)
+		with self.lock:
+			self.request_counts[endpoint] = self.request_counts.get(endpoint, 0) + 1
+			status = self.rng.choice([429, 503]) if self.rng.random() < self.error_rate else 200
+			delay = self.latency * self.rng.uniform(0.5, 1.5)
+		time.sleep(delay)
+		if status != 200:
+			with self.lock:
+				self.error_counts[endpoint] = self.error_counts.get(endpoint, 0) + 1
+			self.respond(request, status, "text/plain", b"Simulated error", {"Retry-After": "1"} if status == 429 else {})
+			return
+		try:
+			status, content_type, body, headers = getattr(self, "answer_" + endpoint.replace("-", "_").replace(" ", "_"))(parts.path, query)
+		except KeyError:
+			status, content_type, body, headers = 404, "text/plain", "Resource not found.", {}
+		self.respond(request, status, content_type, body.encode("utf-8"), headers)
+	
+	def respond(self, request, status, content_type, body, headers):
+		request.send_response(status)
+		request.send_header("Content-Type", content_type + "; charset=utf-8")
+		request.send_header("Content-Length", str(len(body)))
+		for key, value in headers.items():
+			request.send_header(key, value)
+		request.end_headers()
+		request.wfile.write(body)
+	
+	@staticmethod
+	def get_endpoint(path):
+		if path == "/works":
+			return "crossref search"
+		if path.startswith("/works/"):
+			return "crossref work"
+		if path.startswith("/entrez/eutils/"):
+			return path.rsplit("/", 1)[-1].split(".")[0]  # esearch, esummary or efetch
+		if path.startswith("/index/coci/api/v1/citation-count/"):
+			return "citation-count"
+		return "landing page"
+	
+	@staticmethod
+	def get_crossref_work(work):
+		crossref_work = {"DOI": work["doi"], "title": [work["title"]], "reference-count": work["reference_count"], "is-referenced-by-count": work["citation_count"]}
+		if work["abstract_source"] == "crossref":
+			crossref_work["abstract"] = f"<jats:title>Abstract</jats:title><jats:p>{escape(work['abstract'])}</jats:p>"
+		return crossref_work
+	
+	def answer_crossref_work(self, path, query):
+		work = self.works_by_DOI[unquote(path[len("/works/"):]).lower()]
+		return 200, "application/json", json.dumps({"status": "ok", "message": self.get_crossref_work(work)}), {}
+	
+	def answer_crossref_search(self, path, query):
+		work = self.works_by_title.get(cv.normalize_title(query.get("query.title", "")))
+		items = [self.get_crossref_work(work)] if work else []
+		return 200, "application/json", json.dumps({"status": "ok", "message": {"total-results": len(items), "items": items}}), {"x-api-pool": "polite"}
+	
+	def answer_esearch(self, path, query):
+		term = query.get("term", "")
+		if query.get("retmode") == "json":  # Batch of '"<DOI>"[doi] OR ...'
+			DOIs = [part.strip().strip('"') for part in term.replace("[doi]", "").split(" OR ")]
+			ids = [self.works_by_DOI[DOI.lower()]["pmid"] for DOI in DOIs if DOI.lower() in self.works_by_DOI and self.works_by_DOI[DOI.lower()]["pmid"]]
+			return 200, "application/json", json.dumps({"esearchresult": {"count": str(len(ids)), "idlist": ids}}), {}
+		if term.endswith("[Title:~0]"):
+			work = self.works_by_title.get(cv.normalize_title(term[:-len("[Title:~0]")].strip('"')))
+		else:
+			work = self.works_by_DOI.get(term.lower())
+		if not work or not work["pmid"]:
+			return 200, "text/xml", "<eSearchResult><Count>0</Count><IdList></IdList><WarningList><OutputMessage>No items found.</OutputMessage></WarningList></eSearchResult>", {}
+		return 200, "text/xml", f"<eSearchResult><Count>1</Count><IdList><Id>{work['pmid']}</Id></IdList></eSearchResult>", {}
+	
+	def answer_esummary(self, path, query):
+		PMIDs = [PMID for PMID in query.get("id", "").split(",") if PMID in self.works_by_PMID]
+		result = {"uids": PMIDs}
+		for PMID in PMIDs:
+			result[PMID] = {"uid": PMID, "articleids": [{"idtype": "pubmed", "value": PMID}, {"idtype": "doi", "value": self.works_by_PMID[PMID]["doi"]}]}
+		return 200, "application/json", json.dumps({"result": result}), {}
+	
+	def answer_efetch(self, path, query):
+		articles = []
+		for PMID in query.get("id", "").split(","):
+			work = self.works_by_PMID.get(PMID)
+			if work:
+				articles.append(f"<PubmedArticle><MedlineCitation><PMID>{PMID}</PMID><Article><ArticleTitle>{escape(work['title'])}</ArticleTitle>"
+					f"<Abstract><AbstractText>{escape(work['abstract'])}</AbstractText></Abstract></Article></MedlineCitation>"
+					f"<PubmedData><ArticleIdList><ArticleId IdType=\"doi\">{escape(work['doi'])}</ArticleId></ArticleIdList></PubmedData></PubmedArticle>")
+		return 200, "text/xml", "<?xml version=\"1.0\"?><PubmedArticleSet>" + "".join(articles) + "</PubmedArticleSet>", {}
+	
+	def answer_citation_count(self, path, query):
+		work = self.works_by_DOI.get(unquote(path.rsplit("/citation-count/", 1)[1]).lower())
+		return 200, "application/json", json.dumps([{"count": str(work["citation_count"])}] if work else []), {}
+	
+	def answer_landing_page(self, path, query):
+		work = self.works_by_DOI[unquote(path.lstrip("/")).lower()]
+		abstract = f"<p>{escape(work['abstract'])}</p>" if work["abstract_source"] == "landing page" else ""
+		return 200, "text/html", f"<html><body><h1>{escape(work['title'])}</h1><section class=\"abstract\">{abstract}</section></body></html>", {}
+
+
+# Lookups that keep their results for the rest of the run (see coalesced)
+KEPT_LOOKUPS = ("get_DOI_by_title_author_from_crossref", "get_PMID_from_DOI", "get_PMID_by_title", "get_citation_count", "get_abstract_by_DOI")
+
+def reset_lookups():
+	# Forgets the works and lookup results kept in memory, so that the next stage fetches them again
+	cv.crossref_works.clear()
+	for name in KEPT_LOOKUPS:
+		getattr(cv, name).cache_clear()
+
+
+def benchmark_pipeline(n_entries=500, n_paragraphs=300, latency=0.05, error_rate=0.01, real_budgets=False, embeddings=True, save=None, baseline=None, tolerance=1.25, verbose=False):
+	# Times every stage of a run, from load_bibtex to the scorers, on a synthetic library and manuscript, with the remote APIs replaced by a
+	# MockAPIServer. Runs in a temporary folder, so the URL, embedding and enrichment caches start empty.
+	# With baseline (a file written with save), stages that got more than tolerance times slower are reported, and the exit status is 1.
+	rows = []
+	timings = {}
+	
+	def run_stage(name, func, n_items=None):
+		# n_items defaults to the length of the result
+		time_0 = time.perf_counter()
+		with contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO()):
+			result = func()
+		seconds = time.perf_counter() - time_0
+		timings[name] = seconds
+		n_items = len(result) if n_items is None else n_items
+		rows.append([name, n_items, round(seconds, 3), round(n_items / seconds, 1) if seconds else ""])
+		return result
+	
+	# Settings and state of citationvalidator that are changed here, and restored at the end
+	old_folder = os.getcwd()
+	old_host_limits, old_default_host_limit, old_host_limiters = cv.HOST_LIMITS, cv.DEFAULT_HOST_LIMIT, dict(cv.host_limiters)
+	old_url_cache = cv.url_cache
+	cv.metrics.reset()
+	reset_lookups()
+	with tempfile.TemporaryDirectory() as folder:
+		works = generate_synthetic_corpus(folder, n_entries, n_paragraphs)
+		os.chdir(folder)
+		try:
+			with MockAPIServer(works, latency, error_rate) as server:
+				cv.HTTP_HOST_OVERRIDES.update({host: server.url for host in MOCK_API_HOSTS})
+				if not real_budgets:  # Only measure citationvalidator and the mock latency, not the APIs' request budgets
+					cv.HOST_LIMITS = {host: (cv.FETCH_MAX_WORKERS, 1000) for host in cv.HOST_LIMITS}
+					cv.DEFAULT_HOST_LIMIT = (cv.FETCH_MAX_WORKERS, 1000)
+				cv.host_limiters.clear()  # They are created again with the limits above
+				cv.set_url_cache(cv.SQLiteCacheStore("cached_urls.sqlite"))
+				
+				bibs, bib_types = run_stage("load_bibtex", lambda: cv.load_bibtex("library.bib"), n_entries)
+				citation_statements = run_stage("latex2citations_statements", lambda: list(cv.iter_latex_citations("manuscript.tex")))
+				bibs_in_citations = {citation_statement.citation: bibs[citation_statement.citation] for citation_statement in citation_statements}
+				n_cited = len(bibs_in_citations)
+				unenriched_bibs = {bib_name: dict(bib_entry) for bib_name, bib_entry in bibs_in_citations.items()}  # add_prop_to_bib_entries changes the entries
+				DOIs = run_stage("get_DOIs", lambda: cv.get_DOIs(bibs_in_citations, allow_copying_existing=True), n_cited)
+				bibs_in_citations = cv.add_prop_to_bib_entries(bibs_in_citations, "doi", DOIs)
+				PMIDs = run_stage("get_PMIDs", lambda: cv.get_PMIDs(bibs_in_citations, allow_copying_existing=True), n_cited)
+				bibs_in_citations = cv.add_prop_to_bib_entries(bibs_in_citations, "pmid", PMIDs)
+				reference_counts, citation_counts = run_stage("get_reference_and_citation_counts", lambda: cv.get_reference_and_citation_counts(bibs_in_citations, allow_copying_existing=True), n_cited)
+				abstracts = run_stage("get_abstracts", lambda: cv.get_abstracts(bibs_in_citations, allow_copying_existing=True), n_cited)
+				abstracts = {bib_name: abstract if not abstract.startswith("ERROR:") else "" for bib_name, abstract in abstracts.items()}
+				# The same lookups with the stages overlapping, again from an empty URL cache and without the results kept by this process
+				cv.url_cache.close()
+				cv.set_url_cache(cv.SQLiteCacheStore("cached_urls_pipeline.sqlite"))
+				reset_lookups()
+				run_stage("run_enrichment_pipeline", lambda: cv.run_enrichment_pipeline(unenriched_bibs), n_cited)
+				
+				citations_and_statements = [(citation_statement.citation, citation_statement.statement) for citation_statement in citation_statements]
+				n_pairs = len(citations_and_statements)
+				scorers = [("get_simple_overlap_scores", lambda: cv.get_simple_overlap_scores(citations_and_statements, abstracts)),
+					("get_TF_IDF_scores", lambda: cv.get_TF_IDF_scores(citations_and_statements, abstracts))]
+				if embeddings:
+					scorers += [("get_BERT_scores", lambda: cv.get_BERT_scores(citations_and_statements, abstracts)),
+						("get_BioBERT_scores", lambda: cv.get_BioBERT_scores(citations_and_statements, abstracts)),
+						("get_sentence_score_columns", lambda: cv.get_sentence_score_columns(citations_and_statements, abstracts)),
+						("get_alternative_citations", lambda: cv.get_alternative_citations(citations_and_statements, abstracts))]
+				for name, scorer in scorers:
+					run_stage(name, scorer, n_pairs)
+				
+				found = {"DOIs": sum(DOIs[work["key"]] == work["doi"] for work in works if work["key"] in DOIs),
+					"PMIDs": sum(PMIDs[work["key"]] == work["pmid"] for work in works if work["key"] in PMIDs and work["pmid"]),
+					"abstracts": sum(bool(abstracts[work["key"]]) for work in works if work["key"] in abstracts)}
+				n_with_PMID = sum(bool(work["pmid"]) for work in works if work["key"] in PMIDs)
+		finally:
+			os.chdir(old_folder)
+			for host in MOCK_API_HOSTS:
+				cv.HTTP_HOST_OVERRIDES.pop(host, None)
+			cv.HOST_LIMITS, cv.DEFAULT_HOST_LIMIT = old_host_limits, old_default_host_limit
+			cv.host_limiters.clear()
+			cv.host_limiters.update(old_host_limiters)
+			if cv.url_cache is not old_url_cache:  # Closed before the temporary folder is removed
+				cv.url_cache.close()
+			cv.set_url_cache(old_url_cache)
+			reset_lookups()
+	
+	headers = ["Stage", "Items", "Seconds", "Items/s"]
+	regressions = []
+	if baseline:
+		with open(baseline, "r", encoding="utf-8") as f:
+			baseline_timings = json.load(f)["timings"]
+		headers.append("vs. baseline")
+		for row in rows:
+			baseline_seconds = baseline_timings.get(row[0])
+			row.append(f"{timings[row[0]] / baseline_seconds - 1:+.0%}" if baseline_seconds else "")
+			if baseline_seconds and timings[row[0]] > tolerance * baseline_seconds:
+				regressions.append(row[0])
+	print(cv.tabulate(rows, headers=headers))
+	print(f"\nFound {found['DOIs']} / {n_cited} DOIs, {found['PMIDs']} / {n_with_PMID} PMIDs and {found['abstracts']} / {n_cited} abstracts")
+	print("Mock API requests:", ", ".join(f"{endpoint}: {count} ({server.error_counts.get(endpoint, 0)} errors)" for endpoint, count in sorted(server.request_counts.items())))
+	if save:
+		with open(save, "w", encoding="utf-8") as f:
+			json.dump({"settings": {"entries": n_entries, "paragraphs": n_paragraphs, "latency": latency, "error_rate": error_rate, "real_budgets": real_budgets},
+				"timings": timings, "metrics": {key: value for key, value in cv.metrics.summary().items() if key != "spans"}}, f, indent=2)
+	if regressions:
+		print(f"Slower than {tolerance}x the baseline: {', '.join(regressions)}")
+	return rows, regressions
+
+
+HEAVY_MODULES = ("numpy", "pandas", "sklearn", "scipy", "torch", "sentence_transformers", "matplotlib", "dynamic_multiprocessing")
+
+IMPORT_TIMING_CODE = """
+import sys, time
+time_0 = time.perf_counter()
+import citationvalidator
+seconds = time.perf_counter() - time_0
+print(seconds, ",".join(module for module in {modules} if module in sys.modules))
+"""
+
+
+def benchmark_startup(repeats=10):
+	# Times "import citationvalidator" in fresh interpreters (the start of the interpreter itself is excluded)
+	# and lists the heavy dependencies that the import pulled in (there should be none)
+	code = IMPORT_TIMING_CODE.format(modules=HEAVY_MODULES)
+	folder = os.path.dirname(os.path.abspath(__file__))
+	times = []
+	for _ in range(repeats):
+		output = subprocess.run([sys.executable, "-c", code], cwd=folder, capture_output=True, text=True, check=True).stdout.split()
+		times.append(float(output[0]))
+		heavy_modules = output[1] if len(output) > 1 else ""
+	rows = [["import citationvalidator", round(min(times) * 1000, 1), round(statistics.median(times) * 1000, 1), heavy_modules or "-"]]
+	print(cv.tabulate(rows, headers=["", "Min (ms)", "Median (ms)", "Heavy modules imported"]))
+	return rows
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="citationvalidator benchmarks")
+	subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+	bibtex_parser = subparsers.add_parser("bibtex", help="BibTeX parsing throughput")
+	bibtex_parser.add_argument("--file", help="BibTeX file to parse (default: a synthetic library)")
+	bibtex_parser.add_argument("--entries", type=int, default=5000, help="Number of entries in the synthetic library")
+	bibtex_parser.add_argument("--repeats", type=int, default=3)
+
+	startup_parser = subparsers.add_parser("startup", help="Import time of citationvalidator")
+	startup_parser.add_argument("--repeats", type=int, default=10)
+
+	duplicates_parser = subparsers.add_parser("duplicates", help="Duplicate detection on a large synthetic library")
+	duplicates_parser.add_argument("--entries", type=int, default=200000)
+	duplicates_parser.add_argument("--repeats", type=int, default=1)
+
+	latex_parser = subparsers.add_parser("latex", help="Citation extraction from LaTeX")
+	latex_parser.add_argument("--file", help="LaTeX file to read (default: a synthetic chapter)")
+	latex_parser.add_argument("--paragraphs", type=int, default=5000, help="Number of paragraphs in the synthetic chapter")
+	latex_parser.add_argument("--repeats", type=int, default=3)
+
+	embeddings_parser = subparsers.add_parser("embeddings", help="Throughput and score agreement of the embedding inference backends")
+	embeddings_parser.add_argument("--model", default="biobert", help="bert, biobert or a sentence-transformers model name")
+	embeddings_parser.add_argument("--backends", nargs="+", choices=cv.EMBEDDING_BACKENDS, default=list(cv.EMBEDDING_BACKENDS))
+	embeddings_parser.add_argument("--max-seq-length", type=int, help="Truncate texts to this many tokens (the first row always uses the model's own limit)")
+	embeddings_parser.add_argument("--pairs", type=int, default=500)
+	embeddings_parser.add_argument("--file", help="statement_vs_abstract_match_scores.csv to take the pairs from (default: synthetic texts)")
+
+	vectors_parser = subparsers.add_parser("vectors", help="Exact and approximate search of the library's abstract embeddings")
+	vectors_parser.add_argument("--abstracts", type=int, default=100000)
+	vectors_parser.add_argument("--queries", type=int, default=1000)
+
+	pipeline_parser = subparsers.add_parser("pipeline", help="Time of every stage of a run against a local mock of the remote APIs")
+	pipeline_parser.add_argument("--entries", type=int, default=500, help="Number of entries in the synthetic library")
+	pipeline_parser.add_argument("--paragraphs", type=int, default=300, help="Number of paragraphs in the synthetic manuscript")
+	pipeline_parser.add_argument("--latency", type=float, default=0.05, help="Mean seconds per mock API response")
+	pipeline_parser.add_argument("--error-rate", type=float, default=0.01, help="Fraction of mock API requests that fail with 429 or 503")
+	pipeline_parser.add_argument("--real-budgets", action="store_true", help="Keep the per-host request budgets of HOST_LIMITS")
+	pipeline_parser.add_argument("--no-embeddings", action="store_true", help="Skip the BERT/BioBERT scorers")
+	pipeline_parser.add_argument("--save", help="Write the timings to this JSON file")
+	pipeline_parser.add_argument("--baseline", help="Compare with the timings in this JSON file (exit status 1 if a stage got slower)")
+	pipeline_parser.add_argument("--tolerance", type=float, default=1.25, help="Slowdown against the baseline that counts as a regression")
+	pipeline_parser.add_argument("--verbose", action="store_true", help="Show the output of the stages")
+
+	args = parser.parse_args()
+	if args.benchmark == "bibtex":
+		benchmark_load_bibtex(args.file, args.entries, args.repeats)
+	elif args.benchmark == "startup":
+		benchmark_startup(args.repeats)
+	elif args.benchmark == "duplicates":
+		benchmark_duplicates(args.entries, args.repeats)
+	elif args.benchmark == "latex":
+		benchmark_latex(args.file, args.paragraphs, args.repeats)
+	elif args.benchmark == "embeddings":
+		model_name = {"bert": cv.BERT_MODEL_NAME, "biobert": cv.BIOBERT_MODEL_NAME}.get(args.model, args.model)
+		benchmark_embeddings(model_name, args.backends, args.max_seq_length, args.pairs, args.file)
+	elif args.benchmark == "vectors":
+		benchmark_vector_index(args.abstracts, args.queries)
+	elif args.benchmark == "pipeline":
+		embeddings = not args.no_embeddings and importlib.util.find_spec("sentence_transformers") is not None
+		if not args.no_embeddings and not embeddings:
+			print("sentence_transformers is not installed: skipping the BERT/BioBERT scorers")
+		rows, regressions = benchmark_pipeline(args.entries, args.paragraphs, args.latency, args.error_rate, args.real_budgets, embeddings,
+			args.save, args.baseline, args.tolerance, args.verbose)
+		sys.exit(1 if regressions else 0)
@@ -1,33 +1,215 @@
+import argparse
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import gzip
 import hashlib
+import http.client
+import io
+import itertools
+import math
 import os
+import pickle
+import random
+import sqlite3
+import ssl
 import statistics
 import sys
+import threading
 import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 from pprint import pprint
-import crossref_commons.retrieval
 import re
 from tabulate import tabulate
 from tqdm import tqdm as original_tqdm
-from dynamic_multiprocessing import dynamic_multiprocessing
-from urllib.request import urlopen
+from urllib.request import getproxies, proxy_bypass
 import urllib.error
-from urllib.parse import quote, urlencode
-import pandas as pd
+from urllib.parse import quote, urlencode, urljoin, urlsplit
+from html import unescape
 import json
 import csv
 from difflib import SequenceMatcher
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sentence_transformers import SentenceTransformer, util
+from xml.etree import ElementTree
 # from scholarly import scholarly
-import matplotlib
-matplotlib.use("Qt5Agg")
-from matplotlib import pyplot as plt
+
+# numpy, scikit-learn, sentence-transformers (torch), pandas, matplotlib and dynamic_multiprocessing are imported by the functions that use them,
+# so that loading BibTeX/LaTeX files and fetching metadata don't pay for them (importing them all takes seconds, and matplotlib needs a display).
+
+PLOT_BACKEND = None  # None: Qt5Agg when there is a display, otherwise Agg (the figures are only saved to file)
+
+def has_display():
+	return sys.platform in ("win32", "darwin") or bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+def get_pyplot():
+	import matplotlib
+	backend = PLOT_BACKEND or os.environ.get("MPLBACKEND") or ("Qt5Agg" if has_display() else "Agg")
+	try:
+		matplotlib.use(backend)
+	except ImportError:  # E.g. PyQt5 isn't installed
+		matplotlib.use("Agg")
+	from matplotlib import pyplot as plt
+	return plt
 
 def tqdm(*args, **kwargs):
 	kwargs.setdefault("ncols", 100)
 	kwargs.setdefault("file", sys.stdout)
 	return original_tqdm(*args, **kwargs)
 
+
+METRICS_SUMMARY_PATH = "run_metrics.json"  # Written at the end of a run (None to skip)
+METRICS_PROMETHEUS_PATH = "run_metrics.prom"  # The same metrics in the Prometheus text format, e.g. for node_exporter's textfile collector (None to skip)
+METRICS_PREFIX = "citationvalidator_"  # Of the Prometheus metric names
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # Upper bounds (seconds) of the request latency histograms
+METRICS_MAX_SPANS = 10000  # Timing spans kept for the summary (the per-stage totals count all of them)
+
+class Metrics:
+	# Counters, histograms and timing spans of a run. Metrics have a name and labels, like in Prometheus, e.g.
+	# increment("http_requests_total", host="api.crossref.org", status="200"). Recording one is a lock and a few dict updates,
+	# which is negligible next to the requests and model calls being measured, so it is always on.
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+	
+	def reset(self):
+		with self.lock:
+			self.start_time = time.time()
+			self.counters = {}  # (name, labels): value
+			self.histograms = {}  # (name, labels): [bucket upper bounds, counts per bucket (the last one is +Inf), sum]
+			self.spans = []  # (name, labels, start in seconds since start_time, seconds)
+	
+	def increment(self, name, value=1, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + value
+	
+	def observe(self, name, value, buckets=METRICS_LATENCY_BUCKETS, **labels):
+		key = (name, tuple(sorted(labels.items())))
+		i_bucket = bisect.bisect_left(buckets, value)
+		with self.lock:
+			histogram = self.histograms.get(key)
+			if histogram is None:
+				histogram = self.histograms[key] = [buckets, [0] * (len(buckets) + 1), 0.0]
+			histogram[1][i_bucket] += 1
+			histogram[2] += value
+	
+	@contextlib.contextmanager
+	def span(self, name, **labels):
+		# with metrics.span("get_DOIs"): ... records how long the block took (also if it raises), and adds it to the stage's totals
+		start = time.time()
+		try:
+			yield
+		finally:
+			seconds = time.time() - start
+			self.increment("stage_calls_total", stage=name, **labels)
+			self.increment("stage_seconds_total", seconds, stage=name, **labels)
+			with self.lock:
+				if len(self.spans) < METRICS_MAX_SPANS:
+					self.spans.append((name, dict(labels), round(start - self.start_time, 6), round(seconds, 6)))
+	
+	def state(self):
+		# A picklable copy, to merge the metrics of worker processes into the parent's
+		with self.lock:
+			return {"counters": dict(self.counters), "histograms": {key: [buckets, list(counts), total] for key, [buckets, counts, total] in self.histograms.items()}, "spans": list(self.spans)}
+	
+	def merge(self, state):
+		with self.lock:
+			for key, value in state["counters"].items():
+				self.counters[key] = self.counters.get(key, 0) + value
+			for key, [buckets, counts, total] in state["histograms"].items():
+				histogram = self.histograms.setdefault(key, [buckets, [0] * len(counts), 0.0])
+				histogram[1] = [count + new_count for count, new_count in zip(histogram[1], counts)]
+				histogram[2] += total
+			self.spans.extend(state["spans"][:max(0, METRICS_MAX_SPANS - len(self.spans))])
+	
+	def summary(self):
+		# The run summary: time per stage, requests/statuses/retries/latency per host, URL cache hit ratios per source, and embedding throughput per model
+		state = self.state()
+		summary = {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)), "seconds": round(time.time() - self.start_time, 3),
+			"stages": {}, "hosts": {}, "url_cache": {}, "embeddings": {}}
+		for (name, labels), value in sorted(state["counters"].items()):
+			labels = dict(labels)
+			if name in ("stage_calls_total", "stage_seconds_total"):
+				stage = summary["stages"].setdefault(labels["stage"], {"calls": 0, "seconds": 0.0})
+				stage["calls" if name == "stage_calls_total" else "seconds"] += value
+			elif name in ("http_requests_total", "http_retries_total", "http_skipped_total"):
+				host = summary["hosts"].setdefault(labels["host"], {"requests": 0, "statuses": {}, "retries": 0, "skipped": 0})
+				if name == "http_requests_total":
+					host["requests"] += value
+					host["statuses"][labels["status"]] = host["statuses"].get(labels["status"], 0) + value
+				else:
+					host["retries" if name == "http_retries_total" else "skipped"] += value
+			elif name == "url_cache_lookups_total":
+				source = summary["url_cache"].setdefault(labels["source"], {"hits": 0, "misses": 0})
+				source["hits" if labels["result"] == "hit" else "misses"] += value
+			elif name in ("embedding_texts_total", "embedding_encode_seconds_total"):
+				model = summary["embeddings"].setdefault(labels["model"], {"encoded": 0, "cached": 0, "encode_seconds": 0.0})
+				model[labels["result"] if name == "embedding_texts_total" else "encode_seconds"] += value
+		for (name, labels), [buckets, counts, total] in state["histograms"].items():
+			if name == "http_request_seconds":
+				host = summary["hosts"].setdefault(dict(labels)["host"], {"requests": 0, "statuses": {}, "retries": 0, "skipped": 0})
+				host["mean_seconds"] = round(total / sum(counts), 4) if sum(counts) else None
+				host["latency_histogram"] = dict(zip([str(bucket) for bucket in buckets] + ["+Inf"], itertools.accumulate(counts)))
+		for stage in summary["stages"].values():
+			stage["seconds"] = round(stage["seconds"], 3)
+		for source in summary["url_cache"].values():
+			source["hit_ratio"] = round(source["hits"] / (source["hits"] + source["misses"]), 3) if source["hits"] + source["misses"] else None
+		for model in summary["embeddings"].values():
+			model["encode_seconds"] = round(model["encode_seconds"], 3)
+			model["texts_per_second"] = round(model["encoded"] / model["encode_seconds"], 1) if model["encode_seconds"] else None
+		summary["spans"] = [{"name": name, **labels, "start": start, "seconds": seconds} for name, labels, start, seconds in state["spans"]]
+		return summary
+	
+	def to_prometheus(self):
+		# The Prometheus text exposition format: counters as they are, histograms as cumulative _bucket{le=...}, _sum and _count series
+		def format_labels(labels):
+			if not labels:
+				return ""
+			return "{" + ",".join(f'{key}="{escape_prometheus_label(value)}"' for key, value in labels) + "}"
+		state = self.state()
+		lines = []
+		for name in sorted({name for name, labels in state["counters"]}):
+			lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+			for (counter_name, labels), value in sorted(state["counters"].items()):
+				if counter_name == name:
+					lines.append(f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}")
+		for name in sorted({name for name, labels in state["histograms"]}):
+			lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+			for (histogram_name, labels), [buckets, counts, total] in sorted(state["histograms"].items()):
+				if histogram_name != name:
+					continue
+				for bucket, count in zip([str(bucket) for bucket in buckets] + ["+Inf"], itertools.accumulate(counts)):
+					lines.append(f"{METRICS_PREFIX}{name}_bucket{format_labels(labels + (('le', bucket),))} {count}")
+				lines.append(f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {total}")
+				lines.append(f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {sum(counts)}")
+		return "\n".join(lines) + "\n"
+	
+	def write(self, summary_path=METRICS_SUMMARY_PATH, prometheus_path=METRICS_PROMETHEUS_PATH):
+		# Both files are replaced in one step, so a metrics collector never reads a half-written file
+		for path, text in ((summary_path, lambda: json.dumps(self.summary(), indent=2)), (prometheus_path, self.to_prometheus)):
+			if path:
+				with open(path + ".tmp", "w", encoding="utf-8") as f:
+					f.write(text())
+				os.replace(path + ".tmp", path)
+
+
+def escape_prometheus_label(value):
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+def timed(name=None):
+	# Decorator that records every call of a stage function as a metrics span (named after the function by default)
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with metrics.span(name or func.__name__):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
 # PMC_service_root = "https://www.ncbi.nlm.nih.gov/pmc/utils/idconv/v1.0/?tool=windows&email=frederik.bay2@gmail.com"
 
 
@@ -38,7 +220,111 @@ def load_file(file: str):
 	return txt
 
 
+BIBTEX_SKIPPED_TYPES = {"comment", "string", "preamble"}
+BIBTEX_BRACE_RE = re.compile(r"[{}]")
+BIBTEX_VALUE_DELIMITER_RE = re.compile(r'[{}",]')
+BIBTEX_ENTRY_START_RE = re.compile(r"@\s*\w+\s*\{")
+BIBTEX_HEADER_RE = re.compile(r"@\s*(\w+)\s*\{\s*([^,\s]*)\s*,?")
+BIBTEX_KEY_RE = re.compile(r"[\s,]*(\w[\w.:+-]*)\s*=\s*")
+
+def iter_bibtex_entry_texts(f):
+	# Split a BibTeX file into the texts of its entries ("@type{name, ...}") in a single pass, one line at a time.
+	# Only the brace depth is tracked, so anything outside the entries (comments etc.) is skipped and nothing can backtrack.
+	entry_parts = None
+	depth = 0
+	for line in f:
+		pos = 0
+		while pos < len(line):
+			if entry_parts is None:
+				entry_start = BIBTEX_ENTRY_START_RE.search(line, pos)
+				if not entry_start:
+					break
+				pos = entry_start.start()
+				entry_parts, depth = [], 0
+			if line.find("@", pos + 1) < 0:  # No other entry can start on this line, so counting the braces is enough
+				opens, closes = line.count("{", pos), line.count("}", pos)
+				if depth + opens - closes > 0:  # The entry continues on the next line
+					depth += opens - closes
+					entry_parts.append(line[pos:])
+					break
+			# Find the closing brace of the entry; another entry may start after it on the same line ("}@article{b,")
+			for match in BIBTEX_BRACE_RE.finditer(line, pos):
+				depth += 1 if match.group() == "{" else -1
+				if depth == 0:
+					break
+			else:  # The entry continues on the next line
+				entry_parts.append(line[pos:])
+				break
+			entry_parts.append(line[pos:match.end()])
+			yield "".join(entry_parts)
+			entry_parts = None
+			pos = match.end()
+
+def find_bibtex_value_end(text, pos):
+	# Returns the end of the field value starting at pos: a {...} group, a "..." string or a bare word/number, or several of them joined with #
+	depth = 0
+	in_quotes = False
+	for match in BIBTEX_VALUE_DELIMITER_RE.finditer(text, pos):
+		char = match.group()
+		if char == "{":
+			depth += 1
+		elif char == "}":
+			depth -= 1
+			if depth < 0:  # The closing brace of the entry
+				return match.start()
+		elif char == '"' and depth == 0:
+			in_quotes = not in_quotes
+		elif char == "," and depth == 0 and not in_quotes:
+			return match.start()
+	return len(text)
+
+def parse_bibtex_entry(entry_text):
+	# Returns (bib_type, bib_name, [(key, raw value), ...]) for the text of one entry, or None for @comment/@string/@preamble and malformed entries
+	header = BIBTEX_HEADER_RE.match(entry_text)
+	if not header or header.group(1).lower() in BIBTEX_SKIPPED_TYPES:
+		return None
+	bib_type, bib_name = header.groups()
+	fields = []
+	pos = header.end()
+	while True:
+		key = BIBTEX_KEY_RE.match(entry_text, pos)
+		if not key:
+			break
+		value_end = find_bibtex_value_end(entry_text, key.end())
+		fields.append((key.group(1), entry_text[key.end():value_end]))
+		pos = value_end
+	return bib_type, bib_name, fields
+
+def iter_bibtex(file: str, clean=True):
+	# Streams the entries of a BibTeX file as (bib_name, bib_type, {key: value}), reading it one line at a time
+	with open(file, "r", encoding="utf-8") as f:
+		for entry_text in iter_bibtex_entry_texts(f):
+			entry = parse_bibtex_entry(entry_text)
+			if entry is None:
+				continue
+			bib_type, bib_name, fields = entry
+			yield bib_name, bib_type, {key.lower(): clean_text(value) if clean else value for key, value in fields}
+
+@timed()
 def load_bibtex(file: str, debug = None):
+	# bib_types is a dict with the bib name containing the type of the bib entry
+	# bibs is a dict with the bib name containing a dict with that bib's keys and values
+	print("Reading file:", file)
+	bibs, bib_types = {}, {}
+	for bib_name, bib_type, fields in iter_bibtex(file, clean=not debug):
+		if bib_name == debug:
+			print(bib_type)
+			print(fields)  # Print without clean_text()
+			fields = {key: clean_text(value) for key, value in fields.items()}
+			print(fields)
+		elif debug:
+			fields = {key: clean_text(value) for key, value in fields.items()}
+		bibs[bib_name] = fields
+		bib_types[bib_name] = bib_type
+	return bibs, bib_types
+
+def load_bibtex_regex(file: str, debug = None):
+	# The original regex-based parser (kept for comparison in benchmark.py)
 	# txt_divided is a list containing the full text divided into the bibliographic entries
 	# bib_types is a list containing tuples with the type and name respectively of the bib entry
 	# bibs is a dict with the bib name containing a dict with that bib's keys and values
@@ -60,7 +346,107 @@ def load_bibtex(file: str, debug = None):
 	if debug: print(bibs[debug])
 	return bibs, bib_types
 
+# natbib (\cite, \citep, \citet, \citealp, \citeyearpar, \Citep, ...) and biblatex (\autocite, \parencite, \textcite, ...) citation commands, optionally starred:
+# every \cite... and \Cite... command except \citestyle, and \citetext and \citelist, whose argument isn't keys (the citation commands inside it are found on their own).
+# The biblatex multicite commands (\cites, \parencites, ...) take several key groups, each with its own optional arguments.
+# Every alternative starts with a literal character, which lets the regex engine skip ahead to the next %, newline or backslash.
+LATEX_TOKEN_RE = re.compile(r"%(?P<comment>[^\n]*)|\n(?P<break>[\t ]*\n)|\\(?:(?P<linebreak>\\|begin\s*\{document\})|"
+	r"(?P<include>input|include|subfile)\s*\{(?P<path>[^}]*)\}|"
+	r"(?P<cite>(?:[Cc]ite(?!(?:style|text|list)(?![a-zA-Z]))[a-zA-Z]*?|[Pp]arencite|[Tt]extcite|[Aa]utocite|[Ff]ootcite(?:text)?|[Ss]martcite|[Ss]upercite|[Ff]ullcite)(?P<multicite>s)?)\*?(?![a-zA-Z])|"
+	r"(?P<end>end\s*\{document\})|(?P<escaped>%))")
+LATEX_CITE_ARGUMENTS_RE = re.compile(r"(?:\s*\[[^\]]*\])*\s*\{([^}]*)\}")
+LATEX_MULTICITE_ARGUMENTS_RE = re.compile(r"(?:\s*\([^)]*\))*(?:\s*\[[^\]]*\])*\s*\{([^}]*)\}")
+LATEX_COMMAND_WITH_ARGUMENT_RE = re.compile(r"\\(?!text(?:bf|it)?)\w+[\{\[](.*?)[\}\]]", flags=re.S)
+LATEX_TEXT_STYLE_RE = re.compile(r"\\text(?:bf|it)?\{(.*?)\}", flags=re.S)
+
+# One cited key with the statement before it, the file it is in, the line the statement starts on and the line of the citation command
+CitationStatement = collections.namedtuple("CitationStatement", ["citation", "statement", "file", "line", "cite_line"])
+
+
+def clean_latex_statement(text):
+	text = LATEX_COMMAND_WITH_ARGUMENT_RE.sub("", text)  # Remove section headers, labels etc.
+	text = LATEX_TEXT_STYLE_RE.sub(r"\1", text)  # Replace bold, italic (etc.) text with just the text.
+	return clean_text(text)
+
+def resolve_latex_include(name, folders):
+	# \input{chapters/intro} may leave out the .tex. LaTeX looks in the folder of the main file; the folder of the including file is tried too.
+	for folder in folders:
+		path = os.path.join(folder, name.strip())
+		for candidate in (path, path + ".tex"):
+			if os.path.isfile(candidate):
+				return candidate
+	return None
+
+def iter_latex_text_citations(text, file="", folder=".", including=()):
+	# Streams a CitationStatement for every key of every citation command in the text, in a single pass over it with LATEX_TOKEN_RE.
+	# A statement is the text since the last citation, paragraph break, \\ or \begin{document} (without comments). Included files are read where they are included.
+	# folder is where \input and \include paths are relative to.
+	parts = []  # The text of the current statement
+	pos = 0
+	line = statement_line = 1  # Line numbers at pos, and at the start of the current statement
+	while True:
+		token = LATEX_TOKEN_RE.search(text, pos)
+		end = token.start() if token else len(text)
+		parts.append(text[pos:end])
+		line += text.count("\n", pos, end)
+		if not token or token.group("end"):
+			return
+		pos = token.end()
+		if token.group("comment") is not None:
+			continue
+		if token.group("escaped"):  # \%
+			parts.append(token.group())
+			continue
+		
+		if token.group("cite"):
+			arguments_re = LATEX_MULTICITE_ARGUMENTS_RE if token.group("multicite") else LATEX_CITE_ARGUMENTS_RE
+			key_groups = []
+			while arguments := arguments_re.match(text, pos):
+				key_groups.append(arguments.group(1))
+				pos = arguments.end()
+				if not token.group("multicite"):
+					break
+			if not key_groups:  # E.g. \cite in a macro definition
+				parts.append(token.group())
+				continue
+			statement = "".join(parts)
+			start_line = statement_line + statement.count("\n", 0, len(statement) - len(statement.lstrip()))
+			statement = clean_latex_statement(statement)
+			for key_group in key_groups:
+				for key in key_group.split(","):
+					if key.strip():
+						yield CitationStatement(key.strip(), statement, file, start_line, line)
+			if text.startswith(".", pos):
+				pos += 1
+		elif token.group("include"):
+			path = resolve_latex_include(token.group("path"), [folder, os.path.dirname(file)])
+			if path is None:
+				print(f"{file}:{line}: included file not found: {token.group('path')}")
+			elif os.path.abspath(path) in including:
+				print(f"{file}:{line}: {path} is already being read (circular include), skipping it")
+			else:
+				# A subfile's own \input paths are relative to the subfile
+				yield from iter_latex_citations(path, os.path.dirname(path) if token.group("include") == "subfile" else folder, including)
+		line += text.count("\n", token.start(), pos)
+		parts = []
+		statement_line = line
+
+def iter_latex_citations(file, folder=None, including=()):
+	# Streams the CitationStatements of a LaTeX file and the files it includes with \input, \include and \subfile
+	text = load_file(file)
+	yield from iter_latex_text_citations(text, file, os.path.dirname(file) if folder is None else folder, including + (os.path.abspath(file),))
+
+@timed()
 def latex2citations_statements(txt):
+	# (citations, statements) of a LaTeX text. Paths of included files are relative to the current folder.
+	citations, statements = [], []
+	for citation_statement in iter_latex_text_citations(txt):
+		citations.append(citation_statement.citation)
+		statements.append(citation_statement.statement)
+	return citations, statements
+
+def latex2citations_statements_regex(txt):
+	# The original regex-based extractor (kept for comparison in benchmark.py)
 	rough_division = re.split(r"\\cite(?:p|t)?\{(.*?)\}\.?", txt, flags=re.S)  # Text segments: even indices; citations: odd indices.
 	text_segments, citation_segments = rough_division[::2], rough_division[1::2]
 	# Cropping text_segments and citation_segments
@@ -98,55 +484,676 @@ def save_bibtex(bib_dict, bib_types, filename):
 def hash_url(url):
 	return hashlib.md5(url.encode()).hexdigest()
 
+
+# Request budgets per host: (max concurrent requests, max requests per second).
+# Hosts are matched on their suffix, so both eutils.ncbi.nlm.nih.gov and pubmed.ncbi.nlm.nih.gov share the NCBI budget.
+NCBI_API_KEY = os.environ.get("NCBI_API_KEY", "")
+HOST_LIMITS = {
+	"api.crossref.org": (5, 10),  # Polite pool (requests include mailto=)
+	"ncbi.nlm.nih.gov": (3, 10 if NCBI_API_KEY else 3),  # NCBI allows 3 rps without an API key and 10 with one
+	"opencitations.net": (2, 5),
+}
+DEFAULT_HOST_LIMIT = (4, 5)
+FETCH_MAX_WORKERS = 8  # Number of bib entries processed at the same time by the get_* stages
+
+
+# Retries of failed requests (timeouts, connection errors and these statuses), with exponential backoff and jitter unless the server sends Retry-After
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0  # Seconds before the first retry; doubled for every further one
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# A host is considered down after this many failed attempts in a row (retries included), and is then skipped for the cooldown
+CIRCUIT_BREAKER_FAILURES = 5
+CIRCUIT_BREAKER_COOLDOWN = 60.0
+# The concurrency of a host is halved when a response takes longer than this many times the host's median response time
+ADAPTIVE_SLOW_FACTOR = 3.0
+
+
+class HostUnavailableError(urllib.error.URLError):
+	pass
+
+
+class HostLimiter:
+	# Limits the number of concurrent requests to a host and spaces them out to stay within the requests per second budget.
+	# The concurrency adapts to the host: it is halved when responses get slow or fail, and grows back by one after every max_concurrency fast responses.
+	# A Retry-After pauses all requests to the host, Crossref's x-rate-limit-* headers tighten the request rate, and after
+	# CIRCUIT_BREAKER_FAILURES failed attempts in a row the host is skipped (HostUnavailableError) for CIRCUIT_BREAKER_COOLDOWN seconds.
+	def __init__(self, max_concurrency, requests_per_second, name=""):
+		self.name = name
+		self.concurrency_limit = max_concurrency
+		self.max_concurrency = max_concurrency
+		self.default_min_interval = 1 / requests_per_second
+		self.min_interval = self.default_min_interval
+		self.active = 0
+		self.next_slot = 0.0
+		self.paused_until = 0.0
+		self.latencies = collections.deque(maxlen=50)
+		self.fast_responses = 0
+		self.last_decrease = 0.0
+		self.consecutive_failures = 0
+		self.open_until = 0.0
+		self.condition = threading.Condition()
+
+	def __enter__(self):
+		with self.condition:
+			while self.active >= self.max_concurrency:
+				self.condition.wait()
+			now = time.monotonic()
+			if now < self.open_until:
+				raise HostUnavailableError(f"{self.name} is skipped for {round(self.open_until - now)}s after {self.consecutive_failures} failed attempts in a row")
+			self.active += 1
+			wait = max(self.next_slot, self.paused_until) - now
+			self.next_slot = max(now, self.next_slot, self.paused_until) + self.min_interval
+		if wait > 0:
+			time.sleep(wait)
+		return self
+
+	def __exit__(self, *exc_info):
+		with self.condition:
+			self.active -= 1
+			self.condition.notify()
+	
+	def decrease_concurrency(self):
+		# Halve the concurrency, at most once per second (the requests already underway would otherwise halve it again)
+		now = time.monotonic()
+		if now - self.last_decrease > 1 and self.max_concurrency > 1:
+			self.max_concurrency = max(1, self.max_concurrency // 2)
+			self.last_decrease = now
+		self.fast_responses = 0
+	
+	def record_response(self, latency, headers=None):
+		# Called after every response from the host (also for errors like 404 that don't mean the host is struggling)
+		with self.condition:
+			self.consecutive_failures = 0
+			if len(self.latencies) >= 10 and latency > ADAPTIVE_SLOW_FACTOR * statistics.median(self.latencies):
+				self.decrease_concurrency()
+			else:
+				self.fast_responses += 1
+				if self.fast_responses >= self.max_concurrency and self.max_concurrency < self.concurrency_limit:
+					self.max_concurrency += 1
+					self.fast_responses = 0
+					self.condition.notify()
+			self.latencies.append(latency)
+			# Crossref tells how many requests it allows per interval, e.g. x-rate-limit-limit: 50 and x-rate-limit-interval: 1s
+			limit, interval = get_header(headers, "x-rate-limit-limit"), get_header(headers, "x-rate-limit-interval")
+			try:
+				self.min_interval = max(self.default_min_interval, float(interval.rstrip("s")) / int(limit))
+			except (AttributeError, ValueError, ZeroDivisionError):
+				pass
+	
+	def record_failure(self, retry_after=None):
+		# Called after a timeout, a connection error or a retryable status
+		with self.condition:
+			now = time.monotonic()
+			self.consecutive_failures += 1
+			self.decrease_concurrency()
+			if retry_after:
+				self.paused_until = max(self.paused_until, now + retry_after)
+			if self.consecutive_failures >= CIRCUIT_BREAKER_FAILURES:
+				if now >= self.open_until:
+					print(f"{self.name} seems to be down ({self.consecutive_failures} failed attempts in a row). Skipping it for {CIRCUIT_BREAKER_COOLDOWN}s.")
+				self.open_until = now + CIRCUIT_BREAKER_COOLDOWN
+
+
+def get_header(headers, name):
+	# Case-insensitive lookup in a headers dict (or an email.message.Message)
+	return next((value for key, value in (headers or {}).items() if key.lower() == name), None)
+
+
+def parse_retry_after(value):
+	# Retry-After is either a number of seconds or an HTTP date
+	if not value:
+		return None
+	if value.strip().isdigit():
+		return float(value)
+	import email.utils
+	try:
+		return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+	except (TypeError, ValueError):
+		return None
+
+
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+def get_host_limiter(url):
+	host = urlsplit(url).hostname or ""
+	limit_key = max((key for key in HOST_LIMITS if host == key or host.endswith("." + key)), key=len, default=host)
+	with host_limiters_lock:
+		if limit_key not in host_limiters:
+			host_limiters[limit_key] = HostLimiter(*HOST_LIMITS.get(limit_key, DEFAULT_HOST_LIMIT), name=limit_key)
+		return host_limiters[limit_key]
+
+
+def add_api_key(url):
+	# The NCBI API key is only added when fetching, so cached URLs are the same with and without a key
+	if NCBI_API_KEY and (urlsplit(url).hostname or "").endswith("eutils.ncbi.nlm.nih.gov"):
+		url += ("&" if "?" in url else "?") + "api_key=" + NCBI_API_KEY
+	return url
+
+
+def run_concurrently(func, bibs, desc, max_workers=None, on_result=None):
+	# Run func(bib_entry) for all bibs on a thread pool (the host limiters keep the requests within each API's budget).
+	# on_result(bib_name, result) is called (in this thread) as soon as each entry is done.
+	# Returns a dict with the results in the same order as bibs.
+	results = {}
+	pbar = tqdm(total=len(bibs))
+	executor = ThreadPoolExecutor(max_workers=max_workers or FETCH_MAX_WORKERS)
+	try:
+		futures = {executor.submit(func, bib_entry): bib_name for bib_name, bib_entry in bibs.items()}
+		for future in as_completed(futures):
+			bib_name = futures[future]
+			results[bib_name] = future.result()
+			if on_result:
+				on_result(bib_name, results[bib_name])
+			pbar.set_description(bib_name)
+			pbar.update()
+	except BaseException:
+		executor.shutdown(wait=False, cancel_futures=True)
+		raise
+	executor.shutdown()
+	pbar.set_description(desc)
+	pbar.close()
+	return {bib_name: results[bib_name] for bib_name in bibs}
+
+
+def normalize_url(url):
+	# Scheme and host are case-insensitive, and the fragment is never sent to the server
+	parts = urlsplit(url.strip())
+	return parts._replace(scheme=parts.scheme.lower(), netloc=parts.netloc.lower(), fragment="").geturl()
+
+def normalize_DOI(DOI):
+	# DOIs are case-insensitive, and are often written as a doi.org URL or with a "doi:" prefix
+	DOI = (DOI or "").strip()
+	return (DOI if DOI.startswith("10.") else re.sub(r"^(?:https?://(?:dx\.)?doi\.org/|doi:\s*)", "", DOI, flags=re.I)).lower()
+
+def normalize_title(title):
+	# Ignores case, punctuation, LaTeX braces and commands (e.g. {DNA}, M{\"u}ller, \emph{...}) and spacing
+	title = re.sub(r"\\(?:[a-zA-Z]+|.)|[{}]", "", title or "")
+	return " ".join(re.sub(r"[\W_]+", " ", title.lower()).split())
+
+ASCII_PUNCTUATION_TO_SPACE = str.maketrans({chr(i): " " for i in range(128) if not chr(i).isalnum() and chr(i) != "\n"})
+
+def normalize_titles(titles):
+	# normalize_title for many titles at once, with one pass over all of them (the ASCII punctuation is replaced without a regex)
+	text = re.sub(r"\\(?:[a-zA-Z]+|.)|[{}]", "", "\n".join((title or "").replace("\n", " ") for title in titles))
+	text = text.lower().translate(ASCII_PUNCTUATION_TO_SPACE)
+	if not text.isascii():
+		text = re.sub(r"[^\w\s]+", " ", text)
+	return [" ".join(title.split()) for title in text.split("\n")]
+
+
+def coalesced(key_func, keep_results=True):
+	# Decorator for lookups: calls whose key_func(*args, **kwargs) is the same share one call. While it runs, the other callers wait for
+	# its result (or exception) instead of sending the same request, e.g. for duplicate bib entries with the same DOI or title.
+	# With keep_results, the result is also reused by later calls in the same run (failures are not kept, so they are tried again).
+	def decorator(func):
+		in_flight = {}  # key: Future
+		results = {}
+		lock = threading.Lock()
+		
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			key = key_func(*args, **kwargs)
+			with lock:
+				if key in results:
+					return results[key]
+				future = in_flight.get(key)
+				is_owner = future is None
+				if is_owner:
+					future = in_flight[key] = Future()
+			if not is_owner:
+				return future.result()
+			try:
+				result = func(*args, **kwargs)
+			except BaseException as e:
+				with lock:
+					del in_flight[key]
+				future.set_exception(e)
+				raise
+			with lock:
+				if keep_results:
+					results[key] = result
+				del in_flight[key]
+			future.set_result(result)
+			return result
+		
+		wrapper.cache_clear = results.clear
+		return wrapper
+	return decorator
+
+
+HTTP_TIMEOUT = 30  # Seconds before a connect or read is given up on (a hung socket would otherwise stall the whole run)
+HTTP_MAX_REDIRECTS = 10
+HTTP_MAX_IDLE_PER_HOST = 10
+HTTP_USER_AGENT = "citationvalidator/1.0 (mailto:frederik.bay2@gmail.com)"
+
+
+class HTTPConnectionPool:
+	# Keeps keep-alive connections open per (scheme, host, port) so that repeated requests to the same API skip the TCP and TLS handshakes
+	def __init__(self, timeout=HTTP_TIMEOUT, max_idle_per_host=HTTP_MAX_IDLE_PER_HOST):
+		self.timeout = timeout
+		self.max_idle_per_host = max_idle_per_host
+		self.idle_connections = {}
+		self.lock = threading.Lock()
+		self.ssl_context = None  # Created with the first HTTPS connection (loading the CA certificates is a noticeable part of the startup time)
+		self.proxies = getproxies()
+	
+	def new_connection(self, scheme, host, port, timeout):
+		proxy = self.proxies.get(scheme) if not proxy_bypass(host) else None
+		connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+		if scheme == "https" and self.ssl_context is None:
+			with self.lock:
+				if self.ssl_context is None:
+					self.ssl_context = ssl.create_default_context()
+		kwargs = {"context": self.ssl_context} if scheme == "https" else {}
+		if not proxy:
+			return connection_class(host, port, timeout=timeout, **kwargs)
+		proxy_parts = urlsplit(proxy if "://" in proxy else "http://" + proxy)
+		if scheme == "https":
+			connection = connection_class(proxy_parts.hostname, proxy_parts.port or 80, timeout=timeout, **kwargs)
+			connection.set_tunnel(host, port)
+		else:
+			connection = http.client.HTTPConnection(proxy_parts.hostname, proxy_parts.port or 80, timeout=timeout)
+		return connection
+	
+	def request(self, method, url, headers=None, timeout=None):
+		# Returns (status, reason, headers, body). Connections are put back in the pool unless the server asked to close them.
+		parts = urlsplit(url)
+		scheme = parts.scheme or "http"
+		port = parts.port or (443 if scheme == "https" else 80)
+		key = (scheme, parts.hostname, port)
+		target = url if scheme == "http" and self.proxies.get("http") and not proxy_bypass(parts.hostname) else (parts.path or "/") + ("?" + parts.query if parts.query else "")
+		timeout = timeout or self.timeout
+		
+		for attempt in range(2):
+			with self.lock:
+				connection = self.idle_connections.get(key, []).pop() if self.idle_connections.get(key) else None
+			is_reused = connection is not None
+			if not is_reused:
+				connection = self.new_connection(scheme, parts.hostname, port, timeout)
+			connection.timeout = timeout
+			if connection.sock:
+				connection.sock.settimeout(timeout)
+			try:
+				connection.request(method, target, headers=headers or {})
+				response = connection.getresponse()
+				body = response.read()
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+				connection.close()
+				if is_reused and attempt == 0:  # The server closed the idle connection, so try again on a fresh one
+					continue
+				raise urllib.error.URLError(e)
+			except (OSError, http.client.HTTPException) as e:
+				connection.close()
+				raise urllib.error.URLError(e)
+			
+			if response.will_close:
+				connection.close()
+			else:
+				with self.lock:
+					idle = self.idle_connections.setdefault(key, [])
+					if len(idle) < self.max_idle_per_host:
+						idle.append(connection)
+					else:
+						connection.close()
+			return response.status, response.reason, response.getheaders(), body
+	
+	def close(self):
+		with self.lock:
+			for connections in self.idle_connections.values():
+				for connection in connections:
+					connection.close()
+			self.idle_connections = {}
+
+
+http_pool = HTTPConnectionPool()
+
+# {host: base URL} of servers that get the requests for these hosts instead, e.g. {"api.crossref.org": "http://127.0.0.1:8000"}
+# for the mock APIs of benchmark.py. Only the connection changes: the URL cache and the host budgets still use the original URLs.
+HTTP_HOST_OVERRIDES = {}
+
+def override_host(url):
+	parts = urlsplit(url)
+	base_url = HTTP_HOST_OVERRIDES.get(parts.hostname)
+	if not base_url:
+		return url
+	return base_url.rstrip("/") + (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+def http_get(url, timeout=None):
+	# GET through the shared connection pool. Follows redirects, decompresses gzip/deflate and raises urllib.error.HTTPError for error statuses (like urlopen).
+	for i_redirect in range(HTTP_MAX_REDIRECTS + 1):
+		status, reason, headers, body = http_pool.request("GET", override_host(url), {"Accept-Encoding": "gzip, deflate", "User-Agent": HTTP_USER_AGENT}, timeout)
+		headers = dict(headers)
+		headers_lower = {key.lower(): value for key, value in headers.items()}
+		if status in (301, 302, 303, 307, 308) and "location" in headers_lower:
+			url = urljoin(url, headers_lower["location"])
+			continue
+		break
+	else:
+		raise urllib.error.URLError(f"Too many redirects ({HTTP_MAX_REDIRECTS})")
+	
+	content_encoding = headers_lower.get("content-encoding", "").lower()
+	if content_encoding == "gzip":
+		body = gzip.decompress(body)
+	elif content_encoding == "deflate":
+		try:
+			body = zlib.decompress(body)
+		except zlib.error:  # Some servers send raw deflate data without the zlib wrapper
+			body = zlib.decompress(body, -zlib.MAX_WBITS)
+	
+	if status >= 400:
+		import email.message
+		error_headers = email.message.Message()
+		for key, value in headers.items():
+			error_headers[key] = value
+		raise urllib.error.HTTPError(url, status, reason, error_headers, io.BytesIO(body))
+	
+	charset = next(iter(re.findall(r"charset=([\w-]+)", headers_lower.get("content-type", ""), flags=re.I)), "utf-8")
+	try:
+		html = body.decode(charset, errors="replace")
+	except LookupError:  # Unknown charset
+		html = body.decode("utf-8", errors="replace")
+	return html, headers
+
+
+# How long cached responses stay valid, per source (in seconds, None = never expires).
+# DOIs, PMIDs and abstracts don't change, but citation counts (and sometimes reference counts) do.
+CACHE_TTLS = {
+	"opencitations": 7 * 24 * 3600,
+	"crossref_work": 30 * 24 * 3600,
+	"crossref_search": None,
+	"ncbi": None,
+	"doi": None,
+	"other": None,
+}
+URL_CACHE_PATH = "cached_urls.sqlite"
+URL_CACHE_MAX_BYTES = None  # E.g. 2 * 1024**3 to keep the cache below 2 GB (least recently used entries are evicted first)
+URL_CACHE_ACCESS_FLUSH_SIZE = 1000  # The last-used times of cache hits are written in batches of this many (and on every put and at close)
+LEGACY_CACHE_FOLDER = "cached_urls"
+
+def get_cache_source(url):
+	parts = urlsplit(url)
+	host = parts.hostname or ""
+	if host.endswith("opencitations.net"):
+		return "opencitations"
+	if host == "api.crossref.org":
+		return "crossref_work" if parts.path.startswith("/works/") else "crossref_search"
+	if host.endswith("ncbi.nlm.nih.gov"):
+		return "ncbi"
+	if host.endswith("doi.org"):
+		return "doi"
+	return "other"
+
+
+class CacheStore:
+	# Shared TTL and statistics code of the URL cache backends used by get_html_from_url.
+	# Backends implement get(url), which returns (html, headers) or None, and put(url, html, headers).
+	def __init__(self, ttls=None):
+		self.ttls = CACHE_TTLS if ttls is None else ttls
+		self.hits = 0
+		self.misses = 0
+		self.expired = 0
+		self.evictions = 0
+	
+	def get_ttl(self, source):
+		# Entries of unknown origin (source None, e.g. imported from the old cached_urls folder) get the shortest TTL
+		if source is None:
+			return min((ttl for ttl in self.ttls.values() if ttl is not None), default=None)
+		return self.ttls.get(source)
+	
+	def is_expired(self, source, fetched_at):
+		ttl = self.get_ttl(source)
+		return ttl is not None and time.time() - fetched_at > ttl
+	
+	def stats(self):
+		lookups = self.hits + self.misses
+		return {"hits": self.hits, "misses": self.misses, "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0, "expired": self.expired, "evictions": self.evictions}
+
+
+class FileCacheStore(CacheStore):
+	# The original format: a <md5>_html.txt and a <md5>_headers.json file per URL in a flat folder. TTLs use the file modification time.
+	def __init__(self, folder=LEGACY_CACHE_FOLDER, ttls=None):
+		super().__init__(ttls)
+		self.folder = folder
+	
+	def get_filepaths(self, url):
+		return os.path.join(self.folder, hash_url(url) + "_html.txt"), os.path.join(self.folder, hash_url(url) + "_headers.json")
+	
+	def get(self, url):
+		html_filepath, headers_filepath = self.get_filepaths(url)
+		try:
+			if self.is_expired(get_cache_source(url), os.path.getmtime(html_filepath)):
+				self.expired += 1
+				self.misses += 1
+				return None
+			with open(html_filepath, 'r', encoding='utf-8') as html_file:
+				html = html_file.read()
+			with open(headers_filepath, 'r', encoding='utf-8') as headers_file:
+				headers = json.load(headers_file)
+		except FileNotFoundError:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return html, headers
+	
+	def put(self, url, html, headers):
+		html_filepath, headers_filepath = self.get_filepaths(url)
+		os.makedirs(self.folder, exist_ok=True)
+		# Written to a temporary file first, so other threads never read a half-written file
+		thread_suffix = f".{threading.get_ident()}.tmp"
+		with open(html_filepath + thread_suffix, 'w', encoding='utf-8') as html_file:
+			html_file.write(html)
+		with open(headers_filepath + thread_suffix, 'w', encoding='utf-8') as headers_file:
+			json.dump(headers, headers_file)
+		os.replace(html_filepath + thread_suffix, html_filepath)
+		os.replace(headers_filepath + thread_suffix, headers_filepath)
+
+
+class SQLiteCacheStore(CacheStore):
+	# One SQLite file with one row per URL. Keeps track of when each entry was fetched (for the TTLs) and last used (for LRU eviction when max_bytes is exceeded).
+	# The last-used times are kept in memory and written in batches, so a hit doesn't cost a write and a commit.
+	def __init__(self, path=URL_CACHE_PATH, max_bytes=URL_CACHE_MAX_BYTES, ttls=None):
+		super().__init__(ttls)
+		self.path = path
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")  # With WAL, a crash can lose the last commits but not corrupt the cache
+		self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, url TEXT, source TEXT, html TEXT, headers TEXT, size INTEGER, fetched_at REAL, accessed_at REAL)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+		self.connection.execute("UPDATE cache SET source = NULL WHERE url = '' AND source = 'other'")  # Imported by older versions, which gave them no TTL
+		self.connection.commit()
+		self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+		self.pending_accesses = {}  # key: accessed_at, not yet written
+	
+	def get(self, url):
+		key = hash_url(url)
+		with self.lock:
+			row = self.connection.execute("SELECT html, headers, source, fetched_at FROM cache WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				self.misses += 1
+				return None
+			html, headers, source, fetched_at = row
+			if self.is_expired(source, fetched_at):
+				self.expired += 1
+				self.misses += 1
+				return None
+			self.pending_accesses[key] = time.time()
+			if len(self.pending_accesses) >= URL_CACHE_ACCESS_FLUSH_SIZE:
+				self.write_accesses()
+				self.connection.commit()
+			self.hits += 1
+		return html, json.loads(headers)
+	
+	def put(self, url, html, headers, fetched_at=None):
+		key = hash_url(url)
+		size = len(html) + len(url)
+		now = time.time()
+		with self.lock:
+			old_size = self.connection.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+			self.pending_accesses.pop(key, None)
+			self.write_accesses()  # In the same transaction, and before an eviction, which needs them
+			self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, url, get_cache_source(url), html, json.dumps(headers), size, fetched_at or now, now))
+			self.total_bytes += size - (old_size[0] if old_size else 0)
+			if self.max_bytes and self.total_bytes > self.max_bytes:
+				self.evict(int(self.max_bytes * 0.9))
+			self.connection.commit()
+	
+	def write_accesses(self):
+		# Write the pending last-used times (without committing). Must be called with the lock held.
+		if self.pending_accesses:
+			self.connection.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?", [(accessed_at, key) for key, accessed_at in self.pending_accesses.items()])
+			self.pending_accesses.clear()
+	
+	def evict(self, target_bytes):
+		# Remove the least recently used entries until the cache is below target_bytes. Must be called with the lock held.
+		for key, size in self.connection.execute("SELECT key, size FROM cache ORDER BY accessed_at").fetchall():
+			if self.total_bytes <= target_bytes:
+				break
+			self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+			self.total_bytes -= size
+			self.evictions += 1
+	
+	def prune_expired(self):
+		# Delete all entries that are past their source's TTL
+		with self.lock:
+			self.write_accesses()
+			now = time.time()
+			for source, ttl in self.ttls.items():
+				if ttl is not None:
+					self.connection.execute("DELETE FROM cache WHERE source = ? AND fetched_at < ?", (source, now - ttl))
+			if self.get_ttl(None) is not None:
+				self.connection.execute("DELETE FROM cache WHERE source IS NULL AND fetched_at < ?", (now - self.get_ttl(None),))
+			self.connection.commit()
+			self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+	
+	def import_file_cache(self, folder=LEGACY_CACHE_FOLDER):
+		# Copy a cached_urls folder into this store. The URLs aren't stored in the old format, so only the hashes are kept (which is enough for lookups).
+		# Without the URL the source isn't known either, so the entries get the shortest TTL.
+		html_filenames = [filename for filename in os.listdir(folder) if filename.endswith("_html.txt")]
+		with self.lock:
+			for html_filename in tqdm(html_filenames, desc="Importing cached_urls"):
+				key = html_filename[:-len("_html.txt")]
+				html_filepath = os.path.join(folder, html_filename)
+				headers_filepath = os.path.join(folder, key + "_headers.json")
+				if not os.path.exists(headers_filepath):
+					continue
+				with open(html_filepath, 'r', encoding='utf-8') as html_file:
+					html = html_file.read()
+				with open(headers_filepath, 'r', encoding='utf-8') as headers_file:
+					headers = headers_file.read()
+				fetched_at = os.path.getmtime(html_filepath)
+				self.connection.execute("INSERT OR IGNORE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (key, "", None, html, headers, len(html), fetched_at, fetched_at))
+			self.connection.commit()
+			self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+	
+	def stats(self):
+		stats = super().stats()
+		with self.lock:
+			stats["entries"] = self.connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+		stats["bytes"] = self.total_bytes
+		return stats
+	
+	def close(self):
+		# Write the pending last-used times and close the database
+		with self.lock:
+			if self.pending_accesses:
+				self.write_accesses()
+				self.connection.commit()
+			self.connection.close()
+
+
+url_cache = None
+url_cache_lock = threading.Lock()
+def get_url_cache():
+	# The cache used by get_html_from_url. Created on first use; an existing cached_urls folder is imported the first time.
+	global url_cache
+	with url_cache_lock:
+		if url_cache is None:
+			is_new = not os.path.exists(URL_CACHE_PATH)
+			url_cache = SQLiteCacheStore(URL_CACHE_PATH)
+			atexit.register(url_cache.close)
+			if is_new and os.path.isdir(LEGACY_CACHE_FOLDER):
+				print(f"Importing {LEGACY_CACHE_FOLDER}/ into {URL_CACHE_PATH}")
+				url_cache.import_file_cache(LEGACY_CACHE_FOLDER)
+		return url_cache
+
+def set_url_cache(cache_store):
+	# Use another cache backend, e.g. set_url_cache(FileCacheStore()) for the old cached_urls folder
+	global url_cache
+	url_cache = cache_store
+
+
+def fetch_url(url):
+	# GET url within its host's budget, retrying failed requests (see RETRY_* and HostLimiter). Raises the last error if all attempts fail,
+	# and HostUnavailableError straight away while the host's circuit breaker is open.
+	limiter = get_host_limiter(url)
+	for attempt in range(RETRY_MAX_ATTEMPTS):
+		retry_after = None
+		try:
+			with limiter:
+				time_0 = time.monotonic()
+				try:
+					html, headers = http_get(add_api_key(url))
+				except urllib.error.HTTPError as e:
+					metrics.increment("http_requests_total", host=limiter.name, status=str(e.code))
+					metrics.observe("http_request_seconds", time.monotonic() - time_0, host=limiter.name)
+					if e.code not in RETRY_STATUSES:
+						limiter.record_response(time.monotonic() - time_0, e.headers)
+						raise
+					retry_after = parse_retry_after(e.headers.get("Retry-After"))
+					raise
+				except (urllib.error.URLError, http.client.HTTPException, OSError):
+					metrics.increment("http_requests_total", host=limiter.name, status="error")
+					raise
+				metrics.increment("http_requests_total", host=limiter.name, status="200")
+				metrics.observe("http_request_seconds", time.monotonic() - time_0, host=limiter.name)
+				limiter.record_response(time.monotonic() - time_0, headers)
+				return html, headers
+		except HostUnavailableError:
+			metrics.increment("http_skipped_total", host=limiter.name)
+			raise
+		except urllib.error.HTTPError as e:
+			if e.code not in RETRY_STATUSES:
+				raise
+			error = e
+		except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+			error = e
+		limiter.record_failure(retry_after)
+		if attempt == RETRY_MAX_ATTEMPTS - 1:
+			raise error
+		metrics.increment("http_retries_total", host=limiter.name)
+		delay = retry_after if retry_after is not None else random.uniform(0.5, 1.5) * min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+		print(f"{error} ({limiter.name}). Retrying in {round(delay, 1)}s...")
+		time.sleep(delay)
+
+
+@coalesced(lambda url, retrieve_from_cache=True, save_to_cache=True: (normalize_url(url), retrieve_from_cache, save_to_cache), keep_results=False)
 def get_html_from_url(url, retrieve_from_cache=True, save_to_cache=True):
 	html = None
 	headers = None
 	url = url.replace(" ", "%20").replace("‐", "-")  # TODO THIS! in citations
 	
-	cache_folder = "cached_urls"
-	html_filename = hash_url(url) + "_html.txt"
-	headers_filename = hash_url(url) + "_headers.json"
-	html_filepath = os.path.join(cache_folder, html_filename)
-	headers_filepath = os.path.join(cache_folder, headers_filename)
-	
 	# Retrieving cached html and header
 	if retrieve_from_cache:
-		# Check if the files already exist
-		if os.path.exists(html_filepath) and os.path.exists(headers_filepath):
-			# print(f"Loading content from {html_filepath} and {headers_filepath}")
-			with open(html_filepath, 'r', encoding='utf-8') as html_file:
-				html = html_file.read()
-			with open(headers_filepath, 'r', encoding='utf-8') as headers_file:
-				headers = json.load(headers_file)
-			# return html, headers
+		cached = get_url_cache().get(url)
+		metrics.increment("url_cache_lookups_total", source=get_cache_source(url), result="hit" if cached else "miss")
+		if cached:
+			html, headers = cached
 	
 	# Fetch from url if retrieve_from_cache didn't work
 	if not html:
 		print("Fetching from URL")
 		# try:
-		# Fetching HTML and headers
-		response = urlopen(url)
-		html = response.read().decode('utf-8')
-		headers = dict(response.getheaders())
+		# Fetching HTML and headers (waiting for a free slot in the host's request budget, and retrying if the request fails)
+		html, headers = fetch_url(url)
 		# except Exception as e:
 		# 	print(f"Failed to fetch {url}: {e}")
 		# 	return None, None
 		
 		if save_to_cache:
-			# Create the cache directory if it doesn't exist
-			if not os.path.exists(cache_folder):
-				os.makedirs(cache_folder)
-			
-			# Save HTML content
-			with open(html_filepath, 'w', encoding='utf-8') as html_file:
-				html_file.write(html)
-			
-			# Save headers
-			with open(headers_filepath, 'w', encoding='utf-8') as headers_file:
-				json.dump(headers, headers_file)
-			
-			# print(f"Saved {url} content to {html_filepath} and {headers_filepath}")
-		# return html, headers
+			get_url_cache().put(url, html, headers)
 	
 	# page = urlopen(url)
 	# headers = dict(page.getheaders())
@@ -157,40 +1164,45 @@ def get_html_from_url(url, retrieve_from_cache=True, save_to_cache=True):
 def get_DOI_by_title_from_SciHub(title):
 	url = "https://sci-hub.se/"
 
-crossref_response_times = []
+CROSSREF_WORKS_URL = "https://api.crossref.org/works/"
+# Crossref work records ("message" of /works/<DOI>, or an item of a title search) by normalized DOI.
+# The title search, the reference count and the abstract stages all read from here, so each work is requested at most once.
+crossref_works = {}
+
+def add_crossref_work(work):
+	if work.get("DOI"):
+		crossref_works[normalize_DOI(work["DOI"])] = work
+
+@coalesced(lambda DOI: normalize_DOI(DOI), keep_results=False)
+def get_crossref_work(DOI):
+	# Returns the Crossref record of DOI, only fetching /works/<DOI> if no stage has seen it yet. None if there is no DOI.
+	if not DOI:
+		return None
+	if normalize_DOI(DOI) not in crossref_works:
+		html, headers = get_html_from_url(CROSSREF_WORKS_URL + normalize_DOI(DOI) + "?mailto=frederik.bay2@gmail.com")
+		add_crossref_work(json.loads(html)["message"])
+	return crossref_works.get(normalize_DOI(DOI))
+
+JATS_HEADING_RE = re.compile(r"<(jats:)?title>\s*(abstract|summary)\s*</(jats:)?title>", flags=re.I)
+JATS_BLOCK_TAG_RE = re.compile(r"</?(?:jats:)?(?:p|sec|title|list|list-item)\b[^>]*>")
+JATS_TAG_RE = re.compile(r"</?[\w:.-]+(?:\s[^>]*)?/?>")
+
+def jats_to_text(jats):
+	# Crossref abstracts are JATS XML: <jats:p> paragraphs, often with a <jats:title>Abstract</jats:title> heading and inline <jats:italic> etc.
+	text = JATS_HEADING_RE.sub(" ", jats)
+	text = JATS_BLOCK_TAG_RE.sub(" ", text)
+	text = JATS_TAG_RE.sub("", text)
+	return " ".join(unescape(text).split())
+
+def get_abstract_by_crossref(DOI):
+	work = get_crossref_work(DOI)
+	return jats_to_text(work["abstract"]) if work and work.get("abstract") else ""
+
+@coalesced(lambda title="", author=None: (normalize_title(title), normalize_title(author)))
 def get_DOI_by_title_author_from_crossref(title = "", author = None):
 	DOI = None
 	url = "https://api.crossref.org/works?mailto=frederik.bay2@gmail.com&rows=1" + bool(title) * f"&query.title={title}" + bool(author) * f"&query.author={author}"
-	
-	# If response times are getting longer, sleep a bit
-	# if len(crossref_response_times) > 0 and crossref_response_times[-1] > 10 and crossref_response_times[-1] > 1.10 * statistics.median(crossref_response_times):
-	# 	print(f"Crossref response time is going up (current: {round(crossref_response_times[-1], 2)}s, median: {round(statistics.median(crossref_response_times), 2)}s)")
-	# 	# time.sleep(statistics.median(crossref_response_times))
-	# 	# time.sleep(2)
-	try:
-		time_0 = time.perf_counter()
-		html, headers = get_html_from_url(url)
-		if time.perf_counter() - time_0 > 0.2: crossref_response_times.append(time.perf_counter() - time_0)
-	except urllib.error.HTTPError as e:
-		if e.code == 504:
-			print("504 Gateway Time-out error. Retrying...")
-			time.sleep(5)
-			try:
-				time_0 = time.perf_counter()
-				html, headers = get_html_from_url(url)
-				if time.perf_counter() - time_0 > 0.2: crossref_response_times.append(time.perf_counter() - time_0)
-			except urllib.error.HTTPError as e:
-				if e.code == 504:
-					print("504 again. Retrying one last time...")
-					time.sleep(30)
-					time_0 = time.perf_counter()
-					html, headers = get_html_from_url(url)
-					if time.perf_counter() - time_0 > 0.2: crossref_response_times.append(time.perf_counter() - time_0)
-				else:
-					raise
-				
-		else:
-			raise
+	html, headers = get_html_from_url(url)
 	
 	if headers["x-api-pool"] != "polite":
 		print("Not in polite API pool.")
@@ -202,12 +1214,14 @@ def get_DOI_by_title_author_from_crossref(title = "", author = None):
 		if get_simple_overlap_score(title, result_title) >= 0.90:
 			# Titles are assumed to be the same
 			DOI = result["message"]["items"][0]["DOI"]
+			add_crossref_work(result["message"]["items"][0])  # Search items are full work records, so the later stages don't fetch it again
 	
 	return DOI
 
 def is_valid_DOI_format(DOI):
 	return re.match(r"^10.\d{4,9}/[-._;()/:A-Z0-9]+$", DOI, flags=re.I)
 
+@coalesced(lambda DOI: normalize_DOI(DOI))
 def get_PMID_from_DOI(DOI):
 	# Pre-check that it is a valid DOI
 	if not is_valid_DOI_format(DOI):
@@ -225,6 +1239,7 @@ def get_PMID_from_DOI(DOI):
 			PMID = result[0]
 	return PMID
 
+@coalesced(lambda title: normalize_title(title))
 def get_PMID_by_title(title):
 	PMID = None
 	url = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?tool=windows&email=frederik.bay2@gmail.com&retmax=1&term="' + title + '"[Title:~0]'
@@ -237,12 +1252,110 @@ def get_PMID_by_title(title):
 	return PMID
 
 def get_abstract_by_PMID(PMID):
-	abstract = None
-	url = "https://pubmed.ncbi.nlm.nih.gov/" + PMID
-	html, headers = get_html_from_url(url)
-	abstract = next(iter(re.findall(r"\<div.*?class=\"abstract\".*?\<(?:p|em).*?\>[\s\n]*(.*)[\s\n]*\<\/(?:p|em).*?\>[\s\n]*\<\/div", html, flags=re.S | re.I)), None)
+	# Uses the PubMed XML record from efetch instead of scraping the pubmed.ncbi.nlm.nih.gov page
+	abstract = get_abstracts_by_PMIDs([PMID]).get(PMID) or None
 	return abstract
 
+
+NCBI_DOI_BATCH_SIZE = 100  # DOIs per esearch request (keeps the GET URL well below NCBI's length limit)
+NCBI_EFETCH_BATCH_SIZE = 200  # PMIDs per efetch request
+
+OPENCITATIONS_COUNT_URL = "https://opencitations.net/index/coci/api/v1/citation-count/"
+
+@coalesced(lambda DOI: normalize_DOI(DOI))
+def get_citation_count(DOI):
+	# Uses the count-only endpoint (a few bytes, instead of the full list of citing works from /citations/ that is megabytes for reviews).
+	# Only the integer is cached, under the count URL, so it expires with the opencitations TTL.
+	url = OPENCITATIONS_COUNT_URL + DOI
+	cached = get_url_cache().get(url)
+	metrics.increment("url_cache_lookups_total", source=get_cache_source(url), result="hit" if cached else "miss")
+	if cached:
+		return int(cached[0])
+	html, headers = get_html_from_url(url, retrieve_from_cache=False, save_to_cache=False)
+	result = json.loads(html)
+	if not result:
+		return None
+	citation_count = int(result[0]["count"])
+	get_url_cache().put(url, str(citation_count), {})
+	return citation_count
+
+def get_PMIDs_from_DOIs(DOIs):
+	# Resolve many DOIs to PMIDs with two requests per batch: one esearch for all the DOIs and one esummary to map the returned PMIDs back to their DOIs.
+	# Returns {DOI: PMID} for every DOI in a batch that succeeded, with "" if the DOI wasn't found. DOIs matching several PMIDs are left empty, like in get_PMID_from_DOI.
+	PMIDs = {}
+	DOIs = list(dict.fromkeys(DOI for DOI in DOIs if DOI and is_valid_DOI_format(DOI)))
+	for i_batch in range(0, len(DOIs), NCBI_DOI_BATCH_SIZE):
+		batch = DOIs[i_batch:i_batch + NCBI_DOI_BATCH_SIZE]
+		try:
+			term = " OR ".join(f'"{DOI}"[doi]' for DOI in batch)
+			url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?tool=windows&email=frederik.bay2@gmail.com&db=pubmed&retmode=json&retmax=" + str(2 * len(batch)) + "&term=" + quote(term)
+			html, headers = get_html_from_url(url)
+			ids = json.loads(html)["esearchresult"]["idlist"]
+			
+			matches = {DOI.lower(): [] for DOI in batch}
+			if ids:
+				url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?tool=windows&email=frederik.bay2@gmail.com&db=pubmed&retmode=json&id=" + ",".join(ids)
+				html, headers = get_html_from_url(url)
+				summaries = json.loads(html)["result"]
+				for uid in summaries.get("uids", []):
+					for article_id in summaries[uid].get("articleids", []):
+						if article_id.get("idtype") == "doi" and article_id.get("value", "").lower() in matches:
+							matches[article_id["value"].lower()].append(uid)
+			
+			for DOI in batch:
+				uids = set(matches[DOI.lower()])
+				PMIDs[DOI] = uids.pop() if len(uids) == 1 else ""
+		except Exception as e:
+			print(f"Batch of {len(batch)} DOIs could not be resolved to PMIDs: {e}.")
+	return PMIDs
+
+def iter_pubmed_records(source):
+	# Stream through PubMed XML (efetch output or a baseline file) and yield {"pmid", "doi", "title", "abstract"} per article ("" when missing).
+	# Elements are cleared as soon as they have been read, so large files are never held in memory.
+	for event, elem in ElementTree.iterparse(source, events=("end",)):
+		if elem.tag not in ("PubmedArticle", "PubmedBookArticle"):
+			continue
+		PMID = elem.findtext("MedlineCitation/PMID") or elem.findtext("BookDocument/PMID")
+		abstract_parts = []
+		for abstract_text in elem.iterfind(".//Abstract/AbstractText"):
+			text = "".join(abstract_text.itertext()).strip()
+			label = abstract_text.get("Label")
+			abstract_parts.append(f"{label}: {text}" if label and text else text)
+		title = next((title for title in map(elem.find, ("MedlineCitation/Article/ArticleTitle", "BookDocument/ArticleTitle", "BookDocument/Book/BookTitle")) if title is not None), None)
+		# The article's own IDs (the ArticleIdLists in ReferenceList are those of its references)
+		DOI = next((article_id.text for article_id in elem.iterfind("PubmedData/ArticleIdList/ArticleId") if article_id.get("IdType") == "doi"), None) \
+			or next((article_id.text for article_id in elem.iterfind("PubmedBookData/ArticleIdList/ArticleId") if article_id.get("IdType") == "doi"), None) \
+			or next((location.text for location in elem.iterfind("MedlineCitation/Article/ELocationID") if location.get("EIdType") == "doi"), None)
+		if PMID:
+			yield {
+				"pmid": PMID.strip(),
+				"doi": (DOI or "").strip(),
+				"title": " ".join("".join(title.itertext()).split()) if title is not None else "",
+				"abstract": " ".join(part for part in abstract_parts if part),
+			}
+		elem.clear()
+
+def parse_pubmed_abstracts_xml(source):
+	# {PMID: abstract}, with "" for records without an abstract
+	return {record["pmid"]: record["abstract"] for record in iter_pubmed_records(source)}
+
+def get_abstracts_by_PMIDs(PMIDs):
+	# Fetch abstracts for up to NCBI_EFETCH_BATCH_SIZE PMIDs per efetch call.
+	# Returns {PMID: abstract} for every PMID in a batch that succeeded, with "" if PubMed has no abstract.
+	abstracts = {}
+	PMIDs = list(dict.fromkeys(PMID for PMID in PMIDs if PMID))
+	for i_batch in range(0, len(PMIDs), NCBI_EFETCH_BATCH_SIZE):
+		batch = PMIDs[i_batch:i_batch + NCBI_EFETCH_BATCH_SIZE]
+		try:
+			url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?tool=windows&email=frederik.bay2@gmail.com&db=pubmed&retmode=xml&id=" + ",".join(batch)
+			html, headers = get_html_from_url(url)
+			batch_abstracts = parse_pubmed_abstracts_xml(io.BytesIO(html.encode("utf-8")))
+			abstracts.update({PMID: batch_abstracts.get(PMID, "") for PMID in batch})
+		except Exception as e:
+			print(f"Batch of {len(batch)} abstracts could not be fetched: {e}.")
+	return abstracts
+
+@coalesced(lambda DOI: normalize_DOI(DOI))
 def get_abstract_by_DOI(DOI):
 	abstract = None
 	url = "http://dx.doi.org/" + DOI
@@ -251,206 +1364,600 @@ def get_abstract_by_DOI(DOI):
 	return abstract
 
 
-def get_DOIs(bibs, allow_copying_existing=False):
-	DOIs = {}
-	pbar = tqdm(total=len(bibs))
-	for bib_name, bib_entry in bibs.items():
-		pbar.set_description(bib_name)
-		DOI = bib_entry.get("doi", "") if allow_copying_existing else ""
-		title = bib_entry.get("title", "")
-		
-		DOI_result = ""
-		# Get DOI from Crossref
-		if title and (not DOI or DOI and not is_valid_DOI_format(DOI)):
-			try:
-				DOI_result = get_DOI_by_title_author_from_crossref(title, author=bib_entry.get("author", None))
-				if not DOI_result and "author" in bib_entry.keys():
-					# Try again without the author (making sure that the author field was in fact there before)
-					DOI_result = get_DOI_by_title_author_from_crossref(title)
-					if not DOI_result:
-						print(f"DOI could not be found from title.")
-			except Exception as e:
-				print(f"DOI could not be found from title: {e}.")
-		DOIs[bib_name] = DOI_result if DOI_result else DOI
-		pbar.update()
-	pbar.set_description("DOIs")
-	pbar.close()
-	return DOIs
+OFFLINE_INDEX_PATH = "metadata_index.sqlite"  # Built with "python citationvalidator.py index <dump files>". Used whenever the file exists.
+OFFLINE_TITLE_MIN_OVERLAP = 0.90  # Same rule as for the Crossref title search
+OFFLINE_TITLE_MAX_CANDIDATES = 10000
 
-def get_PMIDs(bibs, allow_copying_existing=False):
-	PMIDs = {}
-	pbar = tqdm(total=len(bibs))
-	for bib_name, bib_entry in bibs.items():
-		pbar.set_description(bib_name)
-		PMID = bib_entry.get("pmid", "") if allow_copying_existing else ""
-		DOI = bib_entry.get("doi", "")
-		title = bib_entry.get("title", "")
-		
-		PMID_result = ""
-		# Get PMID from DOI
-		if DOI and not PMID:
-			try:
-				PMID_result = get_PMID_from_DOI(DOI)
-				if not PMID_result:
-					print(f"PMID could not be found from DOI.")
-			except Exception as e:
-				print(f"PMID could not be found from DOI: {e}.")
-		
-		# Get PMID from title if PMID is still not found
-		if title and not PMID_result and not PMID:
-			try:
-				PMID_result = get_PMID_by_title(title)
-				if not PMID_result:
-					print(f"PMID could not be found from title.")
-			except Exception as e:
-				print(f"PMID could not be found from title: {e}.")
-		
-		PMIDs[bib_name] = PMID_result if PMID_result else PMID
-		pbar.update()
-	pbar.set_description("PMIDs")
-	pbar.close()
-	return PMIDs
 
-def get_reference_and_citation_counts(bibs, allow_copying_existing=False):
-	reference_counts = {}
-	citation_counts = {}
-	pbar = tqdm(total=len(bibs))
-	for bib_name, bib_entry in bibs.items():
-		pbar.set_description(bib_name)
-		PMID = bib_entry.get("pmid", "")
-		DOI = bib_entry.get("doi", "")
-		title = bib_entry.get("title", "")
-		reference_count = bib_entry.get("reference_count", "") if allow_copying_existing else ""
-		citation_count = bib_entry.get("citation_count", "") if allow_copying_existing else ""
-		
-		reference_count_result, citation_count_result = "", ""
-		
-		# Get reference count from Crossref and citation count from Opencitations
-		# Get reference count from Crossref
-		if DOI and not reference_count:
-			try:
-				url = "https://api.crossref.org/works/" + DOI + "?mailto=frederik.bay2@gmail.com"
-				html, headers = get_html_from_url(url)
-				result = json.loads(html)
-				reference_count_result = str(result["message"]["reference-count"])
-				if not reference_count_result:
-					print(f"Reference count could not be found.")
-			except Exception as e:
-				print(f"Reference count could not be found: {e}.")
-			
-		if not reference_count and not reference_count_result:  # If still no result, use the Python API
-			print("Using Python Crossref API instead of URL")
-			try:
-				crossref_result = crossref_commons.retrieval.get_publication_as_json(DOI)
-				reference_count_result = str(crossref_result["reference-count"])
-				if not reference_count_result:
-					print(f"Reference count could not be found.")
-			except Exception as e:
-				print(f"Reference count could not be found: {e}.")
-		
-		# # Get citation count from Google Scholar/Scholarly
-		# if False:
-		# 	try:
-		# 		s = next(scholarly.search_pubs(bib["doi"]))
-		# 		citation_count = str(s["num_citations"])
-		# 	except Exception as e:
-		# 		print("\n" * no_prints_yet + "Citation count could not be found:", e);  no_prints_yet = False
-		
-		# Get citation count from Opencitations
-		if DOI and not citation_count:
-			try:
-				url = "https://opencitations.net/index/coci/api/v1/citations/" + DOI
-				html, headers = get_html_from_url(url)
-				citation_result = json.loads(html)
-				citation_count_result = str(len(citation_result))
-				if not citation_count_result:
-					print(f"Citation count could not be found.")
-			except Exception as e:
-				print(f"Citation count could not be found: {e}.")
-		
-		reference_counts[bib_name] = reference_count_result if reference_count_result else reference_count
-		citation_counts[bib_name] = citation_count_result if citation_count_result else citation_count
-		pbar.update()
-	pbar.set_description("Ref & cite counts")
-	pbar.close()
+def iter_crossref_records(source):
+	# Stream through a Crossref JSONL snapshot (one work per line, bare or as {"message": work}) and yield records like iter_pubmed_records
+	for line in source:
+		line = line.strip()
+		if not line:
+			continue
+		work = json.loads(line)
+		work = work.get("message", work)
+		if not work.get("DOI"):
+			continue
+		yield {
+			"pmid": "",
+			"doi": work["DOI"],
+			"title": " ".join(" ".join(work.get("title") or []).split()),
+			"abstract": jats_to_text(work["abstract"]) if work.get("abstract") else "",
+		}
+
+
+def iter_dump_records(filename):
+	# PubMed baseline/update files (.xml, .xml.gz) or Crossref snapshots (.jsonl, .jsonl.gz)
+	open_file = gzip.open if filename.endswith(".gz") else open
+	if re.search(r"\.xml(\.gz)?$", filename):
+		with open_file(filename, "rb") as f:
+			yield from iter_pubmed_records(f)
+	elif re.search(r"\.(jsonl|ndjson|json)(\.gz)?$", filename):
+		with open_file(filename, "rt", encoding="utf-8") as f:
+			yield from iter_crossref_records(f)
+	else:
+		raise ValueError(f"Unknown dump format: {filename} (expected PubMed .xml[.gz] or Crossref .jsonl[.gz])")
+
+
+class MetadataIndex:
+	# On-disk index of works (DOI, PMID, title, abstract) from PubMed and Crossref dumps, for lookups without the network.
+	# Records with the same DOI or PMID are merged, so a PubMed and a Crossref record of the same work complement each other.
+	# Titles are also kept in a full-text index for fuzzy title lookups.
+	def __init__(self, path=OFFLINE_INDEX_PATH):
+		self.path = path
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(path, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("CREATE TABLE IF NOT EXISTS works (id INTEGER PRIMARY KEY, doi TEXT, normalized_doi TEXT, pmid TEXT, title TEXT, normalized_title TEXT, abstract TEXT)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS works_normalized_doi ON works (normalized_doi)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS works_pmid ON works (pmid)")
+		self.connection.execute("CREATE INDEX IF NOT EXISTS works_normalized_title ON works (normalized_title)")
+		# The titles are stored as their \w+ words (the same tokens as get_simple_overlap_score), split on spaces only
+		self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS title_index USING fts5(words, content='', tokenize=\"unicode61 remove_diacritics 0 tokenchars '_'\")")
+		self.connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS title_vocabulary USING fts5vocab(title_index, 'row')")
+		self.connection.commit()
+	
+	@staticmethod
+	def title_words(title):
+		return list(dict.fromkeys(re.findall(r"\w+", title.lower())))
+	
+	def add_records(self, records):
+		# Returns the number of records read
+		num_records = 0
+		with self.lock:
+			self.connection.execute("PRAGMA synchronous=OFF")
+			for record in records:
+				num_records += 1
+				DOI = record["doi"].strip()
+				row = self.connection.execute("SELECT id, doi, pmid, title, abstract FROM works WHERE normalized_doi = ?", (normalize_DOI(DOI),)).fetchone() if DOI else None
+				if row is None and record["pmid"]:
+					row = self.connection.execute("SELECT id, doi, pmid, title, abstract FROM works WHERE pmid = ?", (record["pmid"],)).fetchone()
+				if row is None:
+					work_id = self.connection.execute("INSERT INTO works (doi, normalized_doi, pmid, title, normalized_title, abstract) VALUES (?, ?, ?, ?, ?, ?)",
+						(DOI, normalize_DOI(DOI), record["pmid"], record["title"], normalize_title(record["title"]), record["abstract"])).lastrowid
+					if record["title"]:
+						self.connection.execute("INSERT INTO title_index (rowid, words) VALUES (?, ?)", (work_id, " ".join(self.title_words(record["title"]))))
+					continue
+				# Fill in what the existing record is missing
+				work_id, old_DOI, old_PMID, old_title, old_abstract = row
+				self.connection.execute("UPDATE works SET doi = ?, normalized_doi = ?, pmid = ?, title = ?, normalized_title = ?, abstract = ? WHERE id = ?",
+					(old_DOI or DOI, normalize_DOI(old_DOI or DOI), old_PMID or record["pmid"], old_title or record["title"], normalize_title(old_title or record["title"]), old_abstract or record["abstract"], work_id))
+				if not old_title and record["title"]:
+					self.connection.execute("INSERT INTO title_index (rowid, words) VALUES (?, ?)", (work_id, " ".join(self.title_words(record["title"]))))
+				if num_records % 100000 == 0:
+					self.connection.commit()
+			self.connection.commit()
+			self.connection.execute("PRAGMA synchronous=FULL")
+		return num_records
+	
+	def get(self, column, value, field=None):
+		# With field, only a record that has it
+		with self.lock:
+			row = self.connection.execute(f"SELECT doi, pmid, title, abstract FROM works WHERE {column} = ?" + (f" AND {field} != ''" if field else ""), (value,)).fetchone()
+		return dict(zip(("doi", "pmid", "title", "abstract"), row)) if row else None
+	
+	def get_by_DOI(self, DOI):
+		return self.get("normalized_doi", normalize_DOI(DOI)) if DOI else None
+	
+	def get_by_PMID(self, PMID):
+		return self.get("pmid", PMID.strip()) if PMID else None
+	
+	def find_by_title(self, title, field=None):
+		# The record whose title contains at least OFFLINE_TITLE_MIN_OVERLAP of the words of title (get_simple_overlap_score), or None.
+		# With field, only the records that have it are considered.
+		# A title with n words can only miss n - ceil(0.9 n) of them, so every match contains at least one of the rarest n - ceil(0.9 n) + 1 words,
+		# and only the titles containing those are scored.
+		if not title:
+			return None
+		exact = self.get("normalized_title", normalize_title(title), field)
+		if exact:
+			return exact
+		words = self.title_words(title)
+		if not words:
+			return None
+		num_rare_words = len(words) - math.ceil(OFFLINE_TITLE_MIN_OVERLAP * len(words) - 1e-9) + 1
+		with self.lock:
+			document_counts = {word: (self.connection.execute("SELECT doc FROM title_vocabulary WHERE term = ?", (word,)).fetchone() or [0])[0] for word in words}
+			rare_words = sorted(words, key=document_counts.get)[:num_rare_words]
+			if not any(document_counts[word] for word in rare_words):
+				return None
+			query = " OR ".join('"' + word.replace('"', '""') + '"' for word in rare_words)
+			rows = self.connection.execute("SELECT works.doi, works.pmid, works.title, works.abstract FROM title_index JOIN works ON works.id = title_index.rowid WHERE title_index MATCH ? LIMIT ?",
+				(query, OFFLINE_TITLE_MAX_CANDIDATES)).fetchall()
+		# The best match is the one with the highest overlap, and then the fewest extra words
+		best_score, best_row = None, None
+		for row in rows:
+			if field and not row[("doi", "pmid", "title", "abstract").index(field)]:
+				continue
+			score = (get_simple_overlap_score(title, row[2]), get_simple_overlap_score(row[2], title))
+			if score[0] >= OFFLINE_TITLE_MIN_OVERLAP and (best_score is None or score > best_score):
+				best_score, best_row = score, row
+		return dict(zip(("doi", "pmid", "title", "abstract"), best_row)) if best_row else None
+	
+	def close(self):
+		self.connection.close()
+
+
+offline_index = None
+offline_index_lock = threading.Lock()
+def get_offline_index():
+	# The index at OFFLINE_INDEX_PATH, or None if it hasn't been built
+	global offline_index
+	with offline_index_lock:
+		if offline_index is None and OFFLINE_INDEX_PATH and os.path.exists(OFFLINE_INDEX_PATH):
+			offline_index = MetadataIndex(OFFLINE_INDEX_PATH)
+		return offline_index
+
+
+def lookup_offline(DOI="", PMID="", title="", field=None):
+	# The offline index record of a work, found by PMID, DOI or (fuzzy) title, in that order. None without an index or on a miss.
+	# With field, a record without it (e.g. a Crossref record without a PMID or abstract) doesn't end the search.
+	index = get_offline_index()
+	if index is None:
+		return None
+	for value, find in ((PMID, index.get_by_PMID), (DOI, index.get_by_DOI)):
+		record = find(value) if value else None
+		if record and (field is None or record[field]):
+			return record
+	return index.find_by_title(title, field) if title else None
+
+def get_offline_field(field, DOI="", PMID="", title=""):
+	record = lookup_offline(DOI, PMID, title, field)
+	return record[field] if record else ""
+
+
+def build_offline_index(filenames, index_path=OFFLINE_INDEX_PATH):
+	index = MetadataIndex(index_path)
+	for filename in filenames:
+		time_0 = time.perf_counter()
+		num_records = index.add_records(iter_dump_records(filename))
+		print(f"{filename}: {num_records} records ({round(time.perf_counter() - time_0, 1)}s)")
+	with index.lock:
+		print(f"{index_path}: {index.connection.execute('SELECT COUNT(*) FROM works').fetchone()[0]} works")
+	index.close()
+
+
+ENRICHMENT_CHECKPOINT_PATH = "enrichment_state.jsonl"
+# The bib fields each enrichment stage depends on. A checkpointed result is reused as long as these fields are unchanged.
+CHECKPOINT_STAGE_FIELDS = {
+	"doi": ("title", "author", "doi"),
+	"pmid": ("doi", "title", "pmid"),
+	"counts": ("doi", "reference_count", "citation_count"),
+	"abstract": ("pmid", "doi", "abstract"),
+}
+CHECKPOINT_TTLS = {"counts": 7 * 24 * 3600}  # Citation counts go stale, so they are fetched again after a week
+
+
+class EnrichmentCheckpoint:
+	# Saves the result of every entry of every enrichment stage as soon as it is found, by appending a JSON line to a state file.
+	# A rerun (e.g. after the network dropped) skips the entries whose inputs haven't changed since they were enriched.
+	# Only successful results are saved, so failed lookups are tried again.
+	def __init__(self, path=ENRICHMENT_CHECKPOINT_PATH):
+		self.path = path
+		self.records = {}  # (stage, inputs hash): record
+		self.lock = threading.Lock()
+		num_lines = 0
+		if os.path.exists(path):
+			with open(path, "r", encoding="utf-8") as state_file:
+				for line in state_file:
+					num_lines += 1
+					try:
+						record = json.loads(line)
+					except json.JSONDecodeError:  # E.g. a line cut off when the run was killed
+						continue
+					self.records[(record["stage"], record["inputs"])] = record
+		if num_lines > 2 * len(self.records) + 100:
+			self.compact()
+		self.file = open(path, "a", encoding="utf-8")
+		if self.file.tell() and num_lines:
+			with open(path, "rb") as state_file:
+				state_file.seek(-1, os.SEEK_END)
+				if state_file.read(1) != b"\n":  # Start a new line after a cut-off last line
+					self.file.write("\n")
+	
+	@staticmethod
+	def hash_inputs(stage, bib_entry, allow_copying_existing):
+		inputs = [bib_entry.get(field, "") for field in CHECKPOINT_STAGE_FIELDS[stage]] + [allow_copying_existing]
+		return hashlib.sha1(json.dumps(inputs).encode("utf-8")).hexdigest()
+	
+	def get(self, stage, inputs_hash):
+		# Returns the saved result, or None if there is none (or it has expired)
+		record = self.records.get((stage, inputs_hash))
+		if record is None or stage in CHECKPOINT_TTLS and time.time() - record["time"] > CHECKPOINT_TTLS[stage]:
+			return None
+		return record["result"]
+	
+	def put(self, stage, inputs_hash, bib_name, result):
+		record = {"stage": stage, "inputs": inputs_hash, "bib_name": bib_name, "result": result, "time": time.time()}
+		with self.lock:
+			self.records[(stage, inputs_hash)] = record
+			self.file.write(json.dumps(record) + "\n")
+			self.file.flush()
+	
+	def compact(self):
+		# Rewrite the state file with only the latest record per stage and inputs
+		with open(self.path + ".tmp", "w", encoding="utf-8") as state_file:
+			for record in self.records.values():
+				state_file.write(json.dumps(record) + "\n")
+		os.replace(self.path + ".tmp", self.path)
+	
+	def close(self):
+		self.file.close()
+
+
+def run_checkpointed(stage, fetch, bibs, checkpoint=None, allow_copying_existing=False, is_complete=bool):
+	# Runs fetch(pending_bibs, on_result) only for the entries without a checkpointed result, and saves each complete result as it comes in.
+	# Returns the results of all bibs in the same order as bibs.
+	if checkpoint is None:
+		return fetch(bibs, None)
+	inputs_hashes = {bib_name: checkpoint.hash_inputs(stage, bib_entry, allow_copying_existing) for bib_name, bib_entry in bibs.items()}
+	results = {bib_name: checkpoint.get(stage, inputs_hash) for bib_name, inputs_hash in inputs_hashes.items()}
+	results = {bib_name: result for bib_name, result in results.items() if result is not None}
+	if results:
+		print(f"{len(results)} / {len(bibs)} entries are unchanged since they were last enriched ({checkpoint.path})")
+	
+	def on_result(bib_name, result):
+		if is_complete(result):
+			checkpoint.put(stage, inputs_hashes[bib_name], bib_name, result)
+	
+	pending_bibs = {bib_name: bib_entry for bib_name, bib_entry in bibs.items() if bib_name not in results}
+	if pending_bibs:
+		results.update(fetch(pending_bibs, on_result))
+	return {bib_name: results[bib_name] for bib_name in bibs}
+
+
+def get_DOI(bib_entry, allow_copying_existing=False):
+	DOI = bib_entry.get("doi", "") if allow_copying_existing else ""
+	title = bib_entry.get("title", "")
+	
+	DOI_result = ""
+	# Get DOI from the offline index, or else from Crossref
+	if title and (not DOI or DOI and not is_valid_DOI_format(DOI)):
+		DOI_result = get_offline_field("doi", title=title)
+		if DOI_result:
+			return DOI_result
+		try:
+			DOI_result = get_DOI_by_title_author_from_crossref(title, author=bib_entry.get("author", None))
+			if not DOI_result and "author" in bib_entry.keys():
+				# Try again without the author (making sure that the author field was in fact there before)
+				DOI_result = get_DOI_by_title_author_from_crossref(title)
+				if not DOI_result:
+					print(f"DOI could not be found from title.")
+		except Exception as e:
+			print(f"DOI could not be found from title: {e}.")
+	return DOI_result if DOI_result else DOI
+
+@timed()
+def get_DOIs(bibs, allow_copying_existing=False, max_workers=None, checkpoint=None):
+	def fetch(pending_bibs, on_result):
+		return run_concurrently(lambda bib_entry: get_DOI(bib_entry, allow_copying_existing), pending_bibs, "DOIs", max_workers, on_result)
+	return run_checkpointed("doi", fetch, bibs, checkpoint, allow_copying_existing)
+
+def get_PMID(bib_entry, allow_copying_existing=False, prefetched_PMIDs=None):
+	PMID = bib_entry.get("pmid", "") if allow_copying_existing else ""
+	DOI = bib_entry.get("doi", "")
+	title = bib_entry.get("title", "")
+	
+	PMID_result = ""
+	# Get PMID from the offline index
+	if not PMID:
+		PMID_result = get_offline_field("pmid", DOI=DOI, title=title)
+		if PMID_result:
+			return PMID_result
+	
+	# Get PMID from DOI (from the batched lookup if this DOI was part of it)
+	if DOI and not PMID:
+		try:
+			PMID_result = prefetched_PMIDs[DOI] if prefetched_PMIDs and DOI in prefetched_PMIDs else get_PMID_from_DOI(DOI)
+			if not PMID_result:
+				print(f"PMID could not be found from DOI.")
+		except Exception as e:
+			print(f"PMID could not be found from DOI: {e}.")
+	
+	# Get PMID from title if PMID is still not found
+	if title and not PMID_result and not PMID:
+		try:
+			PMID_result = get_PMID_by_title(title)
+			if not PMID_result:
+				print(f"PMID could not be found from title.")
+		except Exception as e:
+			print(f"PMID could not be found from title: {e}.")
+	
+	return PMID_result if PMID_result else PMID
+
+@timed()
+def get_PMIDs(bibs, allow_copying_existing=False, max_workers=None, use_batches=True, checkpoint=None):
+	def fetch(pending_bibs, on_result):
+		prefetched_PMIDs = {}
+		if use_batches:
+			print("Resolving DOIs to PMIDs in batches...")
+			prefetched_PMIDs = get_PMIDs_from_DOIs([bib_entry.get("doi", "") for bib_entry in pending_bibs.values()
+				if not (allow_copying_existing and bib_entry.get("pmid")) and not get_offline_field("pmid", DOI=bib_entry.get("doi", ""), title=bib_entry.get("title", ""))])
+		return run_concurrently(lambda bib_entry: get_PMID(bib_entry, allow_copying_existing, prefetched_PMIDs), pending_bibs, "PMIDs", max_workers, on_result)
+	return run_checkpointed("pmid", fetch, bibs, checkpoint, allow_copying_existing)
+
+def get_reference_and_citation_count(bib_entry, allow_copying_existing=False):
+	PMID = bib_entry.get("pmid", "")
+	DOI = bib_entry.get("doi", "")
+	title = bib_entry.get("title", "")
+	reference_count = bib_entry.get("reference_count", "") if allow_copying_existing else ""
+	citation_count = bib_entry.get("citation_count", "") if allow_copying_existing else ""
+	
+	reference_count_result, citation_count_result = "", ""
+	
+	# Get reference count from Crossref and citation count from Opencitations
+	# Get reference count from Crossref
+	if DOI and not reference_count:
+		try:
+			reference_count_result = str(get_crossref_work(DOI)["reference-count"])
+			if not reference_count_result:
+				print(f"Reference count could not be found.")
+		except Exception as e:
+			print(f"Reference count could not be found: {e}.")
+	
+	# # Get citation count from Google Scholar/Scholarly
+	# if False:
+	# 	try:
+	# 		s = next(scholarly.search_pubs(bib["doi"]))
+	# 		citation_count = str(s["num_citations"])
+	# 	except Exception as e:
+	# 		print("\n" * no_prints_yet + "Citation count could not be found:", e);  no_prints_yet = False
+	
+	# Get citation count from Opencitations
+	if DOI and not citation_count:
+		try:
+			citation_count_result = get_citation_count(DOI)
+			citation_count_result = str(citation_count_result) if citation_count_result is not None else ""
+			if not citation_count_result:
+				print(f"Citation count could not be found.")
+		except Exception as e:
+			print(f"Citation count could not be found: {e}.")
+	
+	return reference_count_result if reference_count_result else reference_count, citation_count_result if citation_count_result else citation_count
+
+@timed()
+def get_reference_and_citation_counts(bibs, allow_copying_existing=False, max_workers=None, checkpoint=None):
+	def fetch(pending_bibs, on_result):
+		return run_concurrently(lambda bib_entry: get_reference_and_citation_count(bib_entry, allow_copying_existing), pending_bibs, "Ref & cite counts", max_workers, on_result)
+	counts = run_checkpointed("counts", fetch, bibs, checkpoint, allow_copying_existing, is_complete=all)
+	reference_counts = {bib_name: reference_count for bib_name, [reference_count, citation_count] in counts.items()}
+	citation_counts = {bib_name: citation_count for bib_name, [reference_count, citation_count] in counts.items()}
 	return reference_counts, citation_counts
 
 
-def get_abstracts(bibs, allow_copying_existing=True):
-	abstracts = {}
-	fails = {}
-	pbar = tqdm(total=len(bibs))
-	for bib_name, bib_entry in bibs.items():
-		pbar.set_description(bib_name)
-		abstract = bib_entry.get("abstract", "") if allow_copying_existing else ""
-		PMID = bib_entry.get("pmid", "")
-		DOI = bib_entry.get("doi", "")
-		title = bib_entry.get("title", "")
-		
-		no_prints_yet = True
-		
-		abstract_result = ""
-		abstract_status = False  # bool(abstract)
-		
-		# If the abstract is already in the bib, copy it
-		if not abstract_status and allow_copying_existing and abstract:
-			abstract_result = abstract
+def get_abstract(bib_entry, allow_copying_existing=True, prefetched_abstracts=None):
+	abstract = bib_entry.get("abstract", "") if allow_copying_existing else ""
+	PMID = bib_entry.get("pmid", "")
+	DOI = bib_entry.get("doi", "")
+	title = bib_entry.get("title", "")
+	
+	no_prints_yet = True
+	
+	abstract_result = ""
+	abstract_status = False  # bool(abstract)
+	
+	# If the abstract is already in the bib, copy it
+	if not abstract_status and allow_copying_existing and abstract:
+		abstract_result = abstract
+		abstract_status = True
+	
+	# Get abstract from the offline index
+	if not abstract_status and (PMID or DOI or title):
+		abstract_result = get_offline_field("abstract", DOI=DOI, PMID=PMID, title=title)
+		if abstract_result:
+			abstract = abstract_result
 			abstract_status = True
-		
-		# If PMID: Get abstract from PMID
-		if not abstract_status and PMID:
-			abstract_result = get_abstract_by_PMID(PMID)
+	
+	# If PMID: Get abstract from PMID
+	if not abstract_status and PMID:
+		abstract_result = prefetched_abstracts[PMID] if prefetched_abstracts and PMID in prefetched_abstracts else get_abstract_by_PMID(PMID)
+		if not abstract_result:
+			abstract += "Abstract via PMID failed. "
+			print("\n" * no_prints_yet + "PMID failed.");  no_prints_yet = False
+		elif "No abstract available" in abstract_result:
+			abstract += "PMID: 'No abstract available'. "
+			print("\n" * no_prints_yet + "PMID: 'No abstract available'.");  no_prints_yet = False
+		else:
+			abstract = abstract_result
+			abstract_status = True
+	# else:
+	# 	abstract += "No PMID. "
+	
+	# Try the abstract in the Crossref record (often there when PubMed doesn't have the work)
+	if not abstract_status and DOI:
+		try:
+			abstract_result = get_abstract_by_crossref(DOI)
 			if not abstract_result:
-				abstract += "Abstract via PMID failed. "
-				print("\n" * no_prints_yet + "PMID failed.");  no_prints_yet = False
-			elif "No abstract available" in abstract_result:
-				abstract += "PMID: 'No abstract available'. "
-				print("\n" * no_prints_yet + "PMID: 'No abstract available'.");  no_prints_yet = False
+				abstract += "No abstract in Crossref. "
 			else:
 				abstract = abstract_result
 				abstract_status = True
-		# else:
-		# 	abstract += "No PMID. "
-			
-		# Try scraping DOI landing page for abstract
-		if not abstract_status and DOI:
-			print("\n" * no_prints_yet + "Trying DOI.", end="");  no_prints_yet = False
-			try:
-				abstract_result = get_abstract_by_DOI(DOI)
-				if not abstract_result:
-					abstract += "DOI failed. "
-					print(f"\rDOI failed.")
-				else:
-					abstract = abstract_result
-					abstract_status = True
-					print(" Successful.")
-			except Exception as e:
-				abstract += f"DOI failed: {e}. "
-				print(f"\rDOI failed:", e)
-		# else:
-		# 	abstract += "No DOI. "
-		
-		if not abstract_status:  # Add "ERROR" in the beginning if abstract couldn't be found
-			abstract = "ERROR: " + abstract
-		
-		abstract = clean_text(abstract)
-		
-		abstracts[bib_name] = abstract
-		if not abstract_status:
-			fails[bib_name] = abstract
-		
-		pbar.update()
-	pbar.set_description("Abstracts")
-	pbar.close()
+		except Exception as e:
+			abstract += f"Crossref failed: {e}. "
+			print("\n" * no_prints_yet + "Crossref abstract failed:", e);  no_prints_yet = False
+	
+	# Try scraping DOI landing page for abstract
+	if not abstract_status and DOI:
+		print("\n" * no_prints_yet + "Trying DOI.", end="");  no_prints_yet = False
+		try:
+			abstract_result = get_abstract_by_DOI(DOI)
+			if not abstract_result:
+				abstract += "DOI failed. "
+				print(f"\rDOI failed.")
+			else:
+				abstract = abstract_result
+				abstract_status = True
+				print(" Successful.")
+		except Exception as e:
+			abstract += f"DOI failed: {e}. "
+			print(f"\rDOI failed:", e)
+	# else:
+	# 	abstract += "No DOI. "
+	
+	if not abstract_status:  # Add "ERROR" in the beginning if abstract couldn't be found
+		abstract = "ERROR: " + abstract
+	
+	abstract = clean_text(abstract)
+	return abstract, abstract_status
+
+@timed()
+def get_abstracts(bibs, allow_copying_existing=True, max_workers=None, use_batches=True, checkpoint=None):
+	def fetch(pending_bibs, on_result):
+		prefetched_abstracts = {}
+		if use_batches:
+			print("Fetching PubMed abstracts in batches...")
+			prefetched_abstracts = get_abstracts_by_PMIDs([bib_entry.get("pmid", "") for bib_entry in pending_bibs.values()
+				if not (allow_copying_existing and bib_entry.get("abstract")) and not get_offline_field("abstract", DOI=bib_entry.get("doi", ""), PMID=bib_entry.get("pmid", ""), title=bib_entry.get("title", ""))])
+		return run_concurrently(lambda bib_entry: get_abstract(bib_entry, allow_copying_existing, prefetched_abstracts), pending_bibs, "Abstracts", max_workers, on_result)
+	results = run_checkpointed("abstract", fetch, bibs, checkpoint, allow_copying_existing, is_complete=lambda result: result[1])
+	return split_abstract_results(results)
+
+def split_abstract_results(results):
+	# {bib_name: (abstract, abstract_status)} -> {bib_name: abstract}, printing the entries whose abstract couldn't be found
+	abstracts = {bib_name: abstract for bib_name, [abstract, abstract_status] in results.items()}
+	fails = {bib_name: abstract for bib_name, [abstract, abstract_status] in results.items() if not abstract_status}
 	
 	if fails:
-		print(f"Some abstracts couldn't be found:  {len(fails)} / {len(bibs)} ({round(len(fails) / len(bibs) * 100, 1)}%)")
+		print(f"Some abstracts couldn't be found:  {len(fails)} / {len(results)} ({round(len(fails) / len(results) * 100, 1)}%)")
 		print(tabulate([[bib_name, err_msg] for bib_name, err_msg in fails.items()], headers=["Bib name", "Error message"]))
 	# print(f"Number of failed abstracts: {len(fails)} / {len(bibs)} ({round(len(fails) / len(bibs) * 100, 1)}%)")
 	
 	return abstracts
 
 
+PIPELINE_BATCH_WAIT = 0.2  # Seconds that entries wait for other entries to join a batched NCBI lookup (unless no other entry can join it)
+# The lookups each stage starts when it is done. PMIDs and counts only need the DOI, abstracts need the PMID (and DOI).
+PIPELINE_NEXT_STAGES = {"doi": ("pmid", "counts"), "pmid": ("abstract",), "counts": (), "abstract": ()}
+PIPELINE_UPSTREAM_STAGES = {"pmid": ("doi",), "abstract": ("doi", "pmid")}
+
+
+@timed()
+def run_enrichment_pipeline(bibs, allow_copying_existing=True, max_workers=None, checkpoint=None, use_batches=True):
+	# Moves every entry through DOI -> PMID -> abstract and DOI -> reference/citation counts, starting each lookup as soon as its inputs are found,
+	# instead of waiting for the slowest entry of every stage (so one entry's abstract is fetched while another's DOI is still being searched).
+	# The later stages use the entry's DOI and PMID, or the ones found for it if it had none. The esearch/efetch batching of get_PMIDs and
+	# get_abstracts is kept by grouping the entries that reach those stages at about the same time; no worker is held up while a batch fills.
+	# Returns DOIs, PMIDs, reference_counts, citation_counts, abstracts: the same dicts as get_DOIs, get_PMIDs, get_reference_and_citation_counts and get_abstracts.
+	stage_functions = {
+		"doi": lambda bib_entry, prefetched: get_DOI(bib_entry, allow_copying_existing),
+		"pmid": lambda bib_entry, prefetched: get_PMID(bib_entry, allow_copying_existing, prefetched),
+		"counts": lambda bib_entry, prefetched: get_reference_and_citation_count(bib_entry, allow_copying_existing),
+		"abstract": lambda bib_entry, prefetched: get_abstract(bib_entry, allow_copying_existing, prefetched),
+	}
+	# Batch function, the field it looks up and the batch size, and which entries use it (the same ones as in get_PMIDs and get_abstracts: not those the offline index has)
+	batch_lookups = {
+		"pmid": (get_PMIDs_from_DOIs, "doi", NCBI_DOI_BATCH_SIZE),
+		"abstract": (get_abstracts_by_PMIDs, "pmid", NCBI_EFETCH_BATCH_SIZE),
+	} if use_batches else {}
+	uses_batch = {
+		"pmid": lambda bib_entry: bib_entry.get("doi") and not (allow_copying_existing and bib_entry.get("pmid")) and not get_offline_field("pmid", DOI=bib_entry["doi"], title=bib_entry.get("title", "")),
+		"abstract": lambda bib_entry: bib_entry.get("pmid") and not (allow_copying_existing and bib_entry.get("abstract")) and not get_offline_field("abstract", DOI=bib_entry.get("doi", ""), PMID=bib_entry["pmid"], title=bib_entry.get("title", "")),
+	}
+	is_complete = {"doi": bool, "pmid": bool, "counts": all, "abstract": lambda result: result[1]}
+	
+	entries = {bib_name: dict(bib_entry) for bib_name, bib_entry in bibs.items()}  # Copies that get the DOI and PMID found for them
+	results = {stage: {} for stage in PIPELINE_NEXT_STAGES}
+	in_progress = {stage: 0 for stage in PIPELINE_NEXT_STAGES}  # Entries started but not finished, per stage
+	batch_queues = {stage: [] for stage in batch_lookups}  # (bib_name, bib_entry, inputs_hash) waiting for a batched lookup
+	batch_queue_times = {}
+	futures = {}
+	pbar = tqdm(total=len(bibs) * len(PIPELINE_NEXT_STAGES))
+	executor = ThreadPoolExecutor(max_workers=max_workers or FETCH_MAX_WORKERS)
+	
+	def start(stage, bib_name):
+		in_progress[stage] += 1
+		bib_entry = dict(entries[bib_name])
+		inputs_hash = checkpoint.hash_inputs(stage, bib_entry, allow_copying_existing) if checkpoint is not None else None
+		result = checkpoint.get(stage, inputs_hash) if checkpoint is not None else None
+		if result is not None:
+			finish(stage, bib_name, result)
+		elif stage in batch_queues and uses_batch[stage](bib_entry):
+			if not batch_queues[stage]:
+				batch_queue_times[stage] = time.monotonic()
+			batch_queues[stage].append((bib_name, bib_entry, inputs_hash))
+		else:
+			futures[executor.submit(stage_functions[stage], bib_entry, None)] = (stage, bib_name, inputs_hash)
+	
+	def finish(stage, bib_name, result, inputs_hash=None):
+		results[stage][bib_name] = result
+		in_progress[stage] -= 1
+		if inputs_hash is not None and is_complete[stage](result):
+			checkpoint.put(stage, inputs_hash, bib_name, result)
+		if stage in ("doi", "pmid") and result and not entries[bib_name].get(stage, "").strip():
+			# Like add_prop_to_bib_entries, only a missing DOI/PMID is filled in: a different one is only used once the user accepts it
+			# (update_discrepancies), so until then the later lookups keep using the entry's own
+			entries[bib_name][stage] = result
+		pbar.set_description(f"{stage}: {bib_name}")
+		pbar.update()
+		for next_stage in PIPELINE_NEXT_STAGES[stage]:
+			start(next_stage, bib_name)
+	
+	def submit_batches():
+		# A batch is looked up when it is full, when it has waited PIPELINE_BATCH_WAIT, or when no entry is left that could still join it
+		now = time.monotonic()
+		for stage, queue in batch_queues.items():
+			batch_function, key_field, batch_size = batch_lookups[stage]
+			can_grow = any(in_progress[upstream_stage] for upstream_stage in PIPELINE_UPSTREAM_STAGES[stage])
+			while queue and (len(queue) >= batch_size or not can_grow or now - batch_queue_times[stage] >= PIPELINE_BATCH_WAIT):
+				batch, queue[:] = queue[:batch_size], queue[batch_size:]
+				futures[executor.submit(batch_function, [bib_entry[key_field] for bib_name, bib_entry, inputs_hash in batch])] = ("batch", stage, batch)
+				batch_queue_times[stage] = now
+	
+	try:
+		for bib_name in bibs:
+			start("doi", bib_name)
+		while futures or any(batch_queues.values()):
+			submit_batches()
+			timeout = min((batch_queue_times[stage] + PIPELINE_BATCH_WAIT - time.monotonic() for stage, queue in batch_queues.items() if queue), default=None)
+			done, _ = wait(futures, timeout=max(timeout, 0) if timeout is not None else None, return_when=FIRST_COMPLETED)
+			for future in done:
+				task = futures.pop(future)
+				if task[0] == "batch":
+					# Start the entries' own lookups with the batched results (those missing from it, e.g. after a failed batch, are looked up one by one)
+					_, stage, batch = task
+					batch_results = future.result()
+					key_field = batch_lookups[stage][1]
+					for bib_name, bib_entry, inputs_hash in batch:
+						key = bib_entry[key_field]
+						prefetched = {key: batch_results[key]} if key in batch_results else None
+						futures[executor.submit(stage_functions[stage], bib_entry, prefetched)] = (stage, bib_name, inputs_hash)
+				else:
+					stage, bib_name, inputs_hash = task
+					finish(stage, bib_name, future.result(), inputs_hash)
+	except BaseException:
+		executor.shutdown(wait=False, cancel_futures=True)
+		raise
+	executor.shutdown()
+	pbar.set_description("Enrichment")
+	pbar.close()
+	
+	results = {stage: {bib_name: stage_results[bib_name] for bib_name in bibs} for stage, stage_results in results.items()}
+	reference_counts = {bib_name: reference_count for bib_name, [reference_count, citation_count] in results["counts"].items()}
+	citation_counts = {bib_name: citation_count for bib_name, [reference_count, citation_count] in results["counts"].items()}
+	return results["doi"], results["pmid"], reference_counts, citation_counts, split_abstract_results(results["abstract"])
+
+
 def go(bib, allow_copying_existing_abstract=True):
 	# crossref_result = crossref_commons.retrieval.get_publication_as_json("10.1038/cr.2007.113")
 	# abstracts.append(crossref_result)
@@ -514,6 +2021,17 @@ def go(bib, allow_copying_existing_abstract=True):
 			abstract = abstract_result
 			abstract_status = True
 	
+	# Try the abstract in the Crossref record
+	if not abstract_status and DOI:
+		try:
+			abstract_result = get_abstract_by_crossref(DOI)
+			if abstract_result:
+				abstract = abstract_result
+				abstract_status = True
+		except Exception as e:
+			abstract += f"Crossref failed: {e}. "
+			print("\n" * no_prints_yet + "Crossref abstract failed:", e);  no_prints_yet = False
+	
 	# Try scraping DOI landing page for abstract
 	if not abstract_status and ("doi" in bib.keys() and bib["doi"].strip() != "" or DOI):
 		print("\n" * no_prints_yet + "Trying DOI.", end="");  no_prints_yet = False
@@ -568,8 +2086,7 @@ def go(bib, allow_copying_existing_abstract=True):
 		# Get reference count from Crossref
 		if "reference_count" in bib.keys() and bib["reference_count"].strip() == "" or "reference_count" not in bib.keys():
 			try:
-				crossref_result = crossref_commons.retrieval.get_publication_as_json(bib["doi"])
-				reference_count = str(crossref_result["reference-count"])
+				reference_count = str(get_crossref_work(bib["doi"])["reference-count"])
 			except Exception as e:
 				print("\n" * no_prints_yet + "Reference count could not be found:", e);  no_prints_yet = False
 		
@@ -584,10 +2101,8 @@ def go(bib, allow_copying_existing_abstract=True):
 		# Get citation count from Opencitations
 		if "citation_count" in bib.keys() and bib["citation_count"].strip() == "" or "citation_count" not in bib.keys():
 			try:
-				url = "https://opencitations.net/index/coci/api/v1/citations/" + bib["doi"]
-				html, headers = get_html_from_url(url)
-				citation_result = json.loads(html)
-				citation_count = str(len(citation_result))
+				citation_count_result = get_citation_count(bib["doi"])
+				citation_count = str(citation_count_result) if citation_count_result is not None else ""
 			except Exception as e:
 				print("\n" * no_prints_yet + "Citation count could not be found:", e);  no_prints_yet = False
 	
@@ -605,6 +2120,7 @@ def run_go(bibs, allow_copying_existing_abstract=True, multiprocessing=False):
 	bib_names = list(bibs)
 	print("Fetching abstracts")
 	if multiprocessing:
+		from dynamic_multiprocessing import dynamic_multiprocessing
 		for i_bib, go_result in enumerate(dynamic_multiprocessing(bibs.values(), go, True, max_processes=3, tqdm_desc="Bibs")):
 			bib_name = bib_names[i_bib]
 			abstracts[bib_name], DOIs[bib_name], PMIDs[bib_name], abstract_status, reference_counts[bib_name], citation_counts[bib_name] = go_result
@@ -628,26 +2144,248 @@ def run_go(bibs, allow_copying_existing_abstract=True, multiprocessing=False):
 	return abstracts, DOIs, PMIDs, reference_counts, citation_counts
 
 
+DUPLICATE_TITLE_THRESHOLD = 0.7  # Jaccard similarity of the character 5-grams of two normalized titles for them to count as the same work (a typo in a 60-character title gives 0.85)
+DUPLICATE_MIN_TITLE_WORDS = 3  # Shorter titles ("Editorial", "Correction") are only matched on DOI/PMID
+DUPLICATE_AUTHOR_THRESHOLD = 0.6  # Share of the last names of the shorter author list that the other entry must also have for matching titles to count ("Smith and others" vs. the full list gives 1.0, one name of two 0.5). Entries without authors are matched on the title alone.
+DUPLICATE_AUTHOR_ONLY_THRESHOLD = 0.8  # Jaccard similarity of the last names of two entries from the same year for them to count as the same work whatever their titles (a retitled or translated version)
+DUPLICATE_MIN_AUTHORS = 3  # Fewer authors are too common a combination to match entries on their authors and year alone
+MINHASH_SHINGLE_SIZE = 5
+MINHASH_NUM_HASHES = 100
+MINHASH_BAND_SIZE = 4  # Hashes per LSH band: titles with similarity s share a band with probability 1 - (1 - s^4)^25 (0.997 for s = 0.7, 0.18 for s = 0.3)
+MINHASH_CHUNK_SIZE = 65536  # Bytes of text
+MINHASH_MAX_SHINGLE_SHARE = 0.05  # Shingles in more of the texts are too common to pick candidates with
+MINHASH_MAX_BUCKET_SIZE = 50  # Pairs are only made between entries this close together in a bucket of identical bands
+
+
+def get_title_shingles(title):
+	return {title[i:i + MINHASH_SHINGLE_SIZE] for i in range(max(1, len(title) - MINHASH_SHINGLE_SIZE + 1))}
+
+def get_author_last_names(authors):
+	# {"muller", "garcia", ...} from a BibTeX author field ("Last, First and First Last and ... and others")
+	names = [name.split(",")[0] if "," in name else (name.split() or [""])[-1] for name in re.split(r"\s+and\s+", authors or "")]
+	return set(normalize_titles(names)) - {"", "others"}
+
+ASCII_PUNCTUATION_TO_SPACE_KEEP_TABS = str.maketrans({chr(i): " " for i in range(128) if not chr(i).isalnum() and chr(i) not in "\t\n"})
+
+def get_author_last_name_lines(author_fields):
+	# The normalized last names of many author fields at once, with a few passes over all of them: one line per field, the names separated by tabs
+	# (as get_author_last_names, but in order and with "others" kept)
+	text = "\n".join(" ".join((authors or "").split()) for authors in author_fields)
+	text = re.sub(r"\\(?:[a-zA-Z]+|.)|[{}]", "", text).replace(" and ", "\t")
+	text = re.sub(r"(?<![^\t\n])[^\t\n,]* (?=[^ \t\n,]+(?:[\t\n]|\Z))", "", text)  # "First Last": only the last word
+	text = re.sub(r",[^\t\n]*", "", text)  # "Last, First": only what comes before the comma
+	text = text.lower().translate(ASCII_PUNCTUATION_TO_SPACE_KEEP_TABS)
+	if not text.isascii():
+		text = re.sub(r"[^\w\s]+", " ", text)
+	return re.sub(r" *([\t\n]) *", r"\1", re.sub(r"  +", " ", text)).split("\n")
+
+def get_jaccard_score(set1, set2):
+	return len(set1 & set2) / len(set1 | set2) if set1 or set2 else 0.0
+
+def get_overlap_score(set1, set2):
+	# The share of the smaller set that is also in the other one
+	return len(set1 & set2) / min(len(set1), len(set2)) if set1 and set2 else 0.0
+
+
+def get_shingles(encoded_texts):
+	# The hashed byte shingles of all texts in one array, and the index in it where each text's shingles start.
+	# The texts must all be at least MINHASH_SHINGLE_SIZE bytes long.
+	import numpy as np
+	data = np.frombuffer(b"\n".join(encoded_texts), dtype=np.uint8)
+	shingles = data[:len(data) - MINHASH_SHINGLE_SIZE + 1].astype(np.uint32)
+	for i_byte in range(1, MINHASH_SHINGLE_SIZE):
+		shingles *= np.uint32(16777619)
+		shingles += data[i_byte:len(data) - MINHASH_SHINGLE_SIZE + 1 + i_byte]
+	# Drop the shingles that span the separator between two texts, and mix the bits of the rest so that one multiplication per hash function is enough
+	separators = np.cumsum([len(text) + 1 for text in encoded_texts[:-1]], dtype=np.int64)
+	in_text = np.ones(len(shingles), dtype=bool)
+	in_text[(separators[:, None] + np.arange(-MINHASH_SHINGLE_SIZE, 0)).ravel()] = False
+	shingles = shingles[in_text]
+	shingles ^= shingles >> 16
+	shingles *= np.uint32(0x45D9F3B)
+	shingles ^= shingles >> 16
+	return shingles, np.concatenate([[0], separators - np.arange(1, len(encoded_texts)) * MINHASH_SHINGLE_SIZE])
+
+
+def get_minhash_signatures(texts):
+	# One row of MINHASH_NUM_HASHES min-hashes per text, over the hashed byte shingles of the text. The texts are hashed in chunks
+	# of about MINHASH_CHUNK_SIZE bytes, which stay in the CPU cache for all hash functions, and the minimum of every hash function
+	# per text is taken with np.minimum.reduceat. The texts must all be at least MINHASH_SHINGLE_SIZE bytes long.
+	import numpy as np
+	encoded_texts = [text.encode("utf-8") for text in texts]
+	chunk_bounds = [0]
+	chunk_size = 0
+	for i_text, text in enumerate(encoded_texts):
+		chunk_size += len(text) + 1
+		if chunk_size >= MINHASH_CHUNK_SIZE:
+			chunk_bounds.append(i_text + 1)
+			chunk_size = 0
+	if chunk_bounds[-1] < len(texts):
+		chunk_bounds.append(len(texts))
+	chunks = list(zip(chunk_bounds[:-1], chunk_bounds[1:]))
+	
+	# Shingles of very common words ("of the", "ation") would be the minimum in many unrelated titles and put them in the same LSH buckets,
+	# so they are left out, unless a text has nothing else. They are counted in 2^16 buckets, where collisions only make a shingle seem more common.
+	counts = np.zeros(2 ** 16, dtype=np.int64)
+	for i_first, i_end in chunks:
+		counts += np.bincount(get_shingles(encoded_texts[i_first:i_end])[0] >> 16, minlength=2 ** 16)
+	common = counts > max(MINHASH_MAX_SHINGLE_SHARE * len(texts), 100)
+	
+	rng = np.random.default_rng(0)
+	seeds = rng.integers(1, 2 ** 32, size=MINHASH_NUM_HASHES, dtype=np.uint64).astype(np.uint32)
+	multipliers = (rng.integers(1, 2 ** 31, size=MINHASH_NUM_HASHES, dtype=np.uint64) * 2 + 1).astype(np.uint32)
+	signatures = np.empty((len(texts), MINHASH_NUM_HASHES), dtype=np.uint32)
+	for i_first, i_end in chunks:
+		shingles, starts = get_shingles(encoded_texts[i_first:i_end])
+		keep = ~common[shingles >> 16]
+		keep |= np.repeat(np.add.reduceat(keep, starts) == 0, np.diff(np.append(starts, len(shingles))))
+		shingles = shingles[keep]
+		starts = np.concatenate([[0], np.cumsum(np.add.reduceat(keep, starts, dtype=np.int64))[:-1]])
+		hashes = np.empty_like(shingles)
+		for i_hash in range(MINHASH_NUM_HASHES):
+			np.bitwise_xor(shingles, seeds[i_hash], out=hashes)
+			np.multiply(hashes, multipliers[i_hash], out=hashes)
+			signatures[i_first:i_end, i_hash] = np.minimum.reduceat(hashes, starts)
+	return signatures
+
+
+def get_lsh_candidate_pairs(signatures, min_estimated_score=0.0):
+	# (i, j) arrays of the rows that have all hashes of at least one band in common,
+	# and whose share of equal hashes (an estimate of their Jaccard similarity) is at least min_estimated_score
+	import numpy as np
+	N = len(signatures)
+	pairs = [np.empty(0, dtype=np.int64)]
+	for i_band in range(0, signatures.shape[1] - MINHASH_BAND_SIZE + 1, MINHASH_BAND_SIZE):
+		keys = np.zeros(N, dtype=np.uint64)
+		for i_hash in range(i_band, i_band + MINHASH_BAND_SIZE):
+			keys = (keys * np.uint64(0x100000001B3)) ^ signatures[:, i_hash].astype(np.uint64)
+		order = np.argsort(keys)
+		sorted_keys = keys[order]
+		for offset in range(1, min(MINHASH_MAX_BUCKET_SIZE, N)):
+			same = np.flatnonzero(sorted_keys[offset:] == sorted_keys[:-offset])
+			if not len(same):
+				break
+			i, j = order[same], order[same + offset]
+			estimated_scores = np.count_nonzero(signatures[i] == signatures[j], axis=1) / signatures.shape[1]
+			i, j = i[estimated_scores >= min_estimated_score], j[estimated_scores >= min_estimated_score]
+			# Each pair as one number, so that pairs found in several bands can be dropped with a 1-D np.unique
+			pairs.append(np.minimum(i, j).astype(np.int64) * N + np.maximum(i, j))
+	pairs = np.unique(np.concatenate(pairs))
+	return pairs // N, pairs % N
+
+
+@timed()
+def find_duplicate_bibs(bibs, title_threshold=DUPLICATE_TITLE_THRESHOLD):
+	# Clusters of bib entries that are probably the same work, found without comparing all pairs:
+	# entries with the same (normalized) DOI or PMID are grouped by hashing, and near-duplicate titles are found with MinHash/LSH
+	# and then checked with the exact Jaccard similarity of their 5-grams and the overlap of their authors. Entries from the same year
+	# with (nearly) the same authors are also found with MinHash/LSH, over their last names, so retitled and translated versions are grouped too.
+	# Returns [{"bib_names", "matched_on", "title_score", "author_score", "DOIs"}], with the lowest title and author similarity within each cluster
+	# (author_score is None if some of the entries have no authors).
+	bib_names = list(bibs)
+	parents = list(range(len(bib_names)))
+	def find(i):
+		while parents[i] != i:
+			parents[i] = parents[parents[i]]
+			i = parents[i]
+		return i
+	matched_on = collections.defaultdict(set)
+	def union(i, j, reason):
+		root_i, root_j = find(i), find(j)
+		parents[root_j] = root_i
+		matched_on[i].add(reason)
+		matched_on[j].add(reason)
+	
+	# Exact matches
+	for field, normalize in (("doi", normalize_DOI), ("pmid", str.strip)):
+		first_with_value = {}
+		for i, bib_name in enumerate(bib_names):
+			value = normalize(bibs[bib_name].get(field, ""))
+			if value in first_with_value:
+				union(first_with_value[value], i, field.upper())
+			elif value:
+				first_with_value[value] = i
+	
+	# Near-duplicate titles
+	titles = normalize_titles([bibs[bib_name].get("title", "") for bib_name in bib_names])
+	titled = [i for i, title in enumerate(titles) if title.count(" ") >= DUPLICATE_MIN_TITLE_WORDS - 1]
+	shingles = {}
+	authors = {}
+	best_authored_matches = {}  # Entry without authors: (title_score, entry with authors)
+	def get_authors(i):
+		if i not in authors:
+			authors[i] = get_author_last_names(bibs[bib_names[i]].get("author", ""))
+		return authors[i]
+	if len(titled) > 1:
+		# The estimate from MINHASH_NUM_HASHES hashes (without the common shingles) is rough, so candidates are only dropped well below the threshold
+		i_pairs, j_pairs = get_lsh_candidate_pairs(get_minhash_signatures([titles[i] for i in titled]), title_threshold - 0.25)
+		for i_pair, j_pair in zip(i_pairs.tolist(), j_pairs.tolist()):
+			i, j = titled[i_pair], titled[j_pair]
+			for k in (i, j):
+				if k not in shingles:
+					shingles[k] = get_title_shingles(titles[k])
+			title_score = get_jaccard_score(shingles[i], shingles[j])
+			if title_score < title_threshold:
+				continue
+			# Different works with similar titles ("Erratum to ...", series of papers) have different authors. An entry without authors
+			# is only grouped with its best match among the entries with authors, so that it doesn't join the works of different authors.
+			if bool(get_authors(i)) != bool(get_authors(j)):
+				k, other = (i, j) if not authors[i] else (j, i)
+				if title_score > best_authored_matches.get(k, (0.0, None))[0]:
+					best_authored_matches[k] = (title_score, other)
+			elif not authors[i] or get_overlap_score(authors[i], authors[j]) >= DUPLICATE_AUTHOR_THRESHOLD:
+				union(i, j, "title")
+		for k, (title_score, other) in best_authored_matches.items():
+			union(other, k, "title")
+	
+	# The same authors in the same year, under another title. Only entries with enough authors are hashed, and the sets of last names
+	# are only made for the candidate pairs (counting the " and "s and hashing the lines of last names is much faster than parsing every field).
+	years = [bibs[bib_name].get("year", "").strip(" {}") for bib_name in bib_names]
+	with_authors = [i for i, bib_name in enumerate(bib_names) if years[i] and bibs[bib_name].get("author", "").count(" and ") >= DUPLICATE_MIN_AUTHORS - 1]
+	author_lines = dict(zip(with_authors, get_author_last_name_lines([bibs[bib_names[i]]["author"] for i in with_authors])))
+	with_authors = [i for i in with_authors if len(author_lines[i]) >= MINHASH_SHINGLE_SIZE]
+	if len(with_authors) > 1:
+		i_pairs, j_pairs = get_lsh_candidate_pairs(get_minhash_signatures([author_lines[i] for i in with_authors]), DUPLICATE_AUTHOR_ONLY_THRESHOLD - 0.25)
+		for i_pair, j_pair in zip(i_pairs.tolist(), j_pairs.tolist()):
+			i, j = with_authors[i_pair], with_authors[j_pair]
+			if years[i] == years[j] and min(len(get_authors(i)), len(get_authors(j))) >= DUPLICATE_MIN_AUTHORS and get_jaccard_score(authors[i], authors[j]) >= DUPLICATE_AUTHOR_ONLY_THRESHOLD:
+				union(i, j, "authors")
+	
+	clusters = collections.defaultdict(list)
+	for i in range(len(bib_names)):
+		if i in matched_on:
+			clusters[find(i)].append(i)
+	report = []
+	for members in clusters.values():
+		scored = members[:50]
+		member_shingles = [shingles.get(i) or get_title_shingles(titles[i]) for i in scored]
+		member_authors = [get_authors(i) for i in scored]
+		report.append({
+			"bib_names": [bib_names[i] for i in members],
+			"matched_on": sorted(set().union(*(matched_on[i] for i in members))),
+			"title_score": round(min(get_jaccard_score(a, b) for a, b in itertools.combinations(member_shingles, 2)), 3),
+			"author_score": round(min(get_jaccard_score(a, b) for a, b in itertools.combinations(member_authors, 2)), 3) if all(member_authors) else None,
+			"DOIs": sorted({bibs[bib_names[i]].get("doi", "") for i in members} - {""}),
+		})
+	return sorted(report, key=lambda cluster: (-cluster["title_score"], -len(cluster["bib_names"])))
+
+
 def find_matching_bibs(bibs):
-	# Check exact matches between DOIs
-	DOIs = {bib_name: bib_entry["doi"] for bib_name, bib_entry in bibs.items() if "doi" in bib_entry.keys()}
-	matching_DOIs = {}
-	for DOI in DOIs.values():
-		if sum([DOI == x for x in list(DOIs.values())]) > 1:  # If there are more than two identical DOIs in the list
-			matching_DOIs[DOI] = [bib_name for bib_name, bib_value in DOIs.items() if bib_value == DOI]
-	
-	print("Exact matching DOIs:")
-	for DOI, bib_names in matching_DOIs.items():
-		print(f"{DOI} : {", ".join(bib_names)}")
-	
-	# Compare titles (other properties)
-	...
+	# Print the clusters of duplicate entries (by DOI, PMID or title) and return them
+	clusters = find_duplicate_bibs(bibs)
+	if clusters:
+		N_matching_bibs = sum(len(cluster["bib_names"]) for cluster in clusters)
+		print(f"Some bib entries are probably duplicates:  {N_matching_bibs} / {len(bibs)} ({round(N_matching_bibs / len(bibs) * 100, 1)}%) in {len(clusters)} groups")
+		print(tabulate([[", ".join(cluster["bib_names"]), ", ".join(cluster["matched_on"]), cluster["title_score"], cluster["author_score"], ", ".join(cluster["DOIs"])] for cluster in clusters],
+			headers=["Bibs", "Matched on", "Title similarity", "Author similarity", "DOIs"], maxcolwidths=[60, None, None, None, 40]))
+	return clusters
 
 
 def TF_IDF_match_score_statement_vs_abstract(statement, abstract):
 	# Get a match score between the statement in a LaTeX file and the abstract of the following citation
 	# From https://stackoverflow.com/a/8897648
 	corpus = [statement, abstract]
+	from sklearn.feature_extraction.text import TfidfVectorizer
 	vect = TfidfVectorizer(min_df=1)
 	tfidf = vect.fit_transform(corpus)
 	pairwise_similarity = tfidf * tfidf.T
@@ -659,87 +2397,535 @@ def TF_IDF_match_score_statement_vs_abstract(statement, abstract):
 
 
 def citation_abstract_score_matching(statements: list, abstracts: dict):
-	used_bib_names = [bib_name for bib_name, _ in statements if bib_name in abstracts]
+	has_abstract = [bib_name in abstracts for bib_name, _ in statements]
+	TF_IDF_scores = iter(get_TF_IDF_scores([citation_and_statement for citation_and_statement, has in zip(statements, has_abstract) if has], abstracts))
 	
-	scores = []
 	collected_list = []
-	for bib_name, statement in tqdm(statements, ncols=100, file=sys.stdout):
-		if bib_name in abstracts:
-			
-			TF_IDF_score = TF_IDF_match_score_statement_vs_abstract(statement, abstracts[bib_name])
+	for [bib_name, statement], has in zip(statements, has_abstract):
+		if has:
+			TF_IDF_score = next(TF_IDF_scores)
 		else:  # no abstract
 			TF_IDF_score = -1
 			abstracts[bib_name] = ""  # Just to not get an error in collected_list
-		scores.append(TF_IDF_score)
 		collected_list.append([TF_IDF_score, bib_name, statement, abstracts[bib_name]])
 	
 	# collected_list = [[score, bib_name, statement, abstract] for score, [bib_name, statement], abstract in zip(scores, statements, abstracts)]
 	return collected_list
 
-def get_TF_IDF_scores(citations_and_statements: list, abstracts: dict):
-	scores = []
-	for bib_name, statement in tqdm(citations_and_statements, desc="TF_IDF", ncols=100, file=sys.stdout):
+
+TF_IDF_VECTORIZER_PATH = None  # E.g. "tf_idf_vectorizer.pkl" to keep the fitted vocabulary and IDF weights between runs
+
+def fit_TF_IDF_vectorizer(texts, vectorizer_path=None, refit=False):
+	# Fit one TfidfVectorizer on the whole corpus, or load the one saved at vectorizer_path (words that weren't in that corpus are then ignored)
+	if vectorizer_path and os.path.exists(vectorizer_path) and not refit:
+		with open(vectorizer_path, "rb") as vectorizer_file:
+			return pickle.load(vectorizer_file)
+	from sklearn.feature_extraction.text import TfidfVectorizer
+	vect = TfidfVectorizer(min_df=1)
+	vect.fit(texts)
+	if vectorizer_path:
+		with open(vectorizer_path, "wb") as vectorizer_file:
+			pickle.dump(vect, vectorizer_file)
+	return vect
+
+@timed()
+def get_TF_IDF_scores(citations_and_statements: list, abstracts: dict, vectorizer_path=TF_IDF_VECTORIZER_PATH, refit=False):
+	# The vectorizer is fitted once over all statements and abstracts (so the IDF weights are those of the whole corpus, not of each pair),
+	# and the cosine similarities of all pairs come from one row-wise product of the L2-normalised sparse TF-IDF rows.
+	import numpy as np
+	if not citations_and_statements:
+		return []
+	for bib_name, statement in citations_and_statements:
 		if bib_name not in abstracts:
 			abstracts[bib_name] = ""
-		score = TF_IDF_match_score_statement_vs_abstract(statement, abstracts[bib_name])
-		scores.append(score)
-	
-	return scores
+	texts = list(dict.fromkeys([statement for bib_name, statement in citations_and_statements] + [abstracts[bib_name] for bib_name, statement in citations_and_statements]))
+	text_index = {text: i_text for i_text, text in enumerate(texts)}
+	try:
+		vect = fit_TF_IDF_vectorizer(texts, vectorizer_path, refit)
+	except ValueError as e:  # E.g. only empty texts
+		print(f"TF-IDF vectorizer could not be fitted: {e}.")
+		return [0.0] * len(citations_and_statements)
+	tfidf = vect.transform(texts)
+	statement_rows = [text_index[statement] for bib_name, statement in citations_and_statements]
+	abstract_rows = [text_index[abstracts[bib_name]] for bib_name, statement in citations_and_statements]
+	scores = np.asarray(tfidf[statement_rows].multiply(tfidf[abstract_rows]).sum(axis=1)).ravel()
+	return scores.tolist()
 
 
-def get_BERT_scores(citations_and_statements: list, abstracts: dict):
-	model = SentenceTransformer('paraphrase-MiniLM-L6-v2')
-	scores = []
-	for bib_name, statement in tqdm(citations_and_statements, desc="BERT", ncols=100, file=sys.stdout):
+BERT_MODEL_NAME = 'paraphrase-MiniLM-L6-v2'
+BIOBERT_MODEL_NAME = 'pritamdeka/BioBERT-mnli-snli-scinli-scitail-mednli-stsb'
+EMBEDDING_BATCH_SIZE = 64
+
+EMBEDDING_CACHE_FOLDER = "cached_embeddings"
+EMBEDDING_CACHE_FLOAT16 = True  # Halves the size of the cache; the cosine similarities change by less than 0.001
+EMBEDDING_CACHE_MAX_CHUNKS = 20  # Chunks are merged into one when there are more than this
+
+# Inference backend of the embedding models:
+#   "torch": full precision, as downloaded
+#   "torch-int8": the Linear layers dynamically quantized to int8 (CPU only)
+#   "onnx": ONNX Runtime, through sentence-transformers >= 3.2 (pip install sentence-transformers[onnx]); the model is exported on the first load
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx")
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+EMBEDDING_MAX_SEQ_LENGTH = int(os.environ.get("EMBEDDING_MAX_SEQ_LENGTH", 0)) or None  # Tokens; longer texts (mostly abstracts) are truncated. None keeps the model's own limit.
+
+sentence_transformer_models = {}
+def get_sentence_transformer(model_name, backend=None, max_seq_length=None):
+	# Each model is only loaded once per process (for each backend and maximum sequence length)
+	backend = backend or EMBEDDING_BACKEND
+	max_seq_length = max_seq_length or EMBEDDING_MAX_SEQ_LENGTH
+	if (model_name, backend, max_seq_length) not in sentence_transformer_models:
+		from sentence_transformers import SentenceTransformer
+		if backend == "torch":
+			model = SentenceTransformer(model_name)
+		elif backend == "torch-int8":
+			import torch
+			model = torch.ao.quantization.quantize_dynamic(SentenceTransformer(model_name, device="cpu"), {torch.nn.Linear}, dtype=torch.qint8)
+		elif backend == "onnx":
+			model = SentenceTransformer(model_name, backend="onnx")
+		else:
+			raise ValueError(f"Unknown embedding backend {backend!r} (choose from {', '.join(EMBEDDING_BACKENDS)})")
+		if max_seq_length:
+			model.max_seq_length = max_seq_length
+		sentence_transformer_models[(model_name, backend, max_seq_length)] = model
+	return sentence_transformer_models[(model_name, backend, max_seq_length)]
+
+def get_embedding_variant(model_name, backend=None, max_seq_length=None):
+	# The name under which a model's embeddings are cached: other backends and truncation give (slightly) different embeddings
+	backend = backend or EMBEDDING_BACKEND
+	max_seq_length = max_seq_length or EMBEDDING_MAX_SEQ_LENGTH
+	if backend == "torch" and not max_seq_length:
+		return model_name
+	return f"{model_name}@{backend}" + (f"-{max_seq_length}" if max_seq_length else "")
+
+
+class EmbeddingStore:
+	# Persists the embeddings of one model, keyed by the hash of the text, in cached_embeddings/<model name>/.
+	# Every batch of new embeddings is saved as a chunk_<id>.npy file (one row per text) with a chunk_<id>.keys file (one text hash per line).
+	# The chunks are memory-mapped, so even a large cache loads without reading the vectors, and only the rows that are used get copied.
+	def __init__(self, model_name, folder=EMBEDDING_CACHE_FOLDER, float16=EMBEDDING_CACHE_FLOAT16):
+		import numpy as np
+		self.folder = os.path.join(folder, re.sub(r"[^\w.-]+", "_", model_name))
+		self.dtype = np.float16 if float16 else np.float32
+		self.chunks = []
+		self.index = {}  # Text hash: (chunk number, row)
+		self.lock = threading.Lock()
+		self.load()
+	
+	@staticmethod
+	def hash_text(text):
+		return hashlib.sha1(text.encode("utf-8")).hexdigest()
+	
+	def load(self):
+		import numpy as np
+		self.chunks, self.index = [], {}
+		if not os.path.isdir(self.folder):
+			return
+		for keys_filename in sorted(filename for filename in os.listdir(self.folder) if filename.endswith(".keys")):
+			chunk_filepath = os.path.join(self.folder, keys_filename[:-len(".keys")] + ".npy")
+			with open(os.path.join(self.folder, keys_filename), "r", encoding="utf-8") as keys_file:
+				keys = keys_file.read().split()
+			self.chunks.append(np.load(chunk_filepath, mmap_mode="r"))
+			for row, key in enumerate(keys):
+				self.index[key] = (len(self.chunks) - 1, row)
+	
+	def __contains__(self, text):
+		return self.hash_text(text) in self.index
+	
+	def get(self, texts):
+		# Returns a float32 array with one row per text. All texts must be in the store.
+		import numpy as np
+		locations = [self.index[self.hash_text(text)] for text in texts]
+		embeddings = np.empty((len(texts), self.chunks[0].shape[1] if self.chunks else 0), dtype=np.float32)
+		for i_chunk, chunk in enumerate(self.chunks):
+			positions = [i_text for i_text, (text_chunk, row) in enumerate(locations) if text_chunk == i_chunk]
+			if positions:
+				embeddings[positions] = chunk[[locations[i_text][1] for i_text in positions]]
+		return embeddings
+	
+	def add(self, texts, embeddings):
+		import numpy as np
+		if not len(texts):
+			return
+		with self.lock:
+			os.makedirs(self.folder, exist_ok=True)
+			chunk_name = f"chunk_{time.time_ns()}_{os.getpid()}"
+			self.write_chunk(chunk_name, [self.hash_text(text) for text in texts], np.asarray(embeddings, dtype=self.dtype))
+			self.load()
+			if len(self.chunks) > EMBEDDING_CACHE_MAX_CHUNKS:
+				self.compact()
+	
+	def write_chunk(self, chunk_name, keys, embeddings):
+		# The .keys file is written last: a chunk without one (e.g. after a crash) is ignored
+		import numpy as np
+		chunk_filepath = os.path.join(self.folder, chunk_name + ".npy")
+		with open(chunk_filepath + ".tmp", "wb") as chunk_file:
+			np.save(chunk_file, embeddings)
+		os.replace(chunk_filepath + ".tmp", chunk_filepath)
+		with open(os.path.join(self.folder, chunk_name + ".keys.tmp"), "w", encoding="utf-8") as keys_file:
+			keys_file.write("\n".join(keys) + "\n")
+		os.replace(os.path.join(self.folder, chunk_name + ".keys.tmp"), os.path.join(self.folder, chunk_name + ".keys"))
+	
+	def compact(self):
+		# Merge all chunks into a single one
+		import numpy as np
+		keys = list(self.index)
+		merged = np.empty((len(keys), self.chunks[0].shape[1]), dtype=self.dtype)
+		for i_key, key in enumerate(keys):
+			i_chunk, row = self.index[key]
+			merged[i_key] = self.chunks[i_chunk][row]
+		old_chunk_names = [filename[:-len(".keys")] for filename in os.listdir(self.folder) if filename.endswith(".keys")]
+		self.write_chunk(f"chunk_{time.time_ns()}_{os.getpid()}", keys, merged)
+		for chunk_name in old_chunk_names:
+			os.remove(os.path.join(self.folder, chunk_name + ".keys"))
+			os.remove(os.path.join(self.folder, chunk_name + ".npy"))
+		self.load()
+
+
+embedding_stores = {}
+def get_embedding_store(model_name):
+	# The store of the model with the current EMBEDDING_BACKEND and EMBEDDING_MAX_SEQ_LENGTH
+	variant = get_embedding_variant(model_name)
+	if variant not in embedding_stores:
+		embedding_stores[variant] = EmbeddingStore(variant)
+	return embedding_stores[variant]
+
+def encode_texts(model_name, texts, desc=None, use_cache=True):
+	# Returns the L2-normalised embeddings of texts (one row per text), so dot products are cosine similarities.
+	# Texts already in the model's EmbeddingStore aren't encoded again (and the model isn't even loaded if all of them are).
+	store = get_embedding_store(model_name) if use_cache else None
+	new_texts = [text for text in texts if text not in store] if store else list(texts)
+	variant = get_embedding_variant(model_name)
+	metrics.increment("embedding_texts_total", len(texts) - len(new_texts), model=variant, result="cached")
+	if new_texts:
+		model = get_sentence_transformer(model_name)
+		if desc: print(f"{desc}: encoding {len(new_texts)} new texts ({len(texts) - len(new_texts)} cached)")
+		time_0 = time.perf_counter()
+		new_embeddings = model.encode(new_texts, batch_size=EMBEDDING_BATCH_SIZE, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=bool(desc))
+		metrics.increment("embedding_encode_seconds_total", time.perf_counter() - time_0, model=variant)
+		metrics.increment("embedding_texts_total", len(new_texts), model=variant, result="encoded")
+		if not store:
+			return new_embeddings
+		store.add(new_texts, new_embeddings)
+	elif desc:
+		print(f"{desc}: all {len(texts)} texts were cached")
+	return store.get(texts)
+
+def get_embedding_scores(citations_and_statements: list, abstracts: dict, model_name, desc=None):
+	# Every unique statement and abstract is encoded once (a \cite{a,b,c} statement or a heavily cited abstract is not re-encoded),
+	# and the cosine similarities of all (statement, abstract) pairs are computed in one row-wise dot product.
+	import numpy as np
+	if not citations_and_statements:
+		return []
+	for bib_name, statement in citations_and_statements:
 		if bib_name not in abstracts:
 			abstracts[bib_name] = ""
-		embeddings = model.encode([statement, abstracts[bib_name]])
-		score = util.cos_sim(embeddings[0], embeddings[1]).item()
-		scores.append(score)
-	
-	return scores
+	texts = list(dict.fromkeys([statement for bib_name, statement in citations_and_statements] + [abstracts[bib_name] for bib_name, statement in citations_and_statements]))
+	text_index = {text: i_text for i_text, text in enumerate(texts)}
+	embeddings = encode_texts(model_name, texts, desc)
+	statement_rows = [text_index[statement] for bib_name, statement in citations_and_statements]
+	abstract_rows = [text_index[abstracts[bib_name]] for bib_name, statement in citations_and_statements]
+	scores = np.einsum("ij,ij->i", embeddings[statement_rows], embeddings[abstract_rows])
+	return scores.tolist()
+
+@timed()
+def get_BERT_scores(citations_and_statements: list, abstracts: dict):
+	return get_embedding_scores(citations_and_statements, abstracts, BERT_MODEL_NAME, desc="BERT")
 
 
+@timed()
 def get_BioBERT_scores(citations_and_statements: list, abstracts: dict):
-	model = SentenceTransformer('pritamdeka/BioBERT-mnli-snli-scinli-scitail-mednli-stsb')
-	scores = []
-	for bib_name, statement in tqdm(citations_and_statements, desc="BioBERT", ncols=100, file=sys.stdout):
-		if bib_name not in abstracts:
-			abstracts[bib_name] = ""
-		embeddings = model.encode([statement, abstracts[bib_name]])
-		score = util.cos_sim(embeddings[0], embeddings[1]).item()
-		scores.append(score)
-	
-	return scores
-
-
-def get_simple_overlap_score(text1, text2):
-	text1_words = re.findall(r"\w+", text1.lower(), flags=re.I)
-	text2_words = re.findall(r"\w+", text2.lower(), flags=re.I)
-	text1_words_set = set(text1_words)
-	text2_words_set = set(text2_words)
-	common_words = text1_words_set.intersection(text2_words_set)
-	text1_num_words = len(text1_words)
-	text2_num_words = len(text2_words)
-	score = len(common_words) / len(text1_words_set)
+	return get_embedding_scores(citations_and_statements, abstracts, BIOBERT_MODEL_NAME, desc="BioBERT")
+
+
+SENTENCE_LEVEL_SCORING = os.environ.get("SENTENCE_LEVEL_SCORING", "0") == "1"  # Also score statements against the single sentences of their abstracts (off by default, it encodes every abstract sentence)
+ABSTRACT_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9(\[])")  # After ., ! or ?, before a capital, number or bracket (so not inside "e.g. the")
+ABSTRACT_SENTENCE_MIN_WORDS = 4  # Shorter pieces ("BACKGROUND:", "Results.") are joined to the next sentence
+SENTENCE_SCORE_CHUNK_ROWS = 65536  # (statement, sentence) rows scored at a time, which bounds the memory of the gathered embeddings
+
+def split_abstract_sentences(abstract):
+	# The sentences of an abstract (at least one, so an empty abstract is one empty "sentence")
+	sentences = []
+	prefix = ""
+	for piece in ABSTRACT_SENTENCE_RE.split(abstract.strip()):
+		piece = prefix + piece
+		if len(piece.split()) < ABSTRACT_SENTENCE_MIN_WORDS:
+			prefix = piece + " "
+		else:
+			sentences.append(piece)
+			prefix = ""
+	if prefix:
+		if sentences:
+			sentences[-1] += " " + prefix.strip()
+		else:
+			sentences.append(prefix.strip())
+	return sentences or [""]
+
+def get_sentence_embedding_scores(citations_and_statements: list, abstracts: dict, model_name, desc=None):
+	# (max scores, top-2 mean scores): the cosine similarity of each statement with the best (and the mean of the two best) sentences of its abstract.
+	# All sentences of all abstracts and all statements are encoded in one encode_texts call (in large batches, and cached like whole texts).
+	# The sentences of each unique (statement, abstract) pair are one segment of a flat array of (statement, sentence) rows:
+	# the rows are scored with one row-wise dot product per chunk, then sorted by (segment, -score) to read off the two best of every segment.
+	import numpy as np
+	if not citations_and_statements:
+		return [], []
+	unique_abstracts = list(dict.fromkeys(abstracts.get(bib_name, "") for bib_name, statement in citations_and_statements))
+	abstract_sentences = [split_abstract_sentences(abstract) for abstract in unique_abstracts]
+	statements = [statement for bib_name, statement in citations_and_statements]
+	texts = list(dict.fromkeys(statements + [sentence for sentences in abstract_sentences for sentence in sentences]))
+	text_index = {text: i_text for i_text, text in enumerate(texts)}
+	embeddings = encode_texts(model_name, texts, desc)
+	
+	# Every abstract's sentences as a contiguous block of sentence_rows
+	sentence_rows = np.array([text_index[sentence] for sentences in abstract_sentences for sentence in sentences], dtype=np.int64)
+	abstract_lengths = np.array([len(sentences) for sentences in abstract_sentences], dtype=np.int64)
+	abstract_starts = np.concatenate([[0], np.cumsum(abstract_lengths)[:-1]])
+	abstract_index = {abstract: i_abstract for i_abstract, abstract in enumerate(unique_abstracts)}
+	pairs = list(dict.fromkeys((text_index[statement], abstract_index[abstracts.get(bib_name, "")]) for bib_name, statement in citations_and_statements))
+	pair_index = {pair: i_pair for i_pair, pair in enumerate(pairs)}
+	pair_statements = np.array([statement_row for statement_row, i_abstract in pairs], dtype=np.int64)
+	pair_abstracts = np.array([i_abstract for statement_row, i_abstract in pairs], dtype=np.int64)
+	pair_lengths = abstract_lengths[pair_abstracts]
+	
+	max_scores = np.empty(len(pairs), dtype=np.float32)
+	top_2_scores = np.empty(len(pairs), dtype=np.float32)
+	rows_before_pair = np.concatenate([[0], np.cumsum(pair_lengths)])
+	i_pair = 0
+	while i_pair < len(pairs):
+		# As many pairs as fit in SENTENCE_SCORE_CHUNK_ROWS rows (at least one)
+		end = max(i_pair + 1, int(np.searchsorted(rows_before_pair, rows_before_pair[i_pair] + SENTENCE_SCORE_CHUNK_ROWS, side="right")) - 1)
+		lengths = pair_lengths[i_pair:end]
+		segment_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+		segments = np.repeat(np.arange(len(lengths)), lengths)
+		positions = np.arange(len(segments)) - segment_starts[segments]  # Sentence number within its abstract
+		rows = sentence_rows[abstract_starts[pair_abstracts[i_pair:end]][segments] + positions]
+		scores = np.einsum("ij,ij->i", embeddings[pair_statements[i_pair:end][segments]], embeddings[rows])
+		order = np.lexsort((-scores, segments))
+		best = scores[order[segment_starts]]
+		second = scores[order[segment_starts + np.minimum(lengths, 2) - 1]]  # The best again for one-sentence abstracts
+		max_scores[i_pair:end] = best
+		top_2_scores[i_pair:end] = (best + second) / 2
+		i_pair = end
+	pair_rows = [pair_index[(text_index[statement], abstract_index[abstracts.get(bib_name, "")])] for bib_name, statement in citations_and_statements]
+	return max_scores[pair_rows].tolist(), top_2_scores[pair_rows].tolist()
+
+@timed()
+def get_sentence_score_columns(citations_and_statements: list, abstracts: dict):
+	# The CSV columns of the sentence-level BERT and BioBERT scores
+	columns = {}
+	for name, model_name in (("BERT", BERT_MODEL_NAME), ("BioBERT", BIOBERT_MODEL_NAME)):
+		max_scores, top_2_scores = get_sentence_embedding_scores(citations_and_statements, abstracts, model_name, desc=f"{name} sentences")
+		columns[f"{name} best sentence score"] = max_scores
+		columns[f"{name} top-2 sentences score"] = top_2_scores
+	return columns
+
+
+VECTOR_INDEX_EXACT_MAX_SIZE = 20000  # Up to this many abstracts, every statement is compared with every abstract
+VECTOR_INDEX_N_PROBE = 16  # Clusters searched per query in larger indexes (out of about sqrt(number of abstracts))
+VECTOR_INDEX_KMEANS_ITERATIONS = 10
+VECTOR_INDEX_QUERY_BATCH = 256  # Queries per matrix product, which bounds the memory used by the score matrices
+
+class AbstractIndex:
+	# Nearest-neighbour search by cosine similarity over L2-normalised embeddings (one row per bib entry).
+	# Up to VECTOR_INDEX_EXACT_MAX_SIZE rows, the queries are compared with all of them in batched matrix products. Larger indexes are
+	# split into about sqrt(N) clusters with spherical k-means (an inverted-file index): a query is only compared with the rows of the
+	# VECTOR_INDEX_N_PROBE clusters with the closest centroids, which finds most (not always all) of the true nearest neighbours.
+	def __init__(self, bib_names, embeddings, exact=None):
+		import numpy as np
+		self.bib_names = list(bib_names)
+		self.embeddings = np.asarray(embeddings, dtype=np.float32)
+		self.order = None  # Row in self.embeddings: row in bib_names, once the rows are sorted by cluster
+		self.centroids = None
+		self.cluster_starts = None
+		if exact is False or (exact is None and len(self.bib_names) > VECTOR_INDEX_EXACT_MAX_SIZE):
+			self.build_clusters()
+	
+	def build_clusters(self):
+		# k-means is trained on a sample of the rows, then every row is assigned to its closest centroid and the rows are sorted by cluster,
+		# so the rows of each cluster are one contiguous block
+		import numpy as np
+		rng = np.random.default_rng(0)
+		n_clusters = max(1, int(np.sqrt(len(self.embeddings))))
+		sample = self.embeddings[rng.choice(len(self.embeddings), min(len(self.embeddings), 64 * n_clusters), replace=False)]
+		centroids = sample[rng.choice(len(sample), n_clusters, replace=False)]
+		for _ in range(VECTOR_INDEX_KMEANS_ITERATIONS):
+			assignments = (sample @ centroids.T).argmax(axis=1)
+			sums = np.zeros_like(centroids)
+			np.add.at(sums, assignments, sample)
+			empty = np.bincount(assignments, minlength=n_clusters) == 0
+			sums[empty] = sample[rng.choice(len(sample), empty.sum())]  # Restart empty clusters from random rows
+			centroids = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+		assignments = np.concatenate([(self.embeddings[start:start + 8192] @ centroids.T).argmax(axis=1) for start in range(0, len(self.embeddings), 8192)])
+		self.order = np.argsort(assignments, kind="stable")
+		self.embeddings = self.embeddings[self.order]
+		self.cluster_starts = np.searchsorted(assignments[self.order], np.arange(n_clusters + 1))
+		self.centroids = centroids
+	
+	def search(self, queries, k):
+		# (rows, scores): for every query, the rows in bib_names of the k most similar embeddings and their cosine similarities, most similar first.
+		# Scores are -inf where the searched clusters had fewer than k rows.
+		import numpy as np
+		queries = np.asarray(queries, dtype=np.float32)
+		k = min(k, len(self.embeddings))
+		best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+		best_rows = np.zeros((len(queries), k), dtype=np.int64)
+		if self.centroids is None:
+			blocks = [(np.arange(len(queries)), 0, len(self.embeddings))]
+		else:
+			n_probe = min(VECTOR_INDEX_N_PROBE, len(self.centroids))
+			probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+			# The queries that search each cluster
+			probe_order = np.argsort(probes.ravel(), kind="stable")
+			probed_clusters, probe_starts = np.unique(probes.ravel()[probe_order], return_index=True)
+			query_groups = np.split(probe_order // n_probe, probe_starts[1:])
+			blocks = [(query_rows, self.cluster_starts[cluster], self.cluster_starts[cluster + 1]) for cluster, query_rows in zip(probed_clusters, query_groups)]
+		for query_rows, start, end in blocks:
+			if start == end:
+				continue
+			for i_batch in range(0, len(query_rows), VECTOR_INDEX_QUERY_BATCH):
+				batch = query_rows[i_batch:i_batch + VECTOR_INDEX_QUERY_BATCH]
+				scores = queries[batch] @ self.embeddings[start:end].T
+				candidate_scores = np.concatenate([best_scores[batch], scores], axis=1)
+				candidate_rows = np.concatenate([best_rows[batch], np.broadcast_to(np.arange(start, end), scores.shape)], axis=1)
+				top = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+				best_scores[batch] = np.take_along_axis(candidate_scores, top, axis=1)
+				best_rows[batch] = np.take_along_axis(candidate_rows, top, axis=1)
+		ranking = np.argsort(-best_scores, axis=1)
+		best_scores, best_rows = np.take_along_axis(best_scores, ranking, axis=1), np.take_along_axis(best_rows, ranking, axis=1)
+		return (best_rows if self.order is None else self.order[best_rows]), best_scores
+	
+	def save(self, folder):
+		# Writes the index as .npy files, which load memory-maps (so processes that load the same index share its pages)
+		import numpy as np
+		os.makedirs(folder, exist_ok=True)
+		with open(os.path.join(folder, "bib_names.json"), "w", encoding="utf-8") as f:
+			json.dump(self.bib_names, f)
+		for name in ("embeddings", "order", "centroids", "cluster_starts"):
+			if getattr(self, name) is not None:
+				np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+	
+	@classmethod
+	def load(cls, folder):
+		import numpy as np
+		with open(os.path.join(folder, "bib_names.json"), "r", encoding="utf-8") as f:
+			index = cls(json.load(f), np.load(os.path.join(folder, "embeddings.npy"), mmap_mode="r"), exact=True)
+		if os.path.exists(os.path.join(folder, "centroids.npy")):
+			index.order, index.centroids, index.cluster_starts = (np.load(os.path.join(folder, name + ".npy")) for name in ("order", "centroids", "cluster_starts"))
+		return index
+
+
+ALTERNATIVES_MODEL_NAME = BIOBERT_MODEL_NAME
+ALTERNATIVES_TOP_K = 5
+
+abstract_indexes = {}
+def get_abstract_index_key(model_name, library_abstracts):
+	# The key of the index of the non-empty abstracts in {bib name: abstract} in abstract_indexes, and their bib names
+	bib_names = [bib_name for bib_name, abstract in library_abstracts.items() if abstract]
+	key_hash = hashlib.sha1()
+	for bib_name in bib_names:
+		key_hash.update(f"{bib_name}\0{library_abstracts[bib_name]}\0".encode("utf-8"))
+	return (get_embedding_variant(model_name), key_hash.hexdigest()), bib_names
+
+def get_abstract_index(model_name, library_abstracts):
+	# The AbstractIndex of all non-empty abstracts in {bib name: abstract}, built once per process for the same abstracts and model
+	key, bib_names = get_abstract_index_key(model_name, library_abstracts)
+	if key not in abstract_indexes:
+		abstract_indexes.clear()  # Only the index of the current library is kept
+		embeddings = encode_texts(model_name, [library_abstracts[bib_name] for bib_name in bib_names], desc="Library abstracts") if bib_names else None
+		abstract_indexes[key] = AbstractIndex(bib_names, embeddings)
+	return abstract_indexes[key]
+
+@timed()
+def get_alternative_citations(citations_and_statements: list, library_abstracts: dict, model_name=ALTERNATIVES_MODEL_NAME, k=ALTERNATIVES_TOP_K):
+	# For every (citation, statement), the k entries of the library (other than the cited one) whose abstracts are most similar
+	# to the statement, as [(bib name, score), ...]. Each unique statement is searched once.
+	import numpy as np
+	if not citations_and_statements:
+		return []
+	index = get_abstract_index(model_name, library_abstracts)
+	if not index.bib_names:
+		return [[] for _ in citations_and_statements]
+	statements = list(dict.fromkeys(statement for bib_name, statement in citations_and_statements))
+	statement_index = {statement: i_statement for i_statement, statement in enumerate(statements)}
+	rows, scores = index.search(encode_texts(model_name, statements), k + 1)
+	alternatives = []
+	for bib_name, statement in citations_and_statements:
+		i_statement = statement_index[statement]
+		alternatives.append([(index.bib_names[row], round(float(score), 3)) for row, score in zip(rows[i_statement], scores[i_statement]) if np.isfinite(score) and index.bib_names[row] != bib_name][:k])
+	return alternatives
+
+
+# Common English words that can be left out of the overlap scores, so they measure shared content words rather than shared grammar
+OVERLAP_STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been before being below between both but by can could did do does
+doing down during each few for from further had has have having he her here hers herself him himself his how i if in into is it its itself
+just me more most my myself no nor not now of off on once only or other our ours ourselves out over own same she should so some such than
+that the their theirs them themselves then there these they this those through to too under until up very was we were what when where which
+while who whom why will with would you your yours yourself yourselves also et al may however thus using used via within without among
+""".split())
+
+token_ids = {}
+token_ids_lock = threading.Lock()
+
+@functools.lru_cache(maxsize=2 ** 18)
+def tokenize_to_ids(text, exclude_stopwords=False):
+	# The unique lowercase words in text, as a sorted tuple of interned integer ids. Memoised, so each text is only tokenised once.
+	# (Tuples of ints are dropped from the garbage collector's tracking, so a large memo doesn't slow down every collection like sets would.)
+	words = set(re.findall(r"\w+", text.lower()))
+	if exclude_stopwords:
+		words -= OVERLAP_STOPWORDS
+	with token_ids_lock:
+		new_words = [word for word in words if word not in token_ids]
+		token_ids.update(zip(new_words, range(len(token_ids), len(token_ids) + len(new_words))))
+		return tuple(sorted(map(token_ids.__getitem__, words)))
+
+def get_simple_overlap_score(text1, text2, exclude_stopwords=False):
+	text1_ids = tokenize_to_ids(text1, exclude_stopwords)
+	text2_ids = tokenize_to_ids(text2, exclude_stopwords)
+	if not text1_ids:  # No words (or only stopwords): 0, like in get_simple_overlap_scores
+		return 0.0
+	score = len(set(text1_ids).intersection(text2_ids)) / len(text1_ids)
 	return score
 
-def get_simple_overlap_scores(citations_and_statements: list, abstracts: dict):
-	scores = []
-	for bib_name, statement in tqdm(citations_and_statements, desc="Overlap", ncols=100, file=sys.stdout):
+@timed()
+def get_simple_overlap_scores(citations_and_statements: list, abstracts: dict, exclude_stopwords=False):
+	# Each unique text is tokenised once. Every abstract word becomes a sorted key (abstract row * vocabulary size + word id),
+	# so the words each statement shares with its abstract are found for all pairs at once with one searchsorted over the flattened statement words.
+	# Statements without any words get a score of 0.
+	import numpy as np
+	if not citations_and_statements:
+		return []
+	for bib_name, statement in citations_and_statements:
 		if bib_name not in abstracts:
 			abstracts[bib_name] = ""
-		statement_words = re.findall(r"\w+", statement.lower(), flags=re.I)
-		abstract_words = re.findall(r"\w+", abstracts[bib_name].lower(), flags=re.I)
-		statement_words_set = set(statement_words)
-		abstract_words_set = set(abstract_words)
-		common_words = statement_words_set.intersection(abstract_words_set)
-		statement_num_words = len(statement_words)
-		abstract_num_words = len(abstract_words)
-		score = len(common_words) / len(statement_words_set)
-		scores.append(score)
-	
-	return scores
+	statement_texts = list(dict.fromkeys(statement for bib_name, statement in citations_and_statements))
+	abstract_texts = list(dict.fromkeys(abstracts[bib_name] for bib_name, statement in citations_and_statements))
+	statement_tokens = [tokenize_to_ids(text, exclude_stopwords) for text in statement_texts]
+	abstract_tokens = [tokenize_to_ids(text, exclude_stopwords) for text in abstract_texts]
+	vocabulary_size = len(token_ids)
+	
+	abstract_lengths = np.array([len(tokens) for tokens in abstract_tokens], dtype=np.int64)
+	abstract_keys = np.repeat(np.arange(len(abstract_texts), dtype=np.int64), abstract_lengths) * vocabulary_size + np.fromiter(itertools.chain.from_iterable(abstract_tokens), dtype=np.int64, count=abstract_lengths.sum())
+	statement_lengths = np.array([len(tokens) for tokens in statement_tokens], dtype=np.int64)
+	statement_starts = np.concatenate([[0], np.cumsum(statement_lengths)[:-1]])
+	statement_words = np.fromiter(itertools.chain.from_iterable(statement_tokens), dtype=np.int64, count=statement_lengths.sum())
+	
+	statement_index = {text: i_text for i_text, text in enumerate(statement_texts)}
+	abstract_index = {text: i_text for i_text, text in enumerate(abstract_texts)}
+	statement_rows = np.array([statement_index[statement] for bib_name, statement in citations_and_statements], dtype=np.int64)
+	abstract_rows = np.array([abstract_index[abstracts[bib_name]] for bib_name, statement in citations_and_statements], dtype=np.int64)
+	
+	# One element per (pair, statement word)
+	pair_lengths = statement_lengths[statement_rows]
+	pair_of_word = np.repeat(np.arange(len(statement_rows)), pair_lengths)
+	word_positions = np.repeat(statement_starts[statement_rows] - np.cumsum(pair_lengths) + pair_lengths, pair_lengths) + np.arange(pair_lengths.sum())
+	query_keys = abstract_rows[pair_of_word] * vocabulary_size + statement_words[word_positions]
+	found = np.zeros(len(query_keys), dtype=bool)
+	if len(abstract_keys):
+		positions = np.minimum(np.searchsorted(abstract_keys, query_keys), len(abstract_keys) - 1)
+		found = abstract_keys[positions] == query_keys
+	common_words = np.bincount(pair_of_word, weights=found, minlength=len(statement_rows))
+	scores = np.divide(common_words, pair_lengths, out=np.zeros(len(statement_rows)), where=pair_lengths > 0)
+	return scores.tolist()
 
 
 def get_fuzzy_score(str1, str2):
@@ -772,39 +2958,55 @@ def add_prop_to_bib_entries(bibs: dict, property_key: str, property_dict: dict,
 
 
 def remove_curly_braces(text):
+	# Removes curly braces, but keeps groups like {\"o} and \'{e} (and any group that directly follows a character).
+	# Only the brace positions are visited, so the plain text in between is copied in slices.
+	if "{" not in text and "}" not in text:
+		return text
+	braces = [match.start() for match in re.finditer(r"[{}]", text)]
 	result = []
 	i = 0
 	n = len(text)
+	i_brace = 0  # Index in braces of the first brace at or after i
 	
 	while i < n:
-		if text[i:i + 2] == '{\\' or re.match(r".\{", text[i:i + 2]):
-			# Found the start of a group we need to keep
-			start = i
-			i += 2  # Skip '{\'
-			depth = 1  # Track nested braces
-			
-			while i < n and depth > 0:
-				if text[i] == '{':
-					depth += 1
-				elif text[i] == '}':
-					depth -= 1
-				i += 1
-			
-			# Add the kept group to the result
-			result.append(text[start:i])
-		elif text[i] not in '{}':
-			# Add any character that is not a curly brace
-			result.append(text[i])
-			i += 1
+		while i_brace < len(braces) and braces[i_brace] < i:
+			i_brace += 1
+		if i_brace == len(braces):
+			result.append(text[i:])
+			break
+		brace = braces[i_brace]
+		if text[brace] == '{' and brace > i:
+			# Found the start of a group we need to keep (the character before the brace starts it)
+			start = brace - 1
+		elif text[brace:brace + 2] == '{\\' or text[brace + 1:brace + 2] == '{':
+			start = brace
 		else:
 			# Skip pure curly braces
-			i += 1
+			result.append(text[i:brace])
+			i = brace + 1
+			continue
+		result.append(text[i:start])
+		
+		i = start + 2  # Skip the first two characters of the group
+		depth = 1  # Track nested braces
+		while i_brace < len(braces) and braces[i_brace] < i:
+			i_brace += 1
+		while i_brace < len(braces) and depth > 0:
+			depth += 1 if text[braces[i_brace]] == '{' else -1
+			i = braces[i_brace] + 1
+			i_brace += 1
+		if depth > 0:
+			i = n
+		
+		# Add the kept group to the result
+		result.append(text[start:i])
 	
 	return ''.join(result)
 
 def clean_text(text):
 	text = text.replace("‐", "-")  # Replace *ew* Mac *ew* hyphen with a proper hyphen
-	text = re.sub(r"(?:\<\w+.*?\>)|(?:\<\/\w+\>)", "", text)  # Remove html tags
+	if "<" in text:
+		text = re.sub(r"(?:\<\w+.*?\>)|(?:\<\/\w+\>)", "", text)  # Remove html tags
 	# text = re.sub(r"\{(?!\\.\w\})|(?<!\{\\.\w)\}", r"", text)  # Remove { and }, but not if they are part of umlauts and accents
 	# text = re.sub(r"(?<!\{\\.)\{(?!\\.)|(?<!\{\\..)\}", r"", text)  # Remove { and }, but not if they are part of umlauts and accents
 	# text = re.sub(r"(?<!\{\\.)\{(?!\\)(.*?)\}", r"\1", text)  # Remove { and }, but not if they are part of umlauts and accents
@@ -823,8 +3025,7 @@ def clean_text(text):
 	text = text.replace("\n", " ")  # Replace newlines with spaces
 	text = text.strip("\" ,")
 	text = remove_curly_braces(text)
-	text = re.sub(r'\s+', ' ', text)  # Replace multiple spaces with a single space
-	return text.strip()  # Remove leading and trailing spaces
+	return " ".join(text.split())  # Replace multiple spaces with a single space and remove leading and trailing spaces
 
 
 def update_discrepancies(bibs: dict, property_key: str, backup_property_key: str, bibname_new_old_discrepancy_dict: dict):
@@ -851,13 +3052,181 @@ def update_discrepancies(bibs: dict, property_key: str, backup_property_key: str
 
 
 
+def get_match_score_table(citation_statements, bibs_in_citations, abstracts, citation_counts, library_abstracts=None):
+	# The columns of the statement vs. abstract CSV for a list of CitationStatements (abstracts without "ERROR:" strings).
+	# With the abstracts of the whole library ({bib name: abstract}), the entries that match each statement best are listed too.
+	citations_and_statements = [(citation_statement.citation, citation_statement.statement) for citation_statement in citation_statements]
+	citations = [citation for citation, statement in citations_and_statements]
+	table = {
+		"Overlap score (# common words / # of words in statement set)": get_simple_overlap_scores(citations_and_statements, abstracts),
+		# "Fuzzy score": [get_fuzzy_score(str1, str2) for str1, str2 in zip()],  # TODO!!!
+		# "TF_IDF score" : get_TF_IDF_scores(citations_and_statements, abstracts),
+		"BERT score": get_BERT_scores(citations_and_statements, abstracts),
+		"BioBERT score": get_BioBERT_scores(citations_and_statements, abstracts),
+		**(get_sentence_score_columns(citations_and_statements, abstracts) if SENTENCE_LEVEL_SCORING else {}),
+		"bib name": citations,
+		"Citation count": [citation_counts.get(bib_name, 0) for bib_name in citations],
+		"Statement": [statement for citation, statement in citations_and_statements],
+		"Source": [f"{citation_statement.file}:{citation_statement.line}" for citation_statement in citation_statements],
+		"Abstract": [abstracts.get(bib_name, "") for bib_name in citations],
+		"Title": [bibs_in_citations.get(bib_name, {}).get("title", "") for bib_name in citations],
+		"DOI": [bibs_in_citations.get(bib_name, {}).get("doi", "") for bib_name in citations],
+		"PMID": [bibs_in_citations.get(bib_name, {}).get("pmid", "") for bib_name in citations],
+	}
+	if library_abstracts:
+		alternatives = get_alternative_citations(citations_and_statements, library_abstracts)
+		table["Best alternative score"] = [alternative[0][1] if alternative else "" for alternative in alternatives]
+		table[f"Alternatives (top {ALTERNATIVES_TOP_K})"] = ["; ".join(f"{bib_name} ({score})" for bib_name, score in alternative) for alternative in alternatives]
+	return table
+
+
+CORPUS_OUTPUT_FOLDER = "corpus_results"
+CORPUS_MAX_PROCESSES = 4  # Each scoring process holds its own copy of the BERT and BioBERT models
+
+def load_manuscript_manifest(manifest):
+	# One .tex file per line, relative to the manifest's folder. Empty lines and lines starting with # are skipped.
+	folder = os.path.dirname(manifest)
+	with open(manifest, "r", encoding="utf-8") as f:
+		return [os.path.join(folder, line.strip()) for line in f if line.strip() and not line.strip().startswith("#")]
+
+corpus_library_abstracts = {}  # In the scoring processes: the abstracts of the whole library, for the alternative citations
+
+def init_scoring_worker(n_threads, backend, max_seq_length, library_abstracts, abstract_index_key=None, abstract_index_folder=None):
+	# Runs once in every scoring process, before torch is imported. The processes share the CPUs instead of each using all of them,
+	# and they don't merge the chunks of the embedding cache while other processes may be reading them (run_corpus does it at the end).
+	# The library's abstracts are sent once per process instead of with every manuscript, and the index of their embeddings,
+	# built by run_corpus, is loaded from abstract_index_folder instead of being built again.
+	global EMBEDDING_CACHE_MAX_CHUNKS, EMBEDDING_BACKEND, EMBEDDING_MAX_SEQ_LENGTH
+	for variable in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+		os.environ[variable] = str(n_threads)
+	EMBEDDING_CACHE_MAX_CHUNKS = sys.maxsize
+	EMBEDDING_BACKEND, EMBEDDING_MAX_SEQ_LENGTH = backend, max_seq_length
+	corpus_library_abstracts.update(library_abstracts)
+	if abstract_index_key:
+		abstract_indexes[abstract_index_key] = AbstractIndex.load(abstract_index_folder)
+
+def score_corpus_manuscript(citation_statements, bibs_in_citations, abstracts, citation_counts):
+	# Returns the table and the metrics recorded while making it (merged into the parent's metrics by run_corpus)
+	metrics.reset()
+	table = get_match_score_table(citation_statements, bibs_in_citations, abstracts, citation_counts, corpus_library_abstracts)
+	return table, metrics.state()
+
+def run_corpus(manifest, bibtex_filename, output_folder=CORPUS_OUTPUT_FOLDER, max_processes=None):
+	# Validates many manuscripts against one shared library: the library is parsed once, the union of the cited entries is enriched once,
+	# and the manuscripts are scored on a pool of processes that each load the embedding models once.
+	# Writes <manuscript>.csv for every manuscript, combined.csv with all of them, and the enriched entries as <library>_Fred.bib.
+	import multiprocessing
+	import pandas as pd
+	manuscripts = load_manuscript_manifest(manifest)
+	bibs, bib_types = load_bibtex(bibtex_filename)
+	with metrics.span("iter_latex_citations"):
+		citation_statements = {manuscript: list(iter_latex_citations(manuscript)) for manuscript in manuscripts}
+	
+	cited = {citation_statement.citation for statements in citation_statements.values() for citation_statement in statements}
+	for manuscript, statements in citation_statements.items():
+		missing = sorted({citation_statement.citation for citation_statement in statements}.difference(bibs))
+		if missing:
+			print(f"{manuscript}: {len(missing)} citations are missing a reference in the BibTeX: {', '.join(missing)}")
+	bibs_in_citations = {bib_name: bib_entry for bib_name, bib_entry in bibs.items() if bib_name in cited}
+	print(f"{len(manuscripts)} manuscripts cite {len(cited)} unique references, {len(bibs_in_citations)} of the {len(bibs)} in the BibTeX")
+	
+	# Only missing fields are filled in: differences with the existing values are left for an interactive run of a single manuscript
+	checkpoint = EnrichmentCheckpoint(ENRICHMENT_CHECKPOINT_PATH)
+	DOIs, PMIDs, reference_counts, citation_counts, abstracts = run_enrichment_pipeline(bibs_in_citations, allow_copying_existing=True, checkpoint=checkpoint)
+	checkpoint.close()
+	for property_key, property_dict in (("doi", DOIs), ("pmid", PMIDs), ("reference_count", reference_counts), ("citation_count", citation_counts), ("abstract", abstracts)):
+		add_prop_to_bib_entries(bibs_in_citations, property_key, property_dict)
+	abstracts_without_error = {bib_name: bib_entry.get("abstract", "") if not bib_entry.get("abstract", "").startswith("ERROR:") else "" for bib_name, bib_entry in bibs_in_citations.items()}
+	library_abstracts = {bib_name: bib_entry.get("abstract", "") if not bib_entry.get("abstract", "").startswith("ERROR:") else "" for bib_name, bib_entry in bibs.items()}
+	os.makedirs(output_folder, exist_ok=True)
+	save_bibtex(bibs_in_citations, bib_types, os.path.join(output_folder, os.path.basename(bibtex_filename).rsplit(".", 1)[0] + "_Fred.bib"))
+	
+	# Output names: the file name without .tex, numbered if two manuscripts have the same one
+	names = {}
+	for manuscript in manuscripts:
+		name = os.path.splitext(os.path.basename(manuscript))[0]
+		names[manuscript] = name if name not in names.values() else f"{name}_{len(names)}"
+	
+	max_processes = max_processes or min(len(manuscripts), CORPUS_MAX_PROCESSES) or 1
+	n_threads = max(1, (os.cpu_count() or 1) // max_processes)
+	tables = {}
+	# The library's abstracts are encoded and indexed once, here, and the scoring processes load the index (memory-mapped) instead of each building it
+	import tempfile
+	with tempfile.TemporaryDirectory() as abstract_index_folder:
+		abstract_index_key = None
+		if any(library_abstracts.values()):
+			get_abstract_index(ALTERNATIVES_MODEL_NAME, library_abstracts).save(abstract_index_folder)
+			abstract_index_key = get_abstract_index_key(ALTERNATIVES_MODEL_NAME, library_abstracts)[0]
+		# Spawned rather than forked, so the workers don't inherit the parent's HTTP threads and locks
+		with ProcessPoolExecutor(max_processes, mp_context=multiprocessing.get_context("spawn"), initializer=init_scoring_worker, initargs=(n_threads, EMBEDDING_BACKEND, EMBEDDING_MAX_SEQ_LENGTH, library_abstracts, abstract_index_key, abstract_index_folder)) as executor:
+			futures = {}
+			for manuscript, statements in citation_statements.items():
+				manuscript_citations = {citation_statement.citation for citation_statement in statements}
+				futures[executor.submit(score_corpus_manuscript, statements,
+					{bib_name: bib_entry for bib_name, bib_entry in bibs_in_citations.items() if bib_name in manuscript_citations},
+					{bib_name: abstract for bib_name, abstract in abstracts_without_error.items() if bib_name in manuscript_citations},
+					{bib_name: count for bib_name, count in citation_counts.items() if bib_name in manuscript_citations})] = manuscript
+			for future in tqdm(as_completed(futures), total=len(futures), desc="Scoring manuscripts", ncols=100):
+				manuscript = futures[future]
+				table, worker_metrics = future.result()
+				metrics.merge(worker_metrics)
+				tables[manuscript] = pd.DataFrame(table)
+				tables[manuscript].to_csv(os.path.join(output_folder, names[manuscript] + ".csv"), index=False, sep="\t")
+	
+	combined = pd.concat([tables[manuscript].assign(Manuscript=names[manuscript]) for manuscript in manuscripts if manuscript in tables], ignore_index=True) if tables else pd.DataFrame(columns=["Manuscript"])
+	combined = combined[["Manuscript"] + [column for column in combined.columns if column != "Manuscript"]]
+	combined.to_csv(os.path.join(output_folder, "combined.csv"), index=False, sep="\t")
+	print(f"Saved {len(tables)} manuscript reports and combined.csv in {output_folder}")
+	
+	for model_name in (BERT_MODEL_NAME, BIOBERT_MODEL_NAME):
+		store = get_embedding_store(model_name)
+		store.load()
+		if len(store.chunks) > EMBEDDING_CACHE_MAX_CHUNKS:
+			store.compact()
+	metrics.write(*(os.path.join(output_folder, path) if path else None for path in (METRICS_SUMMARY_PATH, METRICS_PROMETHEUS_PATH)))
+	print(f"Saved the run metrics in {output_folder}")
+	return tables
+
+
+def main(argv=None):
+	global EMBEDDING_BACKEND, EMBEDDING_MAX_SEQ_LENGTH
+	parser = argparse.ArgumentParser(description="citationvalidator")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	
+	index_parser = subparsers.add_parser("index", help="Build (or extend) the offline metadata index from PubMed baseline XML or Crossref JSONL dumps")
+	index_parser.add_argument("files", nargs="+", help="PubMed .xml/.xml.gz files and/or Crossref .jsonl/.jsonl.gz files")
+	index_parser.add_argument("--index", default=OFFLINE_INDEX_PATH, help=f"Index file (default: {OFFLINE_INDEX_PATH})")
+	
+	corpus_parser = subparsers.add_parser("corpus", help="Validate many manuscripts against one shared BibTeX library")
+	corpus_parser.add_argument("manifest", help="Text file with one .tex file per line (relative to the manifest)")
+	corpus_parser.add_argument("bibtex", help="The shared .bib library")
+	corpus_parser.add_argument("--output", default=CORPUS_OUTPUT_FOLDER, help=f"Folder for the CSV reports (default: {CORPUS_OUTPUT_FOLDER})")
+	corpus_parser.add_argument("--processes", type=int, help=f"Number of scoring processes (default: up to {CORPUS_MAX_PROCESSES})")
+	corpus_parser.add_argument("--backend", choices=EMBEDDING_BACKENDS, default=EMBEDDING_BACKEND, help=f"Inference backend of the embedding models (default: {EMBEDDING_BACKEND})")
+	corpus_parser.add_argument("--max-seq-length", type=int, default=EMBEDDING_MAX_SEQ_LENGTH, help="Truncate texts to this many tokens when encoding them")
+	
+	args = parser.parse_args(argv)
+	if args.command == "index":
+		build_offline_index(args.files, args.index)
+	elif args.command == "corpus":
+		EMBEDDING_BACKEND, EMBEDDING_MAX_SEQ_LENGTH = args.backend, args.max_seq_length
+		run_corpus(args.manifest, args.bibtex, args.output, args.processes)
+
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+	main()
+
+
 if False and __name__ == '__main__':
 	bibtex_filename = "mythesislibrary_27JUNE2024.bib"
 	bibs, bib_types = load_bibtex(bibtex_filename)
 	
 	latex_filename = "Thesis manuscript_27JUNE2024.tex"
-	latex_file = load_file(latex_filename)
-	citations, statements = latex2citations_statements(latex_file)
+	latex_file = load_file(latex_filename)  # For the acronym pass below
+	with metrics.span("iter_latex_citations"):
+		citation_statements = list(iter_latex_citations(latex_filename))  # Follows \input, \include and \subfile
+	citations = [citation_statement.citation for citation_statement in citation_statements]
+	statements = [citation_statement.statement for citation_statement in citation_statements]
 	
 	print()
 	
@@ -894,9 +3263,14 @@ if False and __name__ == '__main__':
 	print("Only the references used as a citation will be kept.")
 	print()
 	
-	# Get DOIs
-	print("Finding missing DOIs from title and author...")
-	DOIs = get_DOIs(bibs_in_citations, allow_copying_existing=True)
+	# Results of the enrichment stages are saved per entry, so an interrupted run continues where it stopped
+	checkpoint = EnrichmentCheckpoint(ENRICHMENT_CHECKPOINT_PATH)
+	
+	# Get DOIs, PMIDs, reference/citation counts and abstracts. Each entry moves on to its next lookup as soon as the inputs for it are found
+	print("Finding missing DOIs, PMIDs, reference and citation counts and abstracts...")
+	DOIs, PMIDs, reference_counts, citation_counts, abstracts = run_enrichment_pipeline(bibs_in_citations, allow_copying_existing=True, checkpoint=checkpoint)
+	
+	# DOIs
 	# Add DOIs to bibs
 	bibs_in_citations = add_prop_to_bib_entries(bibs_in_citations, "doi", DOIs)
 	# Any mismatching DOIs? I.e. did get_DOIs() find better ones?
@@ -906,9 +3280,7 @@ if False and __name__ == '__main__':
 	else:
 		print("No new DOIs were found, which were different from the ones that were already there.")
 	
-	# Get PMIDs
-	print("Getting PMIDs...")
-	PMIDs = get_PMIDs(bibs_in_citations, allow_copying_existing=True)
+	# PMIDs
 	# Add PMIDs to bibs
 	bibs_in_citations = add_prop_to_bib_entries(bibs_in_citations, "pmid", PMIDs)
 	# Any mismatching PMIDs? I.e. did get_PMIDs() find better ones?
@@ -918,9 +3290,7 @@ if False and __name__ == '__main__':
 	else:
 		print("No new PMIDs were found, which were different from the ones that were already there.")
 	
-	# Get reference_counts and citation_counts
-	print("Getting reference counts and citation counts...")
-	reference_counts, citation_counts = get_reference_and_citation_counts(bibs_in_citations, allow_copying_existing=True)
+	# Reference_counts and citation_counts
 	# Add ref and cit counts to bibs
 	bibs_in_citations = add_prop_to_bib_entries(bibs_in_citations, "reference_count", reference_counts)
 	bibs_in_citations = add_prop_to_bib_entries(bibs_in_citations, "citation_count", citation_counts)
@@ -935,9 +3305,7 @@ if False and __name__ == '__main__':
 		for field, value in entry.items():
 			entry[field] = clean_text(value)
 	
-	# Get abstracts
-	print("Getting abstracts...")
-	abstracts = get_abstracts(bibs_in_citations, allow_copying_existing=True)
+	# Abstracts
 	# Add abstracts to bibs
 	bibs_in_citations = add_prop_to_bib_entries(bibs_in_citations, "abstract", abstracts)
 	# Any mismatching abstracts? I.e. did get_abstracts() find better ones?
@@ -947,6 +3315,8 @@ if False and __name__ == '__main__':
 	else:
 		print("No differences between new and original abstracts.")
 	
+	print("URL cache:", ", ".join(f"{key}: {value}" for key, value in get_url_cache().stats().items()))
+	
 	# # Get abstracts, DOIs, PMIDs, reference and citation counts, and add them to the bib
 	# bibs_in_citations = {bib_name : bib_entry for bib_name, bib_entry in bibs.items() if bib_name in citations}
 	# abstracts, DOIs, PMIDs, reference_counts, citation_counts = run_go(bibs_in_citations, True, False)
@@ -959,44 +3329,28 @@ if False and __name__ == '__main__':
 	# bibs = add_prop_to_bib_entries(bibs, "citation_count", citation_counts)
 	
 	
-	# Find any close duplicates in the bibtex
-	# find_matching_bibs(bibs_in_citations)
-	DOIs_set = set([bib_entry["doi"] for bib_entry in bibs_in_citations.values() if "doi" in bib_entry])
-	matching_DOIs_dict = {DOI : [bib_name for bib_name, bib_entry in bibs_in_citations.items() if "doi" in bib_entry and bib_entry["doi"] == DOI] for DOI in DOIs_set if sum([x.get("doi") == DOI for x in bibs_in_citations.values()]) > 1}
-	N_matching_bibs = sum([len(x) for x in matching_DOIs_dict.values()])
-	if N_matching_bibs:
-		print()
-		print(f"Some bib entries had exact matching DOIs:  {N_matching_bibs} / {len(bibs_in_citations)} ({round(N_matching_bibs / len(bibs_in_citations) * 100, 1)}%)")
-		print(tabulate([[DOI, ", ".join(bib_names)] for DOI, bib_names in matching_DOIs_dict.items()], headers=["DOI", "Bibs"], maxcolwidths=[None, 100]))
+	# Find any close duplicates in the bibtex (same DOI or PMID, or near-identical titles)
+	print()
+	find_matching_bibs(bibs_in_citations)
 	
 	print()
 	
 	# Get a match score between statement in LaTeX file and the abstract(s) of the corresponding citation(s). To avoid bias, exclude common words (e.g. "the", "a"...)
 	abstracts_without_error = {bib_name: bib_entry.get("abstract", "") if not bib_entry.get("abstract", "").startswith("ERROR:") else "" for bib_name, bib_entry in bibs_in_citations.items()}
 	TF_IDF_scores = get_TF_IDF_scores(list(zip(citations, statements)), abstracts_without_error)
-	BERT_scores = get_BERT_scores(list(zip(citations, statements)), abstracts_without_error)
-	BioBERT_scores = get_BioBERT_scores(list(zip(citations, statements)), abstracts_without_error)
-	overlap_scores = get_simple_overlap_scores(list(zip(citations, statements)), abstracts_without_error)
-	# fuzzy_scores =
+	# The abstracts of the whole library, to list the entries that support each statement best
+	library_abstracts = {bib_name: bib_entry.get("abstract", "") if not bib_entry.get("abstract", "").startswith("ERROR:") else "" for bib_name, bib_entry in bibs.items()}
+	data = get_match_score_table(citation_statements, bibs_in_citations, abstracts_without_error, citation_counts, library_abstracts)
 	
 	# Save scores, bib_name, statement, abstract as a .csv file
-	data = {
-		"Overlap score (# common words / # of words in statement set)": overlap_scores,
-		# "Fuzzy score": [get_fuzzy_score(str1, str2) for str1, str2 in zip()],  # TODO!!!
-		# "TF_IDF score" : TF_IDF_scores,
-		"BERT score": BERT_scores,
-		"BioBERT score": BioBERT_scores,
-		"bib name": citations,
-		"Citation count": [citation_counts.get(bib_name, 0) for bib_name in citations],
-		"Statement": statements,
-		"Abstract": [abstracts_without_error.get(bib_name, "") for bib_name in citations],
-		"Title": [bibs_in_citations[bib_name].get("title", "") if bib_name in bibs.keys() else "" for bib_name in citations],
-		"DOI": [bibs_in_citations[bib_name].get("doi", "") if bib_name in bibs.keys() else "" for bib_name in citations],
-		"PMID": [bibs_in_citations[bib_name].get("pmid", "") if bib_name in bibs.keys() else "" for bib_name in citations]
-	}
+	import pandas as pd
 	df = pd.DataFrame(data)
 	df.to_csv("statement_vs_abstract_match_scores.csv", index=False, sep="\t")
 	
+	# Time per stage, requests per host, cache hit ratios and encoding throughput of this run
+	metrics.write()
+	print(f"Run metrics saved in {METRICS_SUMMARY_PATH} and {METRICS_PROMETHEUS_PATH}")
+	
 	# Get a list of DOIs that don't have an abstract
 	bibs_without_abstract = {bib_name: [bib_entry.get("doi"), bib_entry.get("pmid")] for bib_name, bib_entry in bibs_in_citations.items() if not bib_entry.get("abstract") or bib_entry.get("abstract").startswith("ERROR:")}
 	print(f"\nBibs without abstract:  {len(bibs_without_abstract)} / {len(bibs_in_citations)} ({round(len(bibs_without_abstract) / len(bibs_in_citations) * 100, 1)}%)")
@@ -1037,6 +3391,7 @@ if False and __name__ == '__main__':
 	# Plot density of bibs over year
 	years_dict = {bib_name : int(bib_entry.get("year")) for bib_name, bib_entry in bibs_in_citations.items() if bib_entry.get("year")}
 	years_list = [year for year in years_dict.values()]
+	plt = get_pyplot()
 	plt.figure(1, figsize=(7, 5))
 	plt.hist(years_list, bins=max(years_list) - min(years_list) + 1)
 	plt.xlabel("Publication year")
@@ -1045,7 +3400,8 @@ if False and __name__ == '__main__':
 	plt.grid(which="major", axis="both")
 	plt.tight_layout()
 	plt.savefig("hist_bib_years.png")
-	plt.show()
+	if plt.get_backend().lower() != "agg":
+		plt.show()
 
 # TODO: Are there any close duplicates in the bibtex? Done..-
 # TODO: Get a match score between statement in LaTeX file and the abstract of the corresponding citation. To avoid bias, exclude common words (e.g. "the", "a"...)-